@@ -4,7 +4,6 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import json
-import pickle
 import markdown
 import requests
 
@@ -14,20 +13,33 @@ from flask_socketio import SocketIO, emit, join_room
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
-from google.auth.transport.requests import Request as GoogleRequest
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from email.message import EmailMessage
 import base64
+import gzip
+import hashlib
+import threading
+import uuid
 
-from google_auth_oauthlib.flow import InstalledAppFlow
 import health_analysis
+import health_storage
+import health_rollups
+import gemini_cache
+import plot_export
+from report_jobs import ReportJobQueue
+from health_write_queue import HealthWriteQueue, attach_status_codes
 import auth
 from google_auth_oauthlib.flow import Flow
 from auth import init_auth, get_user_upload_folder, load_user_settings, get_user_by_id
 from img_recognition import img_recognition_bp
 from lib import mdToHtml, strip_html_tags
+from gmail_client import SCOPES, CREDENTIALS_FILE, GmailAuthError, get_gmail_client
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 load_dotenv()
 
@@ -51,6 +63,13 @@ app.register_blueprint(img_recognition_bp)
 socketio = SocketIO(app)
 user_sid_map = {}
 
+# 載入模組時就在背景預先啟動 Kaleido (不阻塞)，第一份報告不必等待瀏覽器冷啟動；
+# 以 gunicorn 等 WSGI 伺服器執行時，每個 worker 程序匯入本模組時各自啟動
+plot_export.get_plot_exporter().start()
+
+# 小於此大小的 JSON 回應不壓縮
+RESPONSE_COMPRESS_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+
 # --- Helper functions ---
 def get_user_data_path(user_id, subfolder=None, filename=None):
     base_dir = get_user_upload_folder(user_id)
@@ -84,35 +103,10 @@ def is_authorized_for_user(target_user_id):
     return str(target_user_id) in bound_accounts
 
 # --- Gmail API Function ---
-SCOPES = ['https://www.googleapis.com/auth/gmail.send']
-CREDENTIALS_FILE = "gmail_credential.json"
-TOKEN_FILE = "token.pickle"
+# 憑證、權杖更新與 Gmail service 由 gmail_client 在整個程序中共用，每封信只需送出一次 API 請求
 
 def send_email_with_gmail_api(sender_email, recipient_email, subject, body, attachment_path=None):
-    creds = None
-    try:
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'rb') as token:
-                creds = pickle.load(token)
-    except (EOFError, pickle.PickleError) as e:
-        print(f"Error loading {TOKEN_FILE}: {e}. Re-authenticating...")
-        creds = None
-        if os.path.exists(TOKEN_FILE):
-            os.remove(TOKEN_FILE)
-
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(GoogleRequest())
-        else:
-            if not os.path.exists(CREDENTIALS_FILE):
-                return False, f"credentials.json not found at {CREDENTIALS_FILE}."
-            flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
-            with open(TOKEN_FILE, 'wb') as token:
-                pickle.dump(creds, token)
-
     try:
-        service = build('gmail', 'v1', credentials=creds)
         message = EmailMessage()
         message.set_content(body, subtype='html')
         message['To'] = recipient_email
@@ -128,10 +122,12 @@ def send_email_with_gmail_api(sender_email, recipient_email, subject, body, atta
 
         encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
         create_message = {'raw': encoded_message}
-        send_message = service.users().messages().send(userId="me", body=create_message).execute()
+        send_message = get_gmail_client().send(create_message)
         print(f"✅ Email sent, ID: {send_message['id']}")
         return True, "Email sent successfully."
 
+    except GmailAuthError as e:
+        return False, str(e)
     except HttpError as error:
         print(f"Error sending email: {error}")
         return False, f"Failed to send email: {error}"
@@ -140,58 +136,86 @@ def send_email_with_gmail_api(sender_email, recipient_email, subject, body, atta
         return False, f"Failed to send email: {e}"
 
 # --- Health Data Logic ---
-def save_health_data_to_csv(user_id, date, data_dict, data_type):
-    user_folder = get_user_upload_folder(user_id)
-    csv_filename = f"{data_type}.csv"
-    csv_path = os.path.join(user_folder, csv_filename)
-
-    if data_type == 'blood_pressure':
-        columns = ['Date', 'Morning_Systolic', 'Morning_Diastolic', 'Morning_Pulse',
-                   'Noon_Systolic', 'Noon_Diastolic', 'Noon_Pulse',
-                   'Evening_Systolic', 'Evening_Diastolic', 'Evening_Pulse']
-    elif data_type == 'blood_sugar':
-        columns = ['Date', 'Morning_Fasting', 'Morning_Postprandial',
-                   'Noon_Fasting', 'Noon_Postprandial',
-                   'Evening_Fasting', 'Evening_Postprandial']
-    else:
-        raise ValueError("Invalid data_type specified")
+def notify_health_data_saved(user_id, updated_keys):
+    # 一次合併寫入只送出一則 update 事件
+    dates = sorted({date for _, date in updated_keys})
+    data_types = sorted({data_type.replace("_", " ") for data_type, _ in updated_keys})
+    socketio.emit('update', {
+        'message': f'🟢 {"、".join(dates)} 的 {"、".join(data_types)} 紀錄已更新',
+        'event_type': 'summary'
+    }, room=user_sid_map.get(user_id))
 
-    if os.path.exists(csv_path):
-        df = pd.read_csv(csv_path, encoding='utf-8-sig')
-        df['Date'] = pd.to_datetime(df['Date']).dt.strftime('%Y-%m-%d')
+health_write_queue = HealthWriteQueue(on_flush=notify_health_data_saved)
+
+# --- Report Jobs ---
+def notify_report_job(job):
+    sid = user_sid_map.get(job.owner_id)
+    if sid:
+        socketio.emit('update', {
+            'message': job.message,
+            'event_type': 'report_job',
+            'job': job.to_dict()
+        }, room=sid)
+
+report_job_queue = ReportJobQueue(on_update=notify_report_job)
+
+def email_report_pdf(target_user_id, recipient_email, pdf_report_rel_static_path, pdf_filename):
+    report_subject = pdf_filename.replace('.pdf', '')
+    report_body = f"您好，<br><br>這是您在 HealthLLM 系統中為帳戶 {get_user_by_id(target_user_id).name} 生成的健康趨勢報告。<br><br>請查收附件。<br><br>此致，<br>HealthLLM 團隊"
+    abs_pdf_path = os.path.abspath(os.path.join('static', pdf_report_rel_static_path))
+    return send_email_with_gmail_api(
+        sender_email="healthllm.team@gmail.com",
+        recipient_email=recipient_email,
+        subject=report_subject,
+        body=report_body,
+        attachment_path=abs_pdf_path
+    )
+
+def get_pdf_failure_reason(trend_output_text):
+    """health_trend_analysis 沒有產生 PDF 時的原因：跳過 PDF 的說明附在分析文字最後一行，其餘情況整段文字即為錯誤訊息。"""
+    text = (trend_output_text or '').strip()
+    if not text:
+        return '未知原因'
+    last_line = text.splitlines()[-1]
+    if last_line.startswith(health_analysis.PDF_SKIPPED_NOTE_PREFIX):
+        return last_line
+    return text
+
+def run_report_job(job, progress):
+    """在背景執行緒中產生報告；每個工作有自己的輸出資料夾，工作過期時一併刪除。"""
+    params = job.params
+    job.output_dir = get_user_data_path(params['user_id'], os.path.join('report_jobs', job.id))
+    analysis_timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+    trend_output_text, pdf_report_rel_static_path, _, pdf_filename = health_analysis.health_trend_analysis(
+        params['user_id'], job.output_dir, analysis_timestamp_str, params['time_period'], params['data_type'],
+        generate_pdf=True, progress=progress, start_date=params.get('start_date'), end_date=params.get('end_date')
+    )
+    if not pdf_report_rel_static_path:
+        raise RuntimeError(f"PDF 報告生成失敗：{get_pdf_failure_reason(trend_output_text)}")
+
+    result = {'pdf_filename': pdf_filename, 'pdf_path': pdf_report_rel_static_path}
+    if job.kind == 'email':
+        progress('sending_email', f"正在寄送報告至 {params['email']}...")
+        success, message = email_report_pdf(params['user_id'], params['email'], pdf_report_rel_static_path, pdf_filename)
+        if not success:
+            raise RuntimeError(message)
+        result['message'] = f'🟢 {message}'
     else:
-        df = pd.DataFrame(columns=columns)
+        result['message'] = '🟢 PDF 報告已完成，可以下載。'
+    return result
 
-    for col in columns:
-        if col != 'Date' and col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
+def get_date_range_params(source):
+    """從表單或 JSON 讀取自訂區間 start_date / end_date (YYYY-MM-DD，可只提供一端)。
 
-    if date in df['Date'].values:
-        row_index = df[df['Date'] == date].index[0]
-        for key, value in data_dict.items():
-            numeric_value = pd.to_numeric(value, errors='coerce')
-            df.loc[row_index, key] = numeric_value
-    else:
-        new_row = {'Date': date}
-        for col in columns:
-            if col != 'Date':
-                value = data_dict.get(col)
-                numeric_value = pd.to_numeric(value, errors='coerce')
-                new_row[col] = numeric_value
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-
-    for col in columns:
-        if col not in df.columns:
-            df[col] = np.nan
-    df = df[columns]
-
-    df.sort_values(by='Date', inplace=True)
-    df.to_csv(csv_path, index=False, encoding='utf-8-sig')
-    
-    socketio.emit('update', {
-        'message': f'🟢 {date} 的 {data_type.replace("_", " ")} 紀錄已更新',
-        'event_type': 'summary'
-    }, room=user_sid_map.get(user_id))
+    回傳 (start_date, end_date)，未提供者為 None；日期無效或起始晚於結束時拋出 ValueError。"""
+    start_date = source.get('start_date') or None
+    end_date = source.get('end_date') or None
+    health_analysis.get_period_date_range(None, start_date, end_date)
+    return start_date, end_date
+
+def save_health_data_to_csv(user_id, date, data_dict, data_type):
+    """排入使用者的寫入佇列，回傳寫入完成時才有結果的 Future。"""
+    return health_write_queue.submit(user_id, date, data_dict, data_type)
 
 # --- Route definitions ---
 @app.context_processor
@@ -275,14 +299,18 @@ def save_health_data():
     sugar_data_to_save = {k: v for k, v in sugar_data_to_save.items() if v}
 
     try:
+        pending_writes = []
         if bp_data_to_save:
-            save_health_data_to_csv(target_user_id, date, bp_data_to_save, 'blood_pressure')
+            pending_writes.append(save_health_data_to_csv(target_user_id, date, bp_data_to_save, 'blood_pressure'))
         if sugar_data_to_save:
-            save_health_data_to_csv(target_user_id, date, sugar_data_to_save, 'blood_sugar')
+            pending_writes.append(save_health_data_to_csv(target_user_id, date, sugar_data_to_save, 'blood_sugar'))
         
         if not bp_data_to_save and not sugar_data_to_save:
              return jsonify({'success': False, 'message': '未提交任何有效數據。'}), 400
 
+        for pending_write in pending_writes:
+            pending_write.result(timeout=30)
+
         return jsonify({'success': True, 'message': '數據已成功儲存'})
     except Exception as e:
         print(f"Error in save_health_data: {e}")
@@ -290,6 +318,71 @@ def save_health_data():
         traceback.print_exc()
         return jsonify({'success': False, 'message': f'伺服器錯誤: {e}'}), 500
 
+@app.route('/api/import_health_data', methods=['POST'])
+@login_required
+def import_health_data():
+    # 支援兩種格式：multipart 上傳 CSV 檔 (file 欄位)，或 JSON {"user_id", "data_type", "rows": [...]}
+    if request.is_json:
+        payload = request.get_json()
+        target_user_id = payload.get('user_id')
+        data_type = payload.get('data_type')
+        rows = payload.get('rows')
+        if not isinstance(rows, list) or not rows:
+            return jsonify({'success': False, 'message': '請提供要匯入的資料列 (rows)。'}), 400
+        raw_df = pd.DataFrame(rows)
+    else:
+        target_user_id = request.form.get('user_id')
+        data_type = request.form.get('data_type')
+        upload = request.files.get('file')
+        if not upload or upload.filename == '':
+            return jsonify({'success': False, 'message': '請上傳 CSV 檔案。'}), 400
+        try:
+            raw_df = pd.read_csv(upload.stream, dtype=str, keep_default_na=False, encoding='utf-8-sig')
+        except Exception as e:
+            return jsonify({'success': False, 'message': f'無法解析 CSV 檔案: {e}'}), 400
+
+    if not is_authorized_for_user(target_user_id):
+        return jsonify({'success': False, 'message': '權限不足，無法操作此帳戶。'}), 403
+    if data_type not in health_storage.HEALTH_DATA_COLUMNS:
+        return jsonify({'success': False, 'message': '無效的數據類型。'}), 400
+
+    try:
+        valid_df, rejects, ignored_columns = health_storage.coerce_health_rows(raw_df, data_type)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    if valid_df.empty:
+        return jsonify({
+            'success': False,
+            'message': f'沒有可匯入的有效資料，{len(rejects)} 筆資料被拒絕。',
+            'imported_days': 0,
+            'rejected': rejects,
+            'ignored_columns': ignored_columns
+        }), 400
+
+    try:
+        with health_write_queue.user_lock(target_user_id):
+            store = health_storage.get_health_store()
+            store.bulk_upsert(target_user_id, attach_status_codes(store, target_user_id, data_type, valid_df), data_type)
+            health_rollups.update_rollups(target_user_id, data_type, valid_df['Date'])
+        socketio.emit('update', {
+            'message': f'🟢 已匯入 {len(valid_df)} 天的 {data_type.replace("_", " ")} 紀錄',
+            'event_type': 'summary'
+        }, room=user_sid_map.get(target_user_id))
+    except Exception as e:
+        print(f"Error in import_health_data: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'message': f'伺服器錯誤: {e}'}), 500
+
+    return jsonify({
+        'success': True,
+        'message': f'已匯入 {len(valid_df)} 天的數據，{len(rejects)} 筆資料被拒絕。',
+        'imported_days': len(valid_df),
+        'rejected': rejects,
+        'ignored_columns': ignored_columns
+    })
+
 @app.route('/get_linked_accounts')
 @login_required
 def get_linked_accounts():
@@ -316,24 +409,54 @@ def get_health_data_for_date():
 
     data_to_send = {}
     
+    store = health_storage.get_health_store()
     for data_type in ['blood_pressure', 'blood_sugar']:
-        csv_file = get_user_data_path(target_user_id, filename=f'{data_type}.csv')
-        if os.path.exists(csv_file):
-            try:
-                df = pd.read_csv(csv_file, encoding='utf-8-sig')
-                df['Date'] = pd.to_datetime(df['Date']).dt.strftime('%Y-%m-%d')
-                date_row = df[df['Date'] == selected_date_str]
-                if not date_row.empty:
-                    row_dict = date_row.iloc[0].to_dict()
-                    for csv_col, value in row_dict.items():
-                        if csv_col != 'Date' and pd.notna(value):
-                            form_field_name = csv_col.lower()
-                            data_to_send[form_field_name] = str(int(value))
-            except Exception as e:
-                print(f"Error reading {csv_file}: {e}")
+        try:
+            row_dict = store.lookup(target_user_id, data_type, selected_date_str)
+            if row_dict:
+                for csv_col, value in row_dict.items():
+                    if csv_col != 'Date' and not health_storage.is_status_column(csv_col) and pd.notna(value):
+                        form_field_name = csv_col.lower()
+                        data_to_send[form_field_name] = str(int(value))
+                # 寫入時已儲存的狀態，前端可直接顯示而不必逐筆呼叫 check_bp_status / check_bs_status
+                data_to_send.setdefault('statuses', {}).update(health_analysis.describe_status_row(row_dict, data_type))
+        except Exception as e:
+            print(f"Error reading {data_type} for {target_user_id}: {e}")
     
     return jsonify(data_to_send)
 
+@app.route('/api/health_cache_stats', methods=['GET'])
+@login_required
+def health_cache_stats():
+    stats = health_storage.get_cache_stats()
+    stats['gemini'] = gemini_cache.get_gemini_cache().stats()
+    stats['plot_images'] = plot_export.get_plot_exporter().stats()
+    # 未設定 wkhtmltopdf 時沒有轉檔服務
+    pdf_render_service = health_analysis.pdf_render_service
+    stats['pdf_render'] = pdf_render_service.stats() if pdf_render_service else None
+    return jsonify(stats)
+
+@app.route('/api/health_rollups', methods=['GET'])
+@login_required
+def health_rollups_summary():
+    target_user_id = request.args.get('user_id', current_user.id)
+    if not is_authorized_for_user(target_user_id):
+        return jsonify({"error": "權限不足"}), 403
+
+    data_type = request.args.get('data_type')
+    granularity = request.args.get('granularity', 'month')
+    if data_type not in health_rollups.ROLLUP_METRICS:
+        return jsonify({"error": "無效的數據類型"}), 400
+
+    try:
+        buckets = health_rollups.get_rollups(
+            target_user_id, data_type, granularity,
+            request.args.get('start_date'), request.args.get('end_date')
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({'data_type': data_type, 'granularity': granularity, 'buckets': buckets})
+
 @app.route('/api/check_bp_status', methods=['POST'])
 def check_bp_status():
     data = request.get_json()
@@ -351,6 +474,119 @@ def check_bs_status():
     status, advice, normal_range_info = health_analysis.analyze_blood_sugar(value, measurement_type)
     return jsonify({'status': status, 'advice': advice, 'normal_range_info': normal_range_info})
 
+@app.route('/api/classify_health_batch', methods=['POST'])
+@login_required
+def classify_health_batch():
+    """一次分類多筆讀數。
+
+    - 直接提供讀數：{"blood_pressure": [{"systolic", "diastolic", "pulse"}], "blood_sugar": [{"value", "type"}]}
+    - 分類已儲存的紀錄：{"user_id", "data_type", "start_date", "end_date"}，回傳每日各時段的狀態代碼
+    """
+    data = request.get_json() or {}
+    response = {'legend': health_analysis.get_status_legend()}
+
+    if 'data_type' in data:
+        target_user_id = data.get('user_id') or current_user.id
+        data_type = data.get('data_type')
+        if not is_authorized_for_user(target_user_id):
+            return jsonify({'error': '權限不足'}), 403
+        if data_type not in health_storage.HEALTH_DATA_COLUMNS:
+            return jsonify({'error': '無效的數據類型'}), 400
+        try:
+            df = health_storage.get_health_store().load(target_user_id, data_type, data.get('start_date'), data.get('end_date'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        status_df = health_analysis.get_status_frame(df, data_type)
+        response['data_type'] = data_type
+        response['statuses'] = status_df.to_dict(orient='records')
+        return jsonify(response)
+
+    bp_readings = data.get('blood_pressure') or []
+    if bp_readings:
+        response['blood_pressure'] = health_analysis.describe_blood_pressure_batch(
+            [r.get('systolic') for r in bp_readings],
+            [r.get('diastolic') for r in bp_readings],
+            [r.get('pulse') for r in bp_readings]
+        )
+
+    sugar_readings = data.get('blood_sugar') or []
+    if sugar_readings:
+        results = [None] * len(sugar_readings)
+        for measurement_type in ('fasting', 'postprandial'):
+            positions = [i for i, r in enumerate(sugar_readings) if str(r.get('type', 'fasting')).lower() == measurement_type]
+            if positions:
+                described = health_analysis.describe_blood_sugar_batch([sugar_readings[i].get('value') for i in positions], measurement_type)
+                for i, item in zip(positions, described):
+                    results[i] = item
+        if any(item is None for item in results):
+            return jsonify({'error': "血糖讀數的 type 必須是 'fasting' 或 'postprandial'。"}), 400
+        response['blood_sugar'] = results
+
+    return jsonify(response)
+
+def compressed_json_response(body, etag=None):
+    """依 Accept-Encoding 以 brotli (若已安裝) 或 gzip 壓縮 JSON 回應，並附上 ETag。"""
+    data = body.encode('utf-8')
+    response = Response(mimetype='application/json')
+    accepted = request.accept_encodings
+    encoding = None
+    if len(data) >= RESPONSE_COMPRESS_MIN_BYTES:
+        if brotli is not None and accepted['br']:
+            data, encoding = brotli.compress(data, quality=5), 'br'
+        elif accepted['gzip']:
+            data, encoding = gzip.compress(data, compresslevel=6), 'gzip'
+    response.set_data(data)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if etag:
+        response.set_etag(etag)
+        # 瀏覽器不會替 POST 自動帶 If-None-Match，由前端保存 ETag 並自行送出
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def start_streaming_trend_analysis(sid, stream_id, target_user_id, time_period, data_type, full_resolution, plot_format,
+                                   start_date=None, end_date=None):
+    """在背景執行緒中進行趨勢分析，圖表數據一產生就回傳，AI 分析文字則以 'trend_stream' 事件逐段推送到 sid。
+
+    回傳 (plot_data_string, None)；若分析在產生圖表前就結束 (例如區間內無數據)，回傳 (None, 分析結果文字)。"""
+    plot_ready = threading.Event()
+    outcome = {}
+
+    def on_plot_ready(plot_data_string):
+        outcome['plot'] = plot_data_string
+        plot_ready.set()
+
+    def on_text_chunk(text):
+        socketio.emit('trend_stream', {'stream_id': stream_id, 'chunk': text}, room=sid)
+
+    def run():
+        trend_output_text = None
+        try:
+            trend_output_text, _, _, _ = health_analysis.health_trend_analysis(
+                target_user_id, None, None, time_period, data_type, generate_pdf=False,
+                full_resolution=full_resolution, plot_format=plot_format,
+                on_plot_ready=on_plot_ready, on_text_chunk=on_text_chunk, start_date=start_date, end_date=end_date
+            )
+        finally:
+            outcome['text'] = trend_output_text or "趨勢分析發生錯誤。"
+            streaming = 'plot' in outcome
+            plot_ready.set()
+        if not streaming:
+            return
+        final = {'stream_id': stream_id, 'done': True}
+        if "錯誤" in outcome['text']:
+            final.update(success=False, message=outcome['text'])
+        else:
+            final.update(success=True, message='帳戶數據趨勢分析完成。', trend_output_html=markdown.markdown(outcome['text']))
+        socketio.emit('trend_stream', final, room=sid)
+
+    socketio.start_background_task(run)
+    plot_ready.wait()
+    if 'plot' in outcome:
+        return outcome['plot'], None
+    return None, outcome['text']
+
 @app.route('/analyze_account_trend', methods=['POST'])
 @login_required
 def analyze_account_trend():
@@ -360,43 +596,83 @@ def analyze_account_trend():
 
     time_period = request.form.get('time_period')
     data_type = request.form.get('data_type')
-
-    if data_type == 'blood_pressure':
-        csv_file_path = get_user_data_path(target_user_id, filename='blood_pressure.csv')
-    elif data_type == 'blood_sugar':
-        csv_file_path = get_user_data_path(target_user_id, filename='blood_sugar.csv')
-    else:
+    # 預設長期趨勢圖會取樣以減少傳輸與繪製的點數，full_resolution=true 時回傳每一筆讀數
+    full_resolution = request.form.get('full_resolution') == 'true'
+    # format=compact 時回傳型別化的欄位陣列與版面描述，由前端組成圖表；否則回傳完整的 Plotly 圖表 JSON
+    plot_format = 'compact' if request.form.get('format') == 'compact' else 'plotly'
+    # stream=true 時先回傳圖表，AI 分析文字再以 Socket.IO 'trend_stream' 事件逐段推送 (需已建立連線)
+    stream_sid = user_sid_map.get(current_user.id) if request.form.get('stream') == 'true' else None
+
+    if data_type not in health_analysis.TREND_DATA_TYPES:
         return jsonify({'success': False, 'message': '無效的數據類型。'}), 400
 
-    if not os.path.exists(csv_file_path):
+    try:
+        # start_date / end_date 為自訂區間，提供時取代 time_period
+        start_date, end_date = get_date_range_params(request.form)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'無效的日期範圍：{e}'}), 400
+
+    if not health_analysis.has_trend_data(target_user_id, data_type):
         return jsonify({'success': False, 'message': '該數據類型無歷史紀錄可供分析。'}), 404
     
     try:
-        trend_output_text, _, plotly_data_string, _ = \
-            health_analysis.health_trend_analysis(csv_file_path, None, None, time_period, data_type, generate_pdf=False)
-        
-        if "錯誤" in trend_output_text:
-            return jsonify({'success': False, 'message': trend_output_text}), 500
-
-        trend_output_html = markdown.markdown(trend_output_text)
+        # 數據未變動時直接回 304，不重新分析與繪圖；串流與一般回應的內容不同 (前者只有 stream_id)，ETag 需分開
+        data_version = health_analysis.get_trend_data_version(target_user_id, data_type, time_period, start_date, end_date)
+        period_key = health_analysis.get_period_key(time_period, start_date, end_date)
+        etag = hashlib.sha256(
+            f"{data_version}|{period_key}|{plot_format}|{full_resolution}|{bool(stream_sid)}".encode('utf-8')
+        ).hexdigest()
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
 
         report_params = {
             "data_type": data_type,
             "time_period": time_period,
             "user_id": target_user_id
         }
-        
-        response_data_partial = {
-            'success': True,
-            'message': '帳戶數據趨勢分析完成。',
-            'trend_output_html': trend_output_html, 
-            'report_params': report_params
-        }
+        if start_date or end_date:
+            report_params.update(start_date=start_date, end_date=end_date)
+
+        trend_output_text = None
+        if stream_sid:
+            stream_id = uuid.uuid4().hex
+            plot_data_string, trend_output_text = start_streaming_trend_analysis(
+                stream_sid, stream_id, target_user_id, time_period, data_type, full_resolution, plot_format,
+                start_date, end_date
+            )
+            if plot_data_string is not None:
+                response_data_partial = {
+                    'success': True,
+                    'message': '趨勢圖已完成，AI 趨勢分析產生中...',
+                    'stream_id': stream_id,
+                    'report_params': report_params
+                }
+        else:
+            trend_output_text, _, plot_data_string, _ = \
+                health_analysis.health_trend_analysis(target_user_id, None, None, time_period, data_type, generate_pdf=False,
+                                                      full_resolution=full_resolution, plot_format=plot_format,
+                                                      start_date=start_date, end_date=end_date)
+
+        if trend_output_text is not None:
+            if "錯誤" in trend_output_text:
+                return jsonify({'success': False, 'message': trend_output_text}), 500
+
+            response_data_partial = {
+                'success': True,
+                'message': '帳戶數據趨勢分析完成。',
+                'trend_output_html': markdown.markdown(trend_output_text),
+                'report_params': report_params
+            }
+            plot_data_string = plot_data_string or "{}"
         
         partial_json = json.dumps(response_data_partial)
-        final_json_string = partial_json[:-1] + f', "plot_data": {plotly_data_string}' + '}'
+        plot_key = 'plot_compact' if plot_format == 'compact' else 'plot_data'
+        final_json_string = partial_json[:-1] + f', "{plot_key}": {plot_data_string}' + '}'
         
-        return Response(final_json_string, mimetype='application/json')
+        return compressed_json_response(final_json_string, etag=etag)
 
     except Exception as e:
         error_message = f"分析帳戶數據趨勢失敗: {e}"
@@ -415,14 +691,15 @@ def download_report():
     if not is_authorized_for_user(target_user_id):
         return jsonify({'success': False, 'message': '權限不足'}), 403
 
-    if data_type == 'blood_pressure':
-        csv_file_path = get_user_data_path(target_user_id, filename='blood_pressure.csv')
-    elif data_type == 'blood_sugar':
-        csv_file_path = get_user_data_path(target_user_id, filename='blood_sugar.csv')
-    else:
+    if data_type not in health_analysis.TREND_DATA_TYPES:
         return jsonify({'success': False, 'message': '無效的數據類型'}), 400
 
-    if not os.path.exists(csv_file_path):
+    try:
+        start_date, end_date = get_date_range_params(params)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'無效的日期範圍：{e}'}), 400
+
+    if not health_analysis.has_trend_data(target_user_id, data_type):
         return jsonify({'success': False, 'message': '找不到數據檔案'}), 404
 
     clear_user_data_folder(target_user_id, 'reports')
@@ -431,7 +708,8 @@ def download_report():
     try:
         base_output_dir = get_user_data_path(target_user_id)
         _, pdf_report_rel_static_path, _, pdf_filename = \
-            health_analysis.health_trend_analysis(csv_file_path, base_output_dir, analysis_timestamp_str, time_period, data_type, generate_pdf=True)
+            health_analysis.health_trend_analysis(target_user_id, base_output_dir, analysis_timestamp_str, time_period, data_type, generate_pdf=True,
+                                                  start_date=start_date, end_date=end_date)
 
         if not pdf_report_rel_static_path:
             return jsonify({'success': False, 'message': 'PDF 報告生成失敗'}), 500
@@ -457,14 +735,15 @@ def generate_and_send_report():
     if not recipient_email:
         return jsonify({'success': False, 'message': '請提供收件人電子郵件。'}), 400
 
-    if data_type == 'blood_pressure':
-        csv_file_path = get_user_data_path(target_user_id, filename='blood_pressure.csv')
-    elif data_type == 'blood_sugar':
-        csv_file_path = get_user_data_path(target_user_id, filename='blood_sugar.csv')
-    else:
+    if data_type not in health_analysis.TREND_DATA_TYPES:
         return jsonify({'success': False, 'message': '無效的數據類型。'}), 400
 
-    if not os.path.exists(csv_file_path):
+    try:
+        start_date, end_date = get_date_range_params(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'無效的日期範圍：{e}'}), 400
+
+    if not health_analysis.has_trend_data(target_user_id, data_type):
         return jsonify({'success': False, 'message': '該數據類型無歷史紀錄可供生成報告。'}), 404
 
     clear_user_data_folder(target_user_id, 'reports')
@@ -473,24 +752,15 @@ def generate_and_send_report():
     
     try:
         _, pdf_report_rel_static_path, _, pdf_filename = \
-            health_analysis.health_trend_analysis(csv_file_path, base_output_dir, analysis_timestamp_str, period, data_type, generate_pdf=True)
+            health_analysis.health_trend_analysis(target_user_id, base_output_dir, analysis_timestamp_str, period, data_type, generate_pdf=True,
+                                                  start_date=start_date, end_date=end_date)
         if not pdf_report_rel_static_path:
             return jsonify({'success': False, 'message': '郵寄時 PDF 報告生成失敗'}), 500
     except Exception as e:
         return jsonify({'success': False, 'message': f'郵寄時生成報告失敗: {e}'}), 500
 
     try:
-        report_subject = pdf_filename.replace('.pdf', '')
-        report_body = f"您好，<br><br>這是您在 HealthLLM 系統中為帳戶 {get_user_by_id(target_user_id).name} 生成的健康趨勢報告。<br><br>請查收附件。<br><br>此致，<br>HealthLLM 團隊"
-        abs_pdf_path = os.path.abspath(os.path.join('static', pdf_report_rel_static_path))
-
-        success, message = send_email_with_gmail_api(
-            sender_email="healthllm.team@gmail.com",
-            recipient_email=recipient_email,
-            subject=report_subject,
-            body=report_body,
-            attachment_path=abs_pdf_path
-        )
+        success, message = email_report_pdf(target_user_id, recipient_email, pdf_report_rel_static_path, pdf_filename)
 
         if success:
             return jsonify({'success': True, 'message': message})
@@ -500,6 +770,66 @@ def generate_and_send_report():
         print(f"Error sending report: {e}")
         return jsonify({'success': False, 'message': f'寄送報告時發生錯誤: {e}'}), 500
 
+@app.route('/api/report_jobs', methods=['POST'])
+@login_required
+def submit_report_job():
+    """送出背景報告工作 (kind: 'download' 或 'email')，立即回傳工作 ID；進度以 Socket.IO 'update' 事件推送。"""
+    data = request.get_json() or {}
+    kind = data.get('kind', 'download')
+    target_user_id = str(data.get('user_id') or current_user.id)
+    data_type = data.get('data_type')
+    params = {
+        'user_id': target_user_id,
+        'data_type': data_type,
+        'time_period': data.get('time_period') or data.get('period') or 'all',
+    }
+
+    if kind not in ('download', 'email'):
+        return jsonify({'success': False, 'message': '無效的工作類型'}), 400
+    if not is_authorized_for_user(target_user_id):
+        return jsonify({'success': False, 'message': '權限不足'}), 403
+    if data_type not in health_analysis.TREND_DATA_TYPES:
+        return jsonify({'success': False, 'message': '無效的數據類型'}), 400
+    try:
+        start_date, end_date = get_date_range_params(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': f'無效的日期範圍：{e}'}), 400
+    if start_date or end_date:
+        params.update(start_date=start_date, end_date=end_date)
+    if kind == 'email':
+        if not data.get('email'):
+            return jsonify({'success': False, 'message': '請提供收件人電子郵件。'}), 400
+        params['email'] = data.get('email')
+    if not health_analysis.has_trend_data(target_user_id, data_type):
+        return jsonify({'success': False, 'message': '該數據類型無歷史紀錄可供生成報告。'}), 404
+
+    job, created = report_job_queue.submit(current_user.id, kind, params, run_report_job)
+    return jsonify({'success': True, 'job': job.to_dict(), 'deduplicated': not created}), 202
+
+def get_owned_report_job(job_id):
+    job = report_job_queue.get(job_id)
+    if job is None or job.owner_id != str(current_user.id):
+        return None
+    return job
+
+@app.route('/api/report_jobs/<job_id>', methods=['GET'])
+@login_required
+def get_report_job(job_id):
+    job = get_owned_report_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '找不到此報告工作'}), 404
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+@app.route('/api/report_jobs/<job_id>/file', methods=['GET'])
+@login_required
+def download_report_job_file(job_id):
+    job = get_owned_report_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': '找不到此報告工作'}), 404
+    if job.status != 'done':
+        return jsonify({'success': False, 'message': '報告尚未完成', 'job': job.to_dict()}), 409
+    return send_from_directory('static', job.result['pdf_path'], as_attachment=True, download_name=job.result['pdf_filename'])
+
 # --- RAG Chat Routes ---
 @app.route('/rag_submit', methods=['POST'])
 @login_required
@@ -632,8 +962,7 @@ def gmail_callback():
     try:
         flow = get_gmail_auth_flow()
         flow.fetch_token(authorization_response=request.url)
-        with open(TOKEN_FILE, 'wb') as token_file:
-            pickle.dump(flow.credentials, token_file)
+        get_gmail_client().save_credentials(flow.credentials)
         return '✅ Gmail 授權成功！<a href="/">回到首頁</a>'
     except Exception as e:
         return f"❌ 授權流程錯誤: {e}", 500
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import health_analysis
+import plot_export
+from auth import load_user_settings
+from constants.default_settings import default
+
+# 夜間批次報告：逐一走訪使用者資料夾，為每位使用者產生血壓與血糖的週報告。
+# 分析、圖片輸出與 PDF 轉檔都在程序池中進行，數據自上次執行後沒有變動的使用者直接略過。
+BATCH_REPORT_WORKERS = int(os.getenv('BATCH_REPORT_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))
+BATCH_REPORT_PERIOD = os.getenv('BATCH_REPORT_PERIOD', '7days')
+BATCH_REPORT_DIR = os.getenv('BATCH_REPORT_DIR', os.path.join('instance', 'batch_reports'))
+BATCH_REPORT_DATA_TYPES = ('blood_pressure', 'blood_sugar')
+# 報告存放於 static/users/<user_id>/scheduled_reports/reports/
+SCHEDULED_REPORTS_SUBFOLDER = 'scheduled_reports'
+
+def _state_path(report_dir):
+    return os.path.join(report_dir, 'state.json')
+
+def load_batch_state(report_dir=BATCH_REPORT_DIR):
+    try:
+        with open(_state_path(report_dir), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _write_json(path, payload):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def is_report_enabled(user_id):
+    return load_user_settings(user_id).get('email_report_enabled', default('email_report_enabled'))
+
+def _init_worker():
+    # 每個子程序各自啟動常駐的圖片輸出程序，之後的報告不必再冷啟動 Chrome
+    plot_export.get_plot_exporter().start()
+
+def generate_scheduled_report(user_id, data_type, period, output_dir, timestamp):
+    """在子程序中產生單份報告，回傳結果與各階段耗時。"""
+    timings = {}
+    text, pdf_rel_path, _, pdf_filename = health_analysis.health_trend_analysis(
+        user_id, output_dir, timestamp, period, data_type, generate_pdf=True, timings=timings
+    )
+    return {
+        'pdf_path': pdf_rel_path,
+        'pdf_filename': pdf_filename,
+        'error': None if pdf_rel_path else text,
+        'timings': {stage: round(seconds, 3) for stage, seconds in timings.items()},
+    }
+
+def _summarize_timings(results):
+    stages = {}
+    for result in results:
+        for stage, seconds in (result.get('timings') or {}).items():
+            entry = stages.setdefault(stage, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            entry['count'] += 1
+            entry['total_seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+    for entry in stages.values():
+        entry['avg_seconds'] = round(entry['total_seconds'] / entry['count'], 3)
+        entry['total_seconds'] = round(entry['total_seconds'], 3)
+    return stages
+
+def run_batch_reports(user_ids, users_dir, period=BATCH_REPORT_PERIOD, workers=BATCH_REPORT_WORKERS,
+                      report_dir=BATCH_REPORT_DIR, force=False, enabled_only=False,
+                      data_types=BATCH_REPORT_DATA_TYPES):
+    """為 user_ids 產生報告並寫出執行摘要，回傳摘要 dict。
+    data_types 為 ('combined',) 時每位使用者只產生一份綜合報告 (一次 AI 分析與一次 PDF 轉檔)。
+
+    每位使用者每種數據以報告區間 (已換算成起訖日期) 內數據內容的雜湊作為版本；與上次成功產生時相同且報告檔仍在時略過。
+    區間隨日期移動，因此即使沒有新紀錄，報告涵蓋的日子改變後也會重新產生。"""
+    run_started = time.perf_counter()
+    started_at = datetime.now()
+    timestamp = started_at.strftime("%Y%m%d_%H%M%S")
+    state = load_batch_state(report_dir)
+
+    results = []
+    pending = []
+    for user_id in user_ids:
+        if enabled_only and not is_report_enabled(user_id):
+            continue
+        for data_type in data_types:
+            if not health_analysis.has_trend_data(user_id, data_type):
+                continue
+            state_key = f"{user_id}/{data_type}"
+            version = f"{period}:{health_analysis.get_trend_data_version(user_id, data_type, period)}"
+            previous = state.get(state_key) or {}
+            if not force and previous.get('version') == version and previous.get('pdf_path') \
+                    and os.path.exists(os.path.join('static', previous['pdf_path'])):
+                results.append({'user_id': user_id, 'data_type': data_type, 'status': 'skipped',
+                                'pdf_path': previous['pdf_path']})
+                continue
+            output_dir = os.path.join(users_dir, user_id, SCHEDULED_REPORTS_SUBFOLDER)
+            pending.append((user_id, data_type, state_key, version, output_dir))
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max(1, workers), initializer=_init_worker) as pool:
+            futures = {
+                pool.submit(generate_scheduled_report, user_id, data_type, period, output_dir, timestamp):
+                    (user_id, data_type, state_key, version)
+                for user_id, data_type, state_key, version, output_dir in pending
+            }
+            for future in as_completed(futures):
+                user_id, data_type, state_key, version = futures[future]
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    outcome = {'error': f"{type(e).__name__}: {e}", 'timings': {}}
+                status = 'failed' if outcome['error'] else 'generated'
+                results.append(dict(outcome, user_id=user_id, data_type=data_type, status=status))
+                if status == 'generated':
+                    state[state_key] = {'version': version, 'pdf_path': outcome['pdf_path'],
+                                        'generated_at': datetime.now().isoformat(timespec='seconds')}
+                    print(f"{user_id} / {data_type}: 報告已產生 ({outcome['timings'].get('total', 0):.1f} 秒)")
+                else:
+                    print(f"{user_id} / {data_type}: 報告產生失敗: {outcome['error']}")
+
+    _write_json(_state_path(report_dir), state)
+    results.sort(key=lambda r: (r['user_id'], r['data_type']))
+    summary = {
+        'started_at': started_at.isoformat(timespec='seconds'),
+        'period': period,
+        'workers': workers,
+        'wall_seconds': round(time.perf_counter() - run_started, 3),
+        'counts': {status: sum(1 for r in results if r['status'] == status)
+                   for status in ('generated', 'skipped', 'failed')},
+        'stages': _summarize_timings(results),
+        'reports': results,
+    }
+    summary_path = os.path.join(report_dir, f"run_{started_at.strftime('%Y%m%d_%H%M%S_%f')}.json")
+    _write_json(summary_path, summary)
+    summary['summary_path'] = summary_path
+    return summary
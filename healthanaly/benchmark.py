@@ -0,0 +1,373 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pdfkit
+
+import health_storage
+import health_analysis
+import plot_export
+import model_providers
+from health_write_queue import HealthWriteQueue, attach_status_codes
+
+# 分析流程的效能基準：以合成的健康紀錄 (1 天至 20 年、每天早/午/晚三次) 量測各階段的耗時、
+# Python 記憶體峰值與輸出大小，結果寫成 JSON，可與上一個版本的結果比較以找出效能退化。
+BENCHMARK_FORMAT = 'healthllm-benchmark-v1'
+BENCHMARK_SIZES = (1, 7, 30, 365, 5 * 365, 20 * 365)
+BENCHMARK_REPEATS = int(os.getenv('BENCHMARK_REPEATS', '3'))
+BENCHMARK_SAVE_WRITES = 20
+BENCHMARK_OUTPUT_DIR = os.getenv('BENCHMARK_OUTPUT_DIR', os.path.join('instance', 'benchmarks'))
+# 與基準結果比較時，耗時超過此倍數即視為退化
+BENCHMARK_REGRESSION_RATIO = float(os.getenv('BENCHMARK_REGRESSION_RATIO', '1.25'))
+# 太短的階段誤差大，低於此秒數的變化不列為退化
+BENCHMARK_MIN_SECONDS = 0.005
+BENCHMARK_USER_ID = 'benchmark_user'
+BENCHMARK_DATA_TYPES = ('blood_pressure', 'blood_sugar')
+# 批次 PDF 吞吐量量測的報告份數 (0 代表不量測)
+BENCHMARK_PDF_BATCH = int(os.getenv('BENCHMARK_PDF_BATCH', '8'))
+
+def generate_synthetic_history(days, data_type, seed=0, end_date=None):
+    """產生 days 天的寬格式紀錄，含緩慢漂移、週期變化與雜訊。
+
+    缺漏模擬實際使用情形：每個時段約 12% 隨機漏記，中午最常漏記，另有數次連續多天 (出遊、住院) 完全沒有紀錄。"""
+    rng = np.random.default_rng(seed + (0 if data_type == 'blood_pressure' else 1))
+    end_date = end_date or datetime(2025, 1, 1).date()
+    dates = pd.date_range(end=end_date, periods=days, freq='D')
+    t = np.arange(days, dtype=float)
+    drift = np.cumsum(rng.normal(0, 0.15, days))
+    weekly = 2.0 * np.sin(2 * np.pi * t / 7)
+
+    present = np.ones(days, dtype=bool)
+    for _ in range(days // 120):
+        start = rng.integers(0, days)
+        present[start:start + rng.integers(3, 15)] = False
+    skip_rate = {'Morning': 0.08, 'Noon': 0.2, 'Evening': 0.1}
+
+    def series(base, spread, slot_offset, low, high):
+        values = base + slot_offset + drift * spread / 10 + weekly + rng.normal(0, spread, days)
+        return np.clip(np.round(values), low, high)
+
+    df = pd.DataFrame({'Date': dates.strftime('%Y-%m-%d')})
+    slot_offsets = {'Morning': 0.0, 'Noon': -3.0, 'Evening': 4.0}
+    for slot, offset in slot_offsets.items():
+        slot_present = present & (rng.random(days) >= skip_rate[slot])
+        # 最後一天一定有紀錄，任何長度的歷史都有可分析的數據
+        slot_present[-1] = True
+        if data_type == 'blood_pressure':
+            columns = {
+                'Systolic': series(128, 12, offset, 80, 220),
+                'Diastolic': series(82, 8, offset / 2, 45, 130),
+                'Pulse': series(74, 7, -offset, 40, 150),
+            }
+        else:
+            columns = {
+                'Fasting': series(105, 14, offset, 55, 260),
+                'Postprandial': series(150, 25, offset * 2, 70, 350),
+            }
+        for metric, values in columns.items():
+            df[f'{slot}_{metric}'] = np.where(slot_present, values, np.nan)
+
+    value_cols = df.columns[1:]
+    return df[df[value_cols].notna().any(axis=1)].reset_index(drop=True)
+
+@contextmanager
+def fake_model_provider(latency_seconds=0.0):
+    """以本機替身模型代替 Gemini，不連網；latency_seconds 為每次呼叫的模擬延遲。"""
+    previous = model_providers.set_model_provider(model_providers.FakeModelProvider(latency_seconds, failure_rate=0))
+    try:
+        yield
+    finally:
+        model_providers.set_model_provider(previous)
+
+@contextmanager
+def benchmark_workspace():
+    """在暫存目錄中執行，使用者資料、快取與報告都不會寫進實際的 static/ 與 instance/。"""
+    original_cwd = os.getcwd()
+    workspace = tempfile.mkdtemp(prefix='healthllm_bench_')
+    os.chdir(workspace)
+    try:
+        yield workspace
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+def _measure(fn, repeats):
+    """執行 repeats 次量測耗時，另以 tracemalloc 執行一次取得記憶體峰值 (追蹤本身會拖慢速度，因此分開量測)。
+    回傳 (最後一次的結果, 量測 dict)。子程序 (Kaleido、wkhtmltopdf) 的記憶體不在統計範圍內。"""
+    durations = []
+    result = None
+    for _ in range(max(1, repeats)):
+        started = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {
+        'wall_seconds_min': round(min(durations), 6),
+        'wall_seconds_median': round(statistics.median(durations), 6),
+        'peak_bytes': peak,
+    }
+
+def _disk_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def benchmark_history(days, data_type, repeats=BENCHMARK_REPEATS, seed=0):
+    """量測單一歷史長度與數據類型的各階段，回傳 {days, data_type, rows, readings, stages}。"""
+    store = health_storage.get_health_store()
+    user_id = f"{BENCHMARK_USER_ID}_{data_type}_{days}"
+    history = generate_synthetic_history(days, data_type, seed=seed)
+    store.bulk_upsert(user_id, attach_status_codes(store, user_id, data_type, history), data_type)
+    stages = {}
+
+    # save_health_data_to_csv 的實際路徑：寫入佇列合併後以使用者鎖寫入並更新彙總；每次量測一筆新日期的寫入
+    write_queue = HealthWriteQueue(window_seconds=3600)
+    value_cols = health_storage.get_health_columns(data_type)[1:]
+    sample = history.iloc[-1][value_cols].dropna().to_dict()
+    last_date = datetime.strptime(history['Date'].iloc[-1], '%Y-%m-%d').date()
+    write_durations = []
+    for offset in range(1, BENCHMARK_SAVE_WRITES + 1):
+        started = time.perf_counter()
+        future = write_queue.submit(user_id, (last_date + timedelta(days=offset)).isoformat(), sample, data_type)
+        write_queue.flush(user_id)
+        future.result()
+        write_durations.append(time.perf_counter() - started)
+    csv_path = health_storage.get_health_csv_path(user_id, data_type)
+    stages['save_health_data'] = {
+        'wall_seconds_min': round(min(write_durations), 6),
+        'wall_seconds_median': round(statistics.median(write_durations), 6),
+        'peak_bytes': None,
+        'output_bytes': _disk_bytes([csv_path, health_storage.get_log_path(csv_path)]),
+        'writes': BENCHMARK_SAVE_WRITES,
+    }
+
+    # 儲存層有 DataFrame 快取，重複量測得到的是一般情況下命中快取的讀取
+    df_loaded, stages['load'] = _measure(lambda: store.load(user_id, data_type), repeats)
+    stages['load']['output_rows'] = len(df_loaded)
+
+    # 依實際流程：數值欄位轉型後篩選、轉長格式、取樣後繪圖
+    df_numeric = df_loaded.copy()
+    for col in value_cols:
+        df_numeric[col] = pd.to_numeric(df_numeric[col], errors='coerce')
+    df_filtered, stages['filter_data_by_period'] = _measure(
+        lambda: health_analysis.filter_data_by_period(df_numeric, 'all'), repeats)
+    stages['filter_data_by_period']['output_rows'] = len(df_filtered)
+
+    df_reshaped, stages['reshape_for_plotting'] = _measure(
+        lambda: health_analysis.reshape_for_plotting(df_filtered, data_type), repeats)
+    stages['reshape_for_plotting']['output_rows'] = len(df_reshaped)
+
+    title = health_analysis.TREND_REPORT_TITLES[data_type]
+    df_plot = health_analysis.downsample_for_plotting(df_reshaped)
+    plot_json, stages['generate_plotly_data'] = _measure(
+        lambda: health_analysis.generate_plotly_data(df_plot, data_type, title), repeats)
+    stages['generate_plotly_data']['output_bytes'] = len(plot_json.encode('utf-8'))
+    stages['generate_plotly_data']['plotted_points'] = len(df_plot)
+
+    fig = health_analysis.build_plotly_figure(df_plot, data_type, title)
+    png_base64, stages['generate_plot_base64_with_plotly'] = _measure(
+        lambda: health_analysis.generate_plot_base64_with_plotly(fig, plot_json), repeats)
+    if png_base64:
+        stages['generate_plot_base64_with_plotly']['output_bytes'] = len(png_base64) * 3 // 4
+    else:
+        stages['generate_plot_base64_with_plotly'] = {'skipped': '無法輸出圖片 (Chrome / Kaleido 不可用)'}
+
+    if health_analysis.config:
+        table_df = health_analysis.add_status_label_columns(df_filtered[['Date'] + value_cols], df_filtered, data_type)
+        table_df['Date'] = table_df['Date'].dt.strftime('%Y-%m-%d')
+        output_dir = os.path.join('static', 'users', user_id)
+        pdf_result, stages['generate_trend_report_pdf'] = _measure(
+            lambda: health_analysis.generate_trend_report_pdf(
+                base_output_dir=output_dir, request_timestamp_str='benchmark', report_title=title,
+                time_period_label=health_analysis.get_period_label('all'), time_period_key='all',
+                data_table_df=table_df, trend_plot_base64_data=png_base64 or '',
+                trend_analysis_text=model_providers.fake_text('', 0), data_type_for_filename=data_type
+            ), repeats)
+        stages['generate_trend_report_pdf']['output_bytes'] = _disk_bytes([os.path.join('static', pdf_result[0])])
+    else:
+        stages['generate_trend_report_pdf'] = {'skipped': '未設定 wkhtmltopdf (WKHTMLTOPDF_PATH)'}
+
+    # 整體流程 (Gemini 以替身模型代替)；每次執行前清除分析快取，量到的是未命中快取的路徑
+    def run_pipeline():
+        shutil.rmtree(health_analysis.gemini_cache.GEMINI_CACHE_DIR, ignore_errors=True)
+        timings = {}
+        health_analysis.health_trend_analysis(
+            user_id, os.path.join('static', 'users', user_id), 'benchmark', 'all', data_type,
+            generate_pdf=True, timings=timings
+        )
+        return timings
+    pipeline_timings, stages['health_trend_analysis'] = _measure(run_pipeline, repeats)
+    stages['health_trend_analysis']['stage_seconds'] = {
+        stage: round(seconds, 6) for stage, seconds in pipeline_timings.items()
+    }
+
+    return {
+        'days': days,
+        'data_type': data_type,
+        'rows': len(history),
+        'readings': int(history[value_cols].notna().sum().sum()),
+        'stages': stages,
+    }
+
+def benchmark_pdf_throughput(reports=BENCHMARK_PDF_BATCH, days=30, seed=0):
+    """量測批次轉檔的吞吐量 (份/秒)，比較兩種作法轉出 reports 份相同的 30 天報告：
+    sequential 為原本逐份呼叫 pdfkit.from_string (啟用 JavaScript)；service 為同時送進 PdfRenderService，
+    由 PDF_RENDER_CONCURRENCY 限制同時執行的 wkhtmltopdf 數。需要 wkhtmltopdf。"""
+    service = health_analysis.pdf_render_service
+    if not (health_analysis.config and service):
+        return {'skipped': '未設定 wkhtmltopdf (WKHTMLTOPDF_PATH)'}
+    if reports <= 0:
+        return {'skipped': '未啟用 (BENCHMARK_PDF_BATCH=0)'}
+
+    data_type = 'blood_pressure'
+    history = generate_synthetic_history(days, data_type, seed=seed)
+    history['Date'] = pd.to_datetime(history['Date'])
+    value_cols = health_storage.get_health_columns(data_type)[1:]
+    table_df = health_analysis.add_status_label_columns(history[['Date'] + value_cols], history, data_type)
+    table_df['Date'] = table_df['Date'].dt.strftime('%Y-%m-%d')
+    html = health_analysis.PDF_TEMPLATE.render(
+        report_title=health_analysis.TREND_REPORT_TITLES[data_type],
+        time_period_label=health_analysis.get_period_label('30days'),
+        data_table_html=table_df.fillna('').to_html(index=False, border=0, classes="dataframe"),
+        trend_plot_html_tag='',
+        trend_analysis_text=model_providers.fake_text('', 0),
+        generation_timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    )
+    output_dir = os.path.abspath(os.path.join('static', 'pdf_throughput'))
+    os.makedirs(output_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    for i in range(reports):
+        pdfkit.from_string(html, os.path.join(output_dir, f"sequential_{i}.pdf"),
+                           configuration=health_analysis.config, options={'enable-local-file-access': ''})
+    sequential_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=reports) as pool:
+        list(pool.map(lambda i: service.render(html, os.path.join(output_dir, f"service_{i}.pdf")), range(reports)))
+    service_seconds = time.perf_counter() - started
+
+    return {
+        'reports': reports,
+        'concurrency': service.concurrency,
+        'sequential_seconds': round(sequential_seconds, 3),
+        'service_seconds': round(service_seconds, 3),
+        'sequential_reports_per_second': round(reports / sequential_seconds, 2),
+        'service_reports_per_second': round(reports / service_seconds, 2),
+        'speedup': round(sequential_seconds / service_seconds, 2),
+    }
+
+def _environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    import plotly
+    return {
+        'git_commit': commit,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'plotly': plotly.__version__,
+        'storage_backend': health_storage.HEALTH_STORAGE_BACKEND,
+        'pdf_engine': bool(health_analysis.config),
+    }
+
+def run_benchmarks(sizes=BENCHMARK_SIZES, data_types=BENCHMARK_DATA_TYPES, repeats=BENCHMARK_REPEATS,
+                   model_latency=0.0, seed=0, output_path=None):
+    """在暫存工作目錄中對每個 (歷史天數, 數據類型) 執行基準量測，將結果寫入 output_path 並回傳結果 dict。"""
+    output_path = os.path.abspath(output_path or os.path.join(
+        BENCHMARK_OUTPUT_DIR, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"))
+    report = {
+        'format': BENCHMARK_FORMAT,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'environment': _environment(),
+        'config': {'sizes': list(sizes), 'data_types': list(data_types), 'repeats': repeats,
+                   'model_latency_seconds': model_latency, 'seed': seed, 'save_writes': BENCHMARK_SAVE_WRITES},
+        'results': [],
+    }
+    # 關閉圖片快取，每次量測都實際輸出 PNG
+    exporter = plot_export.get_plot_exporter()
+    original_cache_bytes, exporter.max_cache_bytes = exporter.max_cache_bytes, 0
+    exporter_stats_before = exporter.stats()
+    try:
+        with benchmark_workspace(), fake_model_provider(model_latency):
+            for days in sizes:
+                for data_type in data_types:
+                    print(f"量測 {days} 天的{health_analysis.TREND_TYPE_NAMES[data_type]}數據...")
+                    report['results'].append(benchmark_history(days, data_type, repeats=repeats, seed=seed))
+            print("量測批次 PDF 轉檔吞吐量...")
+            report['pdf_throughput'] = benchmark_pdf_throughput(seed=seed)
+    finally:
+        exporter.max_cache_bytes = original_cache_bytes
+    exporter_stats = exporter.stats()
+    report['plot_image_cache'] = {
+        'hits': exporter_stats['hits'] - exporter_stats_before['hits'],
+        'misses': exporter_stats['misses'] - exporter_stats_before['misses'],
+    }
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    report['output_path'] = output_path
+    return report
+
+def compare_benchmarks(baseline, current, ratio=BENCHMARK_REGRESSION_RATIO):
+    """比較兩份結果中相同 (天數, 數據類型, 階段) 的中位數耗時，回傳耗時倍數超過 ratio 的項目列表。"""
+    baseline_stages = {
+        (entry['days'], entry['data_type'], stage): metrics
+        for entry in baseline.get('results', []) for stage, metrics in entry['stages'].items()
+    }
+    regressions = []
+    for entry in current.get('results', []):
+        for stage, metrics in entry['stages'].items():
+            before = baseline_stages.get((entry['days'], entry['data_type'], stage)) or {}
+            old, new = before.get('wall_seconds_median'), metrics.get('wall_seconds_median')
+            if not old or new is None or new - old < BENCHMARK_MIN_SECONDS:
+                continue
+            if new / old > ratio:
+                regressions.append({
+                    'days': entry['days'], 'data_type': entry['data_type'], 'stage': stage,
+                    'baseline_seconds': old, 'current_seconds': new, 'ratio': round(new / old, 2),
+                })
+    return regressions
+
+def format_report(report):
+    """每個量測組合一行的文字摘要。"""
+    lines = []
+    for entry in report['results']:
+        parts = []
+        for stage, metrics in entry['stages'].items():
+            if 'skipped' in metrics:
+                parts.append(f"{stage}=略過")
+            else:
+                parts.append(f"{stage}={metrics['wall_seconds_median'] * 1000:.1f}ms")
+        lines.append(f"{entry['days']:>5} 天 {entry['data_type']:<14} ({entry['readings']} 筆): " + ", ".join(parts))
+    throughput = report.get('pdf_throughput')
+    if throughput and 'skipped' in throughput:
+        lines.append(f"批次 PDF 吞吐量: 略過 ({throughput['skipped']})")
+    elif throughput:
+        lines.append(
+            f"批次 PDF 吞吐量 ({throughput['reports']} 份): 逐份 {throughput['sequential_reports_per_second']} 份/秒，"
+            f"轉檔服務 {throughput['service_reports_per_second']} 份/秒 (同時 {throughput['concurrency']} 個，"
+            f"{throughput['speedup']} 倍)"
+        )
+    return "\n".join(lines)
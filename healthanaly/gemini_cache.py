@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# Gemini 分析結果的磁碟快取。鍵為 (提示詞版本, 模型, 數據類型, 時間範圍, 送出的數據內容) 的雜湊，
+# 因此區間內新增或修改任何一筆讀數都會得到新的鍵，舊結果不會再被取用，最後由 TTL / LRU 清除。
+GEMINI_CACHE_DIR = os.getenv('GEMINI_CACHE_DIR', os.path.join('instance', 'gemini_cache'))
+GEMINI_CACHE_TTL_SECONDS = float(os.getenv('GEMINI_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+GEMINI_CACHE_MAX_ENTRIES = int(os.getenv('GEMINI_CACHE_MAX_ENTRIES', '2000'))
+
+def make_cache_key(prompt_version, model_name, data_type, period, data_text):
+    payload = json.dumps([prompt_version, model_name, data_type, period, data_text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class GeminiResultCache:
+    """以檔案儲存的內容定址快取。檔案的 mtime 記錄最後使用時間，超過上限時淘汰最久未使用者。"""
+
+    def __init__(self, cache_dir=GEMINI_CACHE_DIR, ttl_seconds=GEMINI_CACHE_TTL_SECONDS, max_entries=GEMINI_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._entry_count = None
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _iter_entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        for sub in os.listdir(self.cache_dir):
+            sub_dir = os.path.join(self.cache_dir, sub)
+            if not os.path.isdir(sub_dir):
+                continue
+            for name in os.listdir(sub_dir):
+                if name.endswith('.json'):
+                    yield os.path.join(sub_dir, name)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        if time.time() - entry.get('created', 0) > self.ttl_seconds:
+            self._remove(path)
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return entry.get('text')
+
+    def put(self, key, text, **meta):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        existed = os.path.exists(path)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(meta, created=time.time(), text=text), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._entry_count is None:
+                self._entry_count = sum(1 for _ in self._iter_entries())
+            elif not existed:
+                self._entry_count += 1
+            needs_eviction = self._entry_count > self.max_entries
+        if needs_eviction:
+            self.evict()
+
+    def get_or_compute(self, key, compute, **meta):
+        """命中時直接回傳；否則呼叫 compute()。同一個鍵同時只會有一個執行緒呼叫模型。
+
+        compute 回傳 (文字, 是否可快取)，錯誤訊息等不應快取的結果會直接回傳。"""
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            try:
+                cached = self.get(key)
+                if cached is not None:
+                    return cached
+                text, cacheable = compute()
+                if cacheable:
+                    try:
+                        self.put(key, text, **meta)
+                    except OSError as e:
+                        print(f"寫入 Gemini 快取失敗: {e}")
+                return text
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if self._entry_count:
+                self._entry_count -= 1
+
+    def evict(self):
+        """刪除過期的項目，若仍超過上限，再依最後使用時間刪到上限的九成。"""
+        now = time.time()
+        entries = []
+        for path in self._iter_entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # 超過 TTL 未被使用者必定已過期；近期用過但建立已久的項目則由 get() 判斷
+            if now - stat.st_mtime > self.ttl_seconds:
+                os.remove(path)
+                continue
+            entries.append((stat.st_mtime, path))
+        entries.sort()
+        excess = len(entries) - int(self.max_entries * 0.9) if len(entries) > self.max_entries else 0
+        for _, path in entries[:excess]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._entry_count = len(entries) - excess
+        return excess
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': self._entry_count,
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+            }
+
+_cache = GeminiResultCache()
+
+def get_gemini_cache():
+    return _cache
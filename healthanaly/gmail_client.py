@@ -0,0 +1,131 @@
+import os
+import pickle
+import threading
+from datetime import datetime, timedelta, timezone
+
+import httplib2
+import google_auth_httplib2
+from google.auth.transport.requests import Request as GoogleRequest
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+
+SCOPES = ['https://www.googleapis.com/auth/gmail.send']
+CREDENTIALS_FILE = "gmail_credential.json"
+TOKEN_FILE = "token.pickle"
+# 存取權杖在到期前多少秒就先更新，避免寄信途中才過期
+GMAIL_TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv('GMAIL_TOKEN_REFRESH_MARGIN_SECONDS', '300'))
+
+class GmailAuthError(RuntimeError):
+    pass
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+class GmailClient:
+    """整個程序共用的 Gmail 用戶端。
+
+    - 憑證只從 token.pickle 讀取一次；檔案被其他程序或授權流程更新時才重新讀取
+    - Gmail service 只建立一次；httplib2 不是執行緒安全的，因此每個執行緒各自使用一個 AuthorizedHttp
+    - 權杖在到期前 refresh_margin_seconds 秒內於鎖中先行更新，更新後的權杖先寫入暫存檔再原子性地替換"""
+
+    def __init__(self, token_file=TOKEN_FILE, credentials_file=CREDENTIALS_FILE, scopes=SCOPES,
+                 refresh_margin_seconds=GMAIL_TOKEN_REFRESH_MARGIN_SECONDS):
+        self.token_file = token_file
+        self.credentials_file = credentials_file
+        self.scopes = scopes
+        self.refresh_margin = timedelta(seconds=refresh_margin_seconds)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._creds = None
+        self._token_signature = None
+        self._service = None
+        self.refreshes = 0
+
+    def _load_token(self):
+        try:
+            with open(self.token_file, 'rb') as token:
+                return pickle.load(token)
+        except FileNotFoundError:
+            return None
+        except (EOFError, pickle.PickleError) as e:
+            print(f"Error loading {self.token_file}: {e}. Re-authenticating...")
+            os.remove(self.token_file)
+            return None
+
+    def _persist(self, creds):
+        tmp_path = f"{self.token_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as token:
+            pickle.dump(creds, token)
+        os.replace(tmp_path, self.token_file)
+        self._token_signature = _file_signature(self.token_file)
+
+    def _needs_refresh(self, creds):
+        if not creds.valid:
+            return True
+        # google-auth 的 expiry 為不含時區的 UTC 時間
+        expiry = creds.expiry
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return expiry is not None and expiry - now <= self.refresh_margin
+
+    def _set_credentials(self, creds):
+        if creds is not self._creds:
+            self._creds = creds
+            self._service = None
+            self._local = threading.local()
+
+    def _current_credentials(self):
+        """在鎖中呼叫：回傳可用的憑證，必要時重新讀取、更新或進行授權。"""
+        signature = _file_signature(self.token_file)
+        if self._creds is None or signature != self._token_signature:
+            self._token_signature = signature
+            self._set_credentials(self._load_token())
+
+        creds = self._creds
+        if creds and creds.refresh_token and self._needs_refresh(creds):
+            creds.refresh(GoogleRequest())
+            self.refreshes += 1
+            self._persist(creds)
+        elif not creds or not creds.valid:
+            if not os.path.exists(self.credentials_file):
+                raise GmailAuthError(f"credentials.json not found at {self.credentials_file}.")
+            flow = InstalledAppFlow.from_client_secrets_file(self.credentials_file, self.scopes)
+            creds = flow.run_local_server(port=0)
+            self._persist(creds)
+            self._set_credentials(creds)
+        return creds
+
+    def _acquire(self):
+        with self._lock:
+            creds = self._current_credentials()
+            if self._service is None:
+                self._service = build('gmail', 'v1', credentials=creds)
+            service, local = self._service, self._local
+        http = getattr(local, 'http', None)
+        if http is None:
+            http = local.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        return service, http
+
+    def send(self, message_body):
+        """以 users.messages.send 寄出 {'raw': ...}，回傳 API 的回應。"""
+        service, http = self._acquire()
+        return service.users().messages().send(userId="me", body=message_body).execute(http=http)
+
+    def save_credentials(self, creds):
+        """授權流程取得新憑證時呼叫，原子性地寫入 token 檔並立即生效。"""
+        with self._lock:
+            self._persist(creds)
+            self._set_credentials(creds)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_gmail_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GmailClient()
+        return _client
@@ -1,8 +1,7 @@
 import os
 import pandas as pd
-import google.generativeai as genai
 import pdfkit
-from jinja2 import Template
+from jinja2 import Environment
 from dotenv import load_dotenv
 import numpy as np
 from datetime import datetime, timedelta
@@ -11,6 +10,9 @@ import base64
 import markdown
 import re 
 import json
+import hashlib
+import time
+import warnings
 
 # 導入 Plotly Express 和 Graph Objects
 import plotly.express as px
@@ -18,6 +20,13 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots # Import for dual y-axis
 import plotly.io as pio
 
+import health_storage
+import gemini_cache
+from pdf_renderer import PdfRenderService
+import plot_export
+import stage_graph
+import model_providers
+
 # 設定 Plotly 預設主題
 pio.templates.default = "plotly_white"
 
@@ -25,22 +34,26 @@ pio.templates.default = "plotly_white"
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
 gemini_model = os.getenv("GEMINI_DEFAULT_MODEL", "gemini-1.5-flash")
-if api_key:
-    genai.configure(api_key=api_key)
-else:
+if not model_providers.get_model_provider().configured:
     print("警告：未找到 GEMINI_API_KEY。AI 生成功能將會失敗。")
 
 # 設定 wkhtmltopdf 路徑
 WKHTMLTOPDF_PATH = os.getenv("WKHTMLTOPDF_PATH")
 config = None
+pdf_render_service = None
 if WKHTMLTOPDF_PATH and os.path.exists(WKHTMLTOPDF_PATH):
     config = pdfkit.configuration(wkhtmltopdf=WKHTMLTOPDF_PATH)
+    pdf_render_service = PdfRenderService(config)
 else:
     print("警告：未設定 WKHTMLTOPDF_PATH 或執行檔不存在。PDF 生成功能將會失敗。")
+# 未產生 PDF 時附加在分析文字最後一行的說明開頭，之後接著跳過的原因
+PDF_SKIPPED_NOTE_PREFIX = "(PDF報告生成已跳過"
 
 # --- 提示詞 (Prompts) ---
+# 修改 trend_prompt 或送給模型的數據格式時請遞增版本，讓快取中的舊分析結果失效
+TREND_PROMPT_VERSION = 2
 trend_prompt = """
-你是一位專業的健康數據分析師。請根據以下提供的健康數據紀錄（已根據用戶選擇的時間區間篩選），分析數據中是否存在任何顯著的異常趨勢（例如，指標持續升高、持續降低、波動過於劇烈、頻繁超出正常範圍等）。
+你是一位專業的健康數據分析師。請根據以下提供的健康數據統計摘要與近期原始紀錄（已根據用戶選擇的時間區間篩選），分析數據中是否存在任何顯著的異常趨勢（例如，指標持續升高、持續降低、波動過於劇烈、頻繁超出正常範圍等）。
 請提供簡短的觀察結果和針對這些趨勢的初步建議。
 
 請嚴格按照以下格式輸出，使用 Markdown 語法：
@@ -52,6 +65,11 @@ trend_prompt = """
   - [提供第三條具體建議，例如：若血壓持續升高或出現不適，請務必諮詢醫療專業人員，切勿自行調整藥物。]
 """
 
+# 依數據類型附加在 trend_prompt 之後的說明
+TREND_PROMPT_NOTES = {
+    'combined': "\n本次數據同時包含血壓與血糖，請另外觀察兩者之間的關聯（例如同一段時間內是否一起升高），並在建議中一併考量。\n",
+}
+
 # --- PDF 報告的 HTML 模板 ---
 PDF_REPORT_TEMPLATE = """
 <html>
@@ -114,8 +132,22 @@ PDF_REPORT_TEMPLATE = """
 def markdown_to_html_filter(text):
     return markdown.markdown(text)
 
+# 模板只在載入模組時編譯一次
+_pdf_template_env = Environment()
+_pdf_template_env.filters['markdown_to_html'] = markdown_to_html_filter
+PDF_TEMPLATE = _pdf_template_env.from_string(PDF_REPORT_TEMPLATE)
+
 # --- 核心分析函式 ---
 
+# 各指標單筆數值的正常範圍 (含上下限，數值先取整數)，與 analyze_blood_pressure / analyze_blood_sugar 的判斷門檻一致
+NORMAL_RANGES = {
+    'Systolic': (90, 119),
+    'Diastolic': (60, 79),
+    'Pulse': (60, 100),
+    'Fasting': (70, 99),
+    'Postprandial': (70, 139),
+}
+
 def analyze_blood_pressure(systolic, diastolic, pulse=None):
     if not (isinstance(systolic, (int, float)) and isinstance(diastolic, (int, float))):
         return "血壓輸入無效", "請輸入有效的數字作為血壓值。", ""
@@ -200,89 +232,632 @@ def analyze_blood_sugar(value, measurement_type="fasting"):
         return "未知的血糖測量類型", "請指定 'fasting' (空腹) 或 'postprandial' (餐後)。", ""
     return status, advice, normal_range_info
 
-def filter_data_by_period(df: pd.DataFrame, period: str) -> pd.DataFrame:
-    if 'Date' not in df.columns:
-        raise ValueError("DataFrame 必須包含 'Date' 欄位。")
-    df_filtered = df.copy()
-    try:
-        df_filtered['Date'] = pd.to_datetime(df_filtered['Date'], errors='coerce')
-        df_filtered = df_filtered.dropna(subset=['Date'])
-    except Exception as e:
-        raise ValueError(f"轉換 'Date' 欄位為日期格式時出錯: {e}")
-    if df_filtered.empty:
-        return df_filtered
-    df_filtered = df_filtered.sort_values(by="Date", ascending=True)
+# --- 批次 (向量化) 分類 ---
+# 狀態代碼：0 代表缺值或無效輸入；判斷門檻與上方的 analyze_blood_pressure / analyze_blood_sugar 完全相同
+BP_STATUS_TABLE = {
+    0: ('missing', '無數據', ''),
+    1: ('normal', '正常血壓', "您的血壓在正常範圍，請繼續保持健康的生活習慣。"),
+    2: ('low', '血壓偏低', "您的血壓在正常範圍內但偏低，如果伴有頭暈、乏力等症狀，請諮詢醫生。"),
+    3: ('elevated', '血壓偏高', "您的血壓略高於正常範圍，建議開始注意健康生活方式，如健康飲食、規律運動和減輕壓力。"),
+    4: ('stage1', '第一期高血壓', "您的血壓處於第一期高血壓範圍，建議諮詢醫生討論生活方式改變，並定期監測。"),
+    5: ('stage2', '第二期高血壓', "您的血壓處於第二期高血壓範圍，建議立即諮詢醫生，可能需要藥物治療和生活方式調整。"),
+    6: ('crisis', '高血壓危機', "您的血壓非常高，這可能表示高血壓危機。請立即尋求醫療協助！"),
+    7: ('special', '血壓數據組合特殊', "您的血壓數據組合較為特殊或不完整，建議諮詢醫生。"),
+}
+PULSE_STATUS_TABLE = {
+    0: ('missing', '無數據'),
+    1: ('normal', '脈搏正常'),
+    2: ('out_of_range', '脈搏異常'),
+}
+SUGAR_STATUS_TABLE = {
+    'fasting': {
+        0: ('missing', '無數據', ''),
+        1: ('low', '低血糖 (空腹)', "您的空腹血糖 ({value} mg/dL) 偏低，可能為低血糖。若有不適請立即補充糖分並諮詢醫生。"),
+        2: ('normal', '正常空腹血糖', "您的空腹血糖 ({value} mg/dL) 在正常範圍。"),
+        3: ('prediabetes', '糖尿病前期 (空腹)', "您的空腹血糖 ({value} mg/dL) 偏高，屬於糖尿病前期。建議改善飲食、增加運動，並定期追蹤血糖。"),
+        4: ('diabetes', '糖尿病 (空腹)', "您的空腹血糖 ({value} mg/dL) 明顯偏高，可能已達糖尿病標準。請立即諮詢醫生進行進一步檢查和治療。"),
+    },
+    'postprandial': {
+        0: ('missing', '無數據', ''),
+        1: ('low', '低血糖 (餐後)', "您的餐後血糖 ({value} mg/dL) 偏低，可能為低血糖。若有不適請立即補充糖分並諮詢醫生。"),
+        2: ('normal', '正常餐後血糖', "您的餐後血糖 ({value} mg/dL) 在正常範圍。"),
+        3: ('prediabetes', '糖尿病前期 (餐後)', "您的餐後血糖 ({value} mg/dL) 偏高，屬於糖尿病前期。建議改善飲食、增加運動，並定期追蹤血糖。"),
+        4: ('diabetes', '糖尿病 (餐後)', "您的餐後血糖 ({value} mg/dL) 明顯偏高，可能已達糖尿病標準。請立即諮詢醫生進行進一步檢查和治療。"),
+    },
+}
+SUGAR_UPPER_LIMITS = {'fasting': (69, 99, 125), 'postprandial': (69, 139, 199)}
+
+def _to_truncated_array(values):
+    # 與純量版本的 int() 一致：先轉為數值，再向零取整；無法轉換者為 NaN
+    return np.trunc(pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=float))
+
+def classify_blood_pressure_array(systolic, diastolic, pulse=None):
+    """向量化的血壓分類，回傳 (血壓狀態代碼, 脈搏狀態代碼) 兩個 int8 陣列，代碼見 BP_STATUS_TABLE / PULSE_STATUS_TABLE。"""
+    s = _to_truncated_array(systolic)
+    d = _to_truncated_array(diastolic)
+    with np.errstate(invalid='ignore'):
+        conditions = [
+            np.isnan(s) | np.isnan(d),
+            (s >= 180) | (d >= 120),
+            (s >= 140) | (d >= 90),
+            ((s >= 130) & (s <= 139)) | ((d >= 80) & (d <= 89)),
+            (s >= 120) & (s <= 129) & (d < 80),
+            (s < 120) & (d < 80) & ((s < 90) | (d < 60)),
+            (s < 120) & (d < 80),
+        ]
+    status_codes = np.select(conditions, [0, 6, 5, 4, 3, 2, 1], default=7).astype(np.int8)
+
+    if pulse is None:
+        pulse_codes = np.zeros(len(s), dtype=np.int8)
+    else:
+        p = _to_truncated_array(pulse)
+        with np.errstate(invalid='ignore'):
+            pulse_codes = np.select([np.isnan(p), (p >= 60) & (p <= 100)], [0, 1], default=2).astype(np.int8)
+    return status_codes, pulse_codes
+
+def classify_blood_sugar_array(values, measurement_type="fasting"):
+    """向量化的血糖分類，回傳 int8 狀態代碼陣列，代碼見 SUGAR_STATUS_TABLE。"""
+    measurement_type = measurement_type.lower()
+    if measurement_type not in SUGAR_UPPER_LIMITS:
+        raise ValueError("請指定 'fasting' (空腹) 或 'postprandial' (餐後)。")
+    v = _to_truncated_array(values)
+    low_max, normal_max, pre_max = SUGAR_UPPER_LIMITS[measurement_type]
+    with np.errstate(invalid='ignore'):
+        conditions = [np.isnan(v), v <= low_max, v <= normal_max, v <= pre_max]
+    return np.select(conditions, [0, 1, 2, 3], default=4).astype(np.int8)
+
+def classify_health_frame(df: pd.DataFrame, data_type: str) -> pd.DataFrame:
+    """為寬格式的每日紀錄計算每個時段的狀態代碼。
+
+    血壓：<時段>_BP_Status 與 <時段>_Pulse_Status；血糖：<時段>_Fasting_Status 與 <時段>_Postprandial_Status。"""
+    result = pd.DataFrame({'Date': df['Date']}) if 'Date' in df.columns else pd.DataFrame(index=df.index)
+    empty = pd.Series(np.nan, index=df.index)
+    for slot in TIME_OF_DAY_LABELS:
+        if data_type == 'blood_pressure':
+            bp_codes, pulse_codes = classify_blood_pressure_array(
+                df.get(f'{slot}_Systolic', empty), df.get(f'{slot}_Diastolic', empty), df.get(f'{slot}_Pulse', empty)
+            )
+            result[f'{slot}_BP_Status'] = bp_codes
+            result[f'{slot}_Pulse_Status'] = pulse_codes
+        else:
+            for measurement in ('Fasting', 'Postprandial'):
+                result[f'{slot}_{measurement}_Status'] = classify_blood_sugar_array(
+                    df.get(f'{slot}_{measurement}', empty), measurement.lower()
+                )
+    return result
+
+def get_status_frame(df: pd.DataFrame, data_type: str) -> pd.DataFrame:
+    """讀取寫入時已儲存的狀態代碼；只有尚未回填 (<NA>) 的資料列才重新計算。"""
+    status_cols = health_storage.HEALTH_STATUS_COLUMNS[data_type]
+    if not all(col in df.columns for col in status_cols):
+        return classify_health_frame(df, data_type)
+    stored = df[status_cols]
+    missing = stored.isna().any(axis=1).to_numpy()
+    result = stored.fillna(0).astype(np.int8)
+    if missing.any():
+        result.loc[missing, status_cols] = classify_health_frame(df[missing], data_type)[status_cols].to_numpy()
+    if 'Date' in df.columns:
+        result.insert(0, 'Date', df['Date'])
+    return result
+
+def describe_status_row(row: dict, data_type: str) -> dict:
+    """將單日紀錄中已儲存的狀態代碼轉為 {欄位名稱 (小寫): {code, key, status, advice}}，無數據的時段略過。"""
+    status_cols = health_storage.HEALTH_STATUS_COLUMNS[data_type]
+    if any(pd.isna(row.get(col)) for col in status_cols):
+        row = dict(row, **get_status_frame(pd.DataFrame([row]), data_type).iloc[0].to_dict())
+    described = {}
+    for col in status_cols:
+        code = int(row[col])
+        if code == 0:
+            continue
+        slot, measurement = col.split('_')[:2]
+        if measurement == 'BP':
+            key, label, advice = BP_STATUS_TABLE[code]
+        elif measurement == 'Pulse':
+            (key, label), advice = PULSE_STATUS_TABLE[code], ''
+        else:
+            key, label, advice = SUGAR_STATUS_TABLE[measurement.lower()][code]
+            value = row.get(f'{slot}_{measurement}')
+            advice = advice.format(value=int(value)) if value is not None and pd.notna(value) else ''
+        described[col.lower()] = {'code': code, 'key': key, 'status': label, 'advice': advice}
+    return described
+
+def add_status_label_columns(table_df: pd.DataFrame, source_df: pd.DataFrame, data_type: str) -> pd.DataFrame:
+    """在報表表格中每個時段的數值後插入狀態文字欄位，狀態取自已儲存的代碼。"""
+    statuses = get_status_frame(source_df, data_type)
+    result = table_df.copy()
+    for slot in TIME_OF_DAY_LABELS:
+        if data_type == 'blood_pressure':
+            pairs = [(f'{slot}_BP_Status', [f'{slot}_Systolic', f'{slot}_Diastolic', f'{slot}_Pulse'], BP_STATUS_TABLE)]
+        else:
+            pairs = [(f'{slot}_{m}_Status', [f'{slot}_{m}'], SUGAR_STATUS_TABLE[m.lower()]) for m in ('Fasting', 'Postprandial')]
+        for status_col, value_cols, table in pairs:
+            shown = [col for col in value_cols if col in result.columns]
+            if not shown:
+                continue
+            labels = statuses[status_col].map(lambda code: table[int(code)][1] if code else '').to_numpy()
+            result.insert(result.columns.get_loc(shown[-1]) + 1, status_col, labels)
+    return result
+
+def describe_blood_pressure_batch(systolic, diastolic, pulse=None):
+    """批次版的 analyze_blood_pressure，回傳每筆讀數的代碼、狀態文字與建議。"""
+    status_codes, pulse_codes = classify_blood_pressure_array(systolic, diastolic, pulse)
+    pulse_values = _to_truncated_array(pulse) if pulse is not None else np.full(len(status_codes), np.nan)
+    results = []
+    for code, pulse_code, p in zip(status_codes.tolist(), pulse_codes.tolist(), pulse_values.tolist()):
+        key, label, advice = BP_STATUS_TABLE[code]
+        pulse_info = ""
+        if pulse_code:
+            pulse_info = f"脈搏: {int(p)} 次/分。 "
+            if pulse_code == 2:
+                pulse_info += "脈搏速率不在常規靜息範圍 (60-100 次/分)，建議注意。"
+        results.append({
+            'status_code': code, 'status_key': key, 'status': label,
+            'advice': pulse_info + advice if code else '',
+            'pulse_status_code': pulse_code, 'pulse_status_key': PULSE_STATUS_TABLE[pulse_code][0],
+        })
+    return results
+
+def describe_blood_sugar_batch(values, measurement_type="fasting"):
+    """批次版的 analyze_blood_sugar，回傳每筆讀數的代碼、狀態文字與建議。"""
+    codes = classify_blood_sugar_array(values, measurement_type)
+    table = SUGAR_STATUS_TABLE[measurement_type.lower()]
+    truncated = _to_truncated_array(values)
+    results = []
+    for code, value in zip(codes.tolist(), truncated.tolist()):
+        key, label, advice = table[code]
+        results.append({
+            'status_code': code, 'status_key': key, 'status': label,
+            'advice': advice.format(value=int(value)) if code else '',
+        })
+    return results
+
+def get_status_legend():
+    """狀態代碼對照表，供前端或報告將代碼轉為文字與顏色。"""
+    return {
+        'blood_pressure': {code: {'key': key, 'status': label} for code, (key, label, _) in BP_STATUS_TABLE.items()},
+        'pulse': {code: {'key': key, 'status': label} for code, (key, label) in PULSE_STATUS_TABLE.items()},
+        'blood_sugar': {
+            measurement: {code: {'key': key, 'status': label} for code, (key, label, _) in table.items()}
+            for measurement, table in SUGAR_STATUS_TABLE.items()
+        },
+    }
+
+# 寬格式欄位名稱 (例如 Morning_Systolic) 的解析規則
+METRIC_COLUMN_PATTERN = re.compile(r"(Morning|Noon|Evening)_(\w+)")
+TIME_OF_DAY_LABELS = {'Morning': '早上', 'Noon': '中午', 'Evening': '晚上'}
+TIME_OF_DAY_HOURS = {'早上': 8, '中午': 12, '晚上': 20}
+METRIC_LABELS = {
+    'blood_pressure': {'Systolic': '收縮壓', 'Diastolic': '舒張壓', 'Pulse': '脈搏'},
+    'blood_sugar': {'Fasting': '空腹血糖', 'Postprandial': '餐後血糖'},
+}
+
+# 送給模型的提示詞上限 (估計的 token 數) 與附上的原始紀錄天數上限
+TREND_PROMPT_TOKEN_BUDGET = int(os.getenv('TREND_PROMPT_TOKEN_BUDGET', '2000'))
+TREND_PROMPT_RAW_ROWS = int(os.getenv('TREND_PROMPT_RAW_ROWS', '14'))
+TREND_PROMPT_OUTLIER_LIMIT = 5
+TREND_EWMA_SPAN = 7
+_CJK_PATTERN = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+def estimate_prompt_tokens(text: str) -> int:
+    """不呼叫 API 的 token 估計：中日韓文字約一字一個 token，其餘約四個字元一個 token。"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + -(-(len(text) - cjk) // 4)
+
+def _format_number(value: float) -> str:
+    return f"{value:.1f}".rstrip('0').rstrip('.')
+
+def _summarize_metric(metric_label: str, metric_raw: str, dates: np.ndarray, matrix: np.ndarray, slot_labels: list) -> str:
+    """單一指標 (各時段欄位組成的 天數 x 時段 矩陣) 的統計摘要。"""
+    readings = matrix[~np.isnan(matrix)]
+    if readings.size == 0:
+        return ''
+    mean, std = readings.mean(), readings.std()
+    parts = [
+        f"共 {readings.size} 筆，平均 {_format_number(mean)} (最低 {_format_number(readings.min())} / 最高 {_format_number(readings.max())})",
+        f"標準差 {_format_number(std)} (變異係數 {_format_number(std / mean * 100 if mean else 0)}%)",
+    ]
+
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        daily = np.nanmean(matrix, axis=1)
+    valid = ~np.isnan(daily)
+    day_numbers = (dates - dates[0]).astype('timedelta64[D]').astype(float)
+    if valid.sum() >= 3 and np.ptp(day_numbers[valid]) > 0:
+        slope = np.polyfit(day_numbers[valid], daily[valid], 1)[0]
+        parts.append(f"每日平均的線性趨勢 {slope:+.2f}/天 ({slope * 7:+.1f}/週)")
+    if valid.any():
+        # 與 pandas ewm(span=..., adjust=True) 最後一個值相同
+        alpha = 2 / (TREND_EWMA_SPAN + 1)
+        weights = (1 - alpha) ** np.arange(valid.sum() - 1, -1, -1)
+        ewma = np.dot(weights, daily[valid]) / weights.sum()
+        parts.append(f"近期加權平均 (EWMA, span {TREND_EWMA_SPAN}) {_format_number(ewma)}")
+
+    low, high = NORMAL_RANGES.get(metric_raw, (-np.inf, np.inf))
+    truncated = np.trunc(readings)
+    above, below = int((truncated > high).sum()), int((truncated < low).sum())
+    parts.append(f"超出正常範圍 ({low}-{high})：偏高 {above} 筆、偏低 {below} 筆 ({(above + below) / readings.size * 100:.0f}%)")
+
+    slot_parts = []
+    for i, slot_label in enumerate(slot_labels):
+        column = matrix[:, i]
+        count = int((~np.isnan(column)).sum())
+        if count:
+            slot_parts.append(f"{slot_label} {_format_number(np.nanmean(column))} ({count} 筆)")
+    if len(slot_parts) > 1:
+        parts.append("各時段平均：" + "、".join(slot_parts))
+
+    # 以中位數與 MAD 計算的穩健 z 分數找出特殊讀數
+    median = np.median(readings)
+    mad = np.median(np.abs(readings - median))
+    scale = mad / 0.6745 if mad > 0 else (std if std > 0 else 0)
+    if scale > 0:
+        z = np.abs(matrix - median) / scale
+        z[np.isnan(z)] = 0
+        flat_order = np.argsort(z, axis=None, kind='stable')[::-1][:TREND_PROMPT_OUTLIER_LIMIT]
+        rows, cols = np.unravel_index(flat_order, matrix.shape)
+        notable = [
+            f"{np.datetime_as_string(dates[r], unit='D')} {slot_labels[c]} {_format_number(matrix[r, c])}"
+            for r, c in zip(rows, cols) if z[r, c] >= 2.5
+        ]
+        if notable:
+            parts.append("特殊讀數：" + "、".join(notable))
+    return f"- {metric_label}：" + "；".join(parts)
+
+def summarize_for_prompt(df: pd.DataFrame, data_type: str) -> str:
+    """以 NumPy 計算每個指標的趨勢斜率、EWMA、變異程度、各時段差異、超出範圍次數與特殊讀數，
+    取代把整張數據表送給模型。"""
+    if df.empty or 'Date' not in df.columns:
+        return ''
+    ordered = df.sort_values('Date')
+    dates = pd.to_datetime(ordered['Date']).to_numpy(dtype='datetime64[D]')
+    metric_map = METRIC_LABELS['blood_pressure' if data_type == 'blood_pressure' else 'blood_sugar']
+
+    lines = [f"- 紀錄期間：{np.datetime_as_string(dates[0])} 至 {np.datetime_as_string(dates[-1])}，共 {len(dates)} 天有紀錄"]
+    for metric_raw, metric_label in metric_map.items():
+        slots = [slot for slot in TIME_OF_DAY_LABELS if f'{slot}_{metric_raw}' in ordered.columns]
+        if not slots:
+            continue
+        matrix = np.column_stack([
+            pd.to_numeric(ordered[f'{slot}_{metric_raw}'], errors='coerce').to_numpy(dtype=float) for slot in slots
+        ])
+        line = _summarize_metric(metric_label, metric_raw, dates, matrix, [TIME_OF_DAY_LABELS[slot] for slot in slots])
+        if line:
+            lines.append(line)
+
+    statuses = get_status_frame(ordered, data_type)
+    if data_type == 'blood_pressure':
+        codes = statuses[[f'{slot}_BP_Status' for slot in TIME_OF_DAY_LABELS]].to_numpy().ravel()
+        labels = {code: label for code, (_, label, _) in BP_STATUS_TABLE.items()}
+        counts = [f"{labels[code]} {int((codes == code).sum())} 次" for code in labels if code and (codes == code).any()]
+        if counts:
+            lines.append("- 血壓分級次數：" + "、".join(counts))
+    else:
+        for measurement, label in (('fasting', '空腹'), ('postprandial', '餐後')):
+            codes = statuses[[f'{slot}_{measurement.capitalize()}_Status' for slot in TIME_OF_DAY_LABELS]].to_numpy().ravel()
+            table = SUGAR_STATUS_TABLE[measurement]
+            counts = [f"{table[code][1]} {int((codes == code).sum())} 次" for code in table if code and (codes == code).any()]
+            if counts:
+                lines.append(f"- {label}血糖分級次數：" + "、".join(counts))
+    return "\n".join(lines)
+
+def build_trend_prompt_data(df: pd.DataFrame, data_type: str, value_columns: list,
+                            token_budget: int = TREND_PROMPT_TOKEN_BUDGET, max_raw_rows: int = TREND_PROMPT_RAW_ROWS,
+                            summary: str = None) -> str:
+    """統計摘要加上最近幾天的原始紀錄；超過 token_budget 時逐步減少附上的原始紀錄天數。
+    summary 省略時以 summarize_for_prompt 產生 (綜合模式由呼叫端傳入兩種數據各自的摘要)。"""
+    if summary is None:
+        summary = summarize_for_prompt(df, data_type)
+    table_df = df.sort_values('Date')[['Date'] + value_columns].copy()
+    table_df['Date'] = pd.to_datetime(table_df['Date']).dt.strftime('%Y-%m-%d')
+    total_rows = len(table_df)
+
+    raw_rows = min(max_raw_rows, total_rows)
+    while True:
+        text = f"統計摘要：\n{summary}"
+        if raw_rows > 0:
+            heading = "原始紀錄" if raw_rows == total_rows else f"原始紀錄 (最近 {raw_rows} 天，共 {total_rows} 天)"
+            text += f"\n\n{heading}：\n" + table_df.tail(raw_rows).to_string(index=False, na_rep='無')
+        if raw_rows == 0 or estimate_prompt_tokens(trend_prompt) + estimate_prompt_tokens(text) <= token_budget:
+            break
+        raw_rows //= 2
+
+    remaining = token_budget - estimate_prompt_tokens(trend_prompt)
+    if estimate_prompt_tokens(text) > remaining:
+        # 摘要本身就超過預算 (指標極多時)：保留完整的行，截掉後面的部分
+        kept = []
+        for line in text.split('\n'):
+            if estimate_prompt_tokens('\n'.join(kept + [line])) > remaining:
+                break
+            kept.append(line)
+        text = '\n'.join(kept)
+    return text
+
+TIME_PERIOD_LABELS = {'today': '當日', '7days': '最近7天', '30days': '最近30天', 'all': '所有歷史數據'}
+
+def _parse_range_bound(value):
+    if value is None or value == '':
+        return None
+    return datetime.strptime(health_storage.normalize_date(value), '%Y-%m-%d').date()
+
+def get_period_date_range(period: str, start_date=None, end_date=None):
+    """回傳時間區間對應的 (起始日, 結束日)，None 表示不限制。供儲存層只讀取需要的資料列。
+
+    提供 start_date / end_date (任一即可) 時為自訂區間，忽略 period；日期無效或起始晚於結束時拋出 ValueError。"""
+    if start_date not in (None, '') or end_date not in (None, ''):
+        start, end = _parse_range_bound(start_date), _parse_range_bound(end_date)
+        if start and end and start > end:
+            raise ValueError("起始日期不可晚於結束日期。")
+        return start, end
     today = datetime.now().date()
     if period == 'today':
-        return df_filtered[df_filtered['Date'].dt.date == today]
+        return today, today
     elif period == '7days':
-        seven_days_ago = today - timedelta(days=6)
-        return df_filtered[(df_filtered['Date'].dt.date >= seven_days_ago) & (df_filtered['Date'].dt.date <= today)]
+        return today - timedelta(days=6), today
     elif period == '30days':
-        thirty_days_ago = today - timedelta(days=29)
-        return df_filtered[(df_filtered['Date'].dt.date >= thirty_days_ago) & (df_filtered['Date'].dt.date <= today)]
-    elif period == 'all':
-        return df_filtered
-    else:
+        return today - timedelta(days=29), today
+    return None, None
+
+def get_period_key(period: str, start_date=None, end_date=None) -> str:
+    """快取鍵與檔名使用的區間代號：預設區間為 period 本身，自訂區間為 '起始~結束' (未限制的一端留空)。"""
+    if start_date in (None, '') and end_date in (None, ''):
+        return period
+    start, end = get_period_date_range(period, start_date, end_date)
+    return f"{start or ''}~{end or ''}"
+
+def get_period_label(period: str, start_date=None, end_date=None) -> str:
+    if start_date in (None, '') and end_date in (None, ''):
+        return TIME_PERIOD_LABELS.get(period, "指定期間")
+    start, end = get_period_date_range(period, start_date, end_date)
+    return f"{start or '最早紀錄'} 至 {end or '最新紀錄'}"
+
+def filter_data_by_period(df: pd.DataFrame, period: str, start_date=None, end_date=None) -> pd.DataFrame:
+    """以二分搜尋在已排序的日期上切出區間。
+
+    儲存層回傳的數據已依日期排序並帶有 health_storage.DATES_SORTED_ATTR 標記，直接以 searchsorted 找出邊界並切片，
+    不檢查、不轉換整欄日期，成本取決於區間大小而非整段歷史。沒有標記的輸入 (或區間內含無效日期) 才先整段轉換、整理。
+    回傳的 Date 欄位為 datetime64。"""
+    if 'Date' not in df.columns:
+        raise ValueError("DataFrame 必須包含 'Date' 欄位。")
+    if period not in TIME_PERIOD_LABELS and start_date in (None, '') and end_date in (None, ''):
         print(f"無法識別的時間範圍 '{period}'，將回傳所有數據。")
-        return df_filtered
+    start, end = get_period_date_range(period, start_date, end_date)
+    dates = df['Date']
+
+    if dates.dtype == object and df.attrs.get(health_storage.DATES_SORTED_ATTR):
+        # 儲存層的日期為 YYYY-MM-DD 字串，字典順序即日期順序：直接在字串上二分搜尋，只轉換區間內的日期
+        raw = dates.to_numpy()
+        lo = 0 if start is None else int(np.searchsorted(raw, start.isoformat(), side='left'))
+        hi = len(raw) if end is None else int(np.searchsorted(raw, end.isoformat(), side='right'))
+        window_dates = pd.to_datetime(dates.iloc[lo:hi], format='%Y-%m-%d', errors='coerce')
+        if not window_dates.isna().any():
+            result = df.iloc[lo:hi].copy(deep=False)
+            result['Date'] = window_dates.to_numpy()
+            return result
+
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        try:
+            dates = pd.to_datetime(dates, errors='coerce')
+        except Exception as e:
+            raise ValueError(f"轉換 'Date' 欄位為日期格式時出錯: {e}")
+    if dates.isna().any() or not dates.is_monotonic_increasing:
+        valid = dates.notna().to_numpy()
+        order = np.argsort(dates.to_numpy()[valid], kind='stable')
+        df = df[valid].iloc[order]
+        dates = dates[valid].iloc[order]
+
+    values = dates.to_numpy(dtype='datetime64[ns]')
+    lo = 0 if start is None else int(np.searchsorted(values, np.datetime64(start, 'ns'), side='left'))
+    hi = len(values) if end is None else int(np.searchsorted(values, np.datetime64(end + timedelta(days=1), 'ns'), side='left'))
+
+    result = df.iloc[lo:hi].copy(deep=False)
+    result['Date'] = values[lo:hi]
+    return result
 
 def reshape_for_plotting(df: pd.DataFrame, data_type: str) -> pd.DataFrame:
-    """Reshapes the data from wide to long format suitable for plotting."""
-    df_long = df.melt(id_vars=['Date'], var_name='Metric', value_name='Value')
-    df_long.dropna(subset=['Value'], inplace=True)
-    if df_long.empty:
-        return pd.DataFrame()
+    """Reshapes the data from wide to long format suitable for plotting.
 
-    pattern = re.compile(r"(Morning|Noon|Evening)_(\w+)")
-    
-    extracted_data = df_long['Metric'].str.extract(pattern)
-    df_long['TimeOfDayRaw'] = extracted_data[0]
-    df_long['MetricTypeRaw'] = extracted_data[1]
+    Column names are parsed once per column and timestamps are built with array ops,
+    so the cost is a handful of vectorized operations per column instead of a Python
+    call per reading."""
+    metric_map = METRIC_LABELS['blood_pressure' if data_type == 'blood_pressure' else 'blood_sugar']
+    dates = pd.to_datetime(df['Date']).to_numpy()
+
+    pieces = []
+    for col in df.columns:
+        if col == 'Date':
+            continue
+        match = METRIC_COLUMN_PATTERN.search(col)
+        if not match:
+            continue
+        time_raw, metric_raw = match.groups()
+        time_label = TIME_OF_DAY_LABELS.get(time_raw)
+        metric_label = metric_map.get(metric_raw)
+        if time_label is None or metric_label is None:
+            continue
+
+        values = df[col]
+        mask = values.notna().to_numpy()
+        if not mask.any():
+            continue
+        # 餐後血糖畫在該時段的 2 小時後，避免與空腹血糖重疊
+        hours = TIME_OF_DAY_HOURS[time_label]
+        if data_type == 'blood_sugar' and metric_raw == 'Postprandial':
+            hours += 2
+        col_dates = dates[mask]
+        pieces.append(pd.DataFrame({
+            'Date': col_dates,
+            'Metric': col,
+            'Value': values.to_numpy()[mask],
+            'TimeOfDayRaw': time_raw,
+            'MetricTypeRaw': metric_raw,
+            'TimeOfDay': time_label,
+            'MetricType': metric_label,
+            'DateTime': col_dates + np.timedelta64(hours, 'h'),
+        }))
 
-    df_long.dropna(subset=['TimeOfDayRaw', 'MetricTypeRaw'], inplace=True)
-    if df_long.empty:
+    if not pieces:
         return pd.DataFrame()
+    df_long = pd.concat(pieces, ignore_index=True)
+    df_long.sort_values('DateTime', inplace=True, kind='stable')
+    return df_long
 
-    time_map = {'Morning': '早上', 'Noon': '中午', 'Evening': '晚上'}
-    
-    if data_type == 'blood_pressure':
-        metric_map = {'Systolic': '收縮壓', 'Diastolic': '舒張壓', 'Pulse': '脈搏'}
-    else: # blood_sugar
-        metric_map = {'Fasting': '空腹血糖', 'Postprandial': '餐後血糖'}
+# 趨勢圖每個指標最多繪製的點數，超過時以 LTTB 取樣 (0 代表不取樣)
+PLOT_MAX_POINTS_PER_METRIC = int(os.getenv('PLOT_MAX_POINTS_PER_METRIC', '1000'))
 
-    df_long['TimeOfDay'] = df_long['TimeOfDayRaw'].map(time_map)
-    df_long['MetricType'] = df_long['MetricTypeRaw'].map(metric_map)
-    
-    df_long.dropna(subset=['TimeOfDay', 'MetricType'], inplace=True)
-    
-    time_offsets = {'早上': 8, '中午': 12, '晚上': 20}
-    
-    df_long['DateTime'] = df_long.apply(
-        lambda row: row['Date'] + pd.to_timedelta(time_offsets.get(row['TimeOfDay'], 12), unit='h'),
-        axis=1
-    )
-    
-    if data_type == 'blood_sugar':
-        postprandial_mask = df_long['MetricTypeRaw'] == 'Postprandial'
-        df_long.loc[postprandial_mask, 'DateTime'] += pd.to_timedelta(2, unit='h')
+def lttb_indices(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets：保留視覺形狀的取樣，回傳被選取點的索引 (含首尾)。"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    sampled = np.empty(threshold, dtype=np.int64)
+    sampled[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        # 下一個桶的平均點作為三角形的第三個頂點
+        next_start = int(np.floor((i + 1) * every)) + 1
+        next_end = min(int(np.floor((i + 2) * every)) + 1, n)
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
 
-    df_long.sort_values('DateTime', inplace=True)
-    return df_long
+        start = int(np.floor(i * every)) + 1
+        end = int(np.floor((i + 1) * every)) + 1
+        areas = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        sampled[i + 1] = a
+    sampled[-1] = n - 1
+    return sampled
 
-def generate_plotly_data(reshaped_df: pd.DataFrame, data_type: str, title: str):
+def _out_of_range_extreme_indices(values: np.ndarray, metric_raw: str, buckets: int) -> np.ndarray:
+    """每個桶中偏離正常範圍最多的一筆讀數，確保取樣後異常值仍會出現在圖上。"""
+    low, high = NORMAL_RANGES.get(metric_raw, (-np.inf, np.inf))
+    truncated = np.trunc(values)
+    deviation = np.maximum(low - truncated, truncated - high)
+    candidates = np.flatnonzero(deviation > 0)
+    if candidates.size == 0:
+        return candidates
+    bucket_ids = (candidates * buckets) // len(values)
+    order = np.lexsort((-deviation[candidates], bucket_ids))
+    first_in_bucket = np.r_[True, bucket_ids[order][1:] != bucket_ids[order][:-1]]
+    return candidates[order][first_in_bucket]
+
+def downsample_for_plotting(reshaped_df: pd.DataFrame, max_points_per_metric: int = PLOT_MAX_POINTS_PER_METRIC) -> pd.DataFrame:
+    """介於 reshape_for_plotting 與繪圖之間的取樣步驟。
+
+    每個欄位 (時段 x 指標) 各自以 LTTB 取樣到約 max_points_per_metric 點，
+    並額外保留每個桶中最嚴重的超出正常範圍讀數。點數未超過上限時原樣回傳。"""
+    if reshaped_df.empty or not max_points_per_metric:
+        return reshaped_df
+    per_column = max(3, max_points_per_metric // max(1, reshaped_df['TimeOfDayRaw'].nunique()))
+
+    keep = []
+    for _, group in reshaped_df.groupby('Metric', sort=False):
+        values = pd.to_numeric(group['Value'], errors='coerce').to_numpy(dtype=float)
+        if len(group) <= per_column:
+            keep.append(group.index.to_numpy())
+            continue
+        x = group['DateTime'].to_numpy(dtype='datetime64[ns]').astype(np.int64) / 1e9
+        selected = lttb_indices(x, np.nan_to_num(values), per_column)
+        extremes = _out_of_range_extreme_indices(values, group['MetricTypeRaw'].iloc[0], per_column)
+        keep.append(group.index.to_numpy()[np.union1d(selected, extremes)])
+
+    kept = np.concatenate(keep)
+    if len(kept) == len(reshaped_df):
+        return reshaped_df
+    # 保留原本依 DateTime 排序的順序
+    return reshaped_df[reshaped_df.index.isin(kept)].copy()
+
+# 趨勢圖的 Y 軸設定；血壓圖的第二個軸 (脈搏) 與第一軸重疊、畫在右側。
+# 綜合模式為上下兩個面板共用時間軸：上方血壓 (與脈搏)，下方血糖；domain 為各面板在圖中的垂直位置。
+TREND_Y_AXES = {
+    'blood_pressure': [
+        {'title': "<b>血壓</b> (mmHg)", 'range': [0, 300]},
+        {'title': "<b>脈搏</b> (次/分)", 'range': [0, 200], 'overlaying': 'y'},
+    ],
+    'blood_sugar': [
+        {'title': "<b>血糖</b> (mg/dL)", 'range': [0, 300]},
+    ],
+    'combined': [
+        {'title': "<b>血壓</b> (mmHg)", 'range': [0, 300], 'domain': [0.55, 1]},
+        {'title': "<b>脈搏</b> (次/分)", 'range': [0, 200], 'overlaying': 'y'},
+        {'title': "<b>血糖</b> (mg/dL)", 'range': [0, 300], 'domain': [0, 0.45]},
+    ],
+}
+# 綜合分析模式一次處理的數據類型
+COMBINED_DATA_TYPES = ('blood_pressure', 'blood_sugar')
+TREND_DATA_TYPES = COMBINED_DATA_TYPES + ('combined',)
+TREND_PLOT_HEIGHTS = {'combined': 800}
+TREND_TYPE_NAMES = {'blood_pressure': '血壓', 'blood_sugar': '血糖'}
+TREND_REPORT_TITLES = {
+    'blood_pressure': "血壓與脈搏趨勢分析報告",
+    'blood_sugar': "血糖趨勢分析報告",
+    'combined': "血壓與血糖綜合趨勢分析報告",
+}
+
+def get_source_data_types(data_type: str) -> tuple:
+    """趨勢分析的數據類型實際要讀取的儲存類型。"""
+    return COMBINED_DATA_TYPES if data_type == 'combined' else (data_type,)
+
+def has_trend_data(user_id: str, data_type: str) -> bool:
+    """綜合模式只要有任一種數據即可分析。"""
+    store = health_storage.get_health_store()
+    return any(store.has_data(user_id, source_type) for source_type in get_source_data_types(data_type))
+
+def merge_on_date(frames) -> pd.DataFrame:
+    """以日期 (外部連接) 將多張每日寬表合併為一張，依日期排序；只有一張時直接回傳。"""
+    frames = list(frames)
+    merged = frames[0]
+    for frame in frames[1:]:
+        merged = merged.merge(frame, on='Date', how='outer', sort=True)
+    return merged
+
+def get_trend_axis(data_type: str, metric_label: str) -> int:
+    """指標畫在 TREND_Y_AXES[data_type] 的第幾個軸 (從 1 起算)。"""
+    if metric_label == '脈搏':
+        return 2
+    if data_type == 'combined' and metric_label in METRIC_LABELS['blood_sugar'].values():
+        return 3
+    return 1
+TREND_HOVER_TEMPLATE = '<b>%{y}</b><br>日期: %{x|%Y-%m-%d}<br>時間: %{x|%H:%M}<extra></extra>'
+COMPACT_PLOT_FORMAT = 'columnar-v1'
+
+def build_plotly_figure(reshaped_df: pd.DataFrame, data_type: str, title: str):
+    """建立趨勢圖的 Figure 物件；沒有可繪製的數據時回傳 None。"""
     if reshaped_df.empty:
-        return "{}"
+        return None
 
     reshaped_df['Value'] = pd.to_numeric(reshaped_df['Value'], errors='coerce')
     reshaped_df.dropna(subset=['Value'], inplace=True)
 
     if reshaped_df.empty:
-        return "{}"
+        return None
 
     metric_types = reshaped_df['MetricType'].unique()
 
-    if data_type == 'blood_pressure':
+    if data_type == 'combined':
+        fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.08,
+                            specs=[[{"secondary_y": True}], [{"secondary_y": False}]])
+        for metric in metric_types:
+            df_metric = reshaped_df[reshaped_df['MetricType'] == metric]
+            axis = get_trend_axis(data_type, metric)
+            fig.add_trace(
+                go.Scatter(
+                    x=df_metric['DateTime'].tolist(),
+                    y=df_metric['Value'].tolist(),
+                    mode='lines+markers',
+                    name=metric,
+                    hovertemplate=TREND_HOVER_TEMPLATE
+                ),
+                row=2 if axis == 3 else 1, col=1, secondary_y=axis == 2
+            )
+        bp_axis, pulse_axis, sugar_axis = TREND_Y_AXES['combined']
+        fig.update_yaxes(title_text=bp_axis['title'], range=bp_axis['range'], row=1, col=1, secondary_y=False)
+        fig.update_yaxes(title_text=pulse_axis['title'], range=pulse_axis['range'], row=1, col=1, secondary_y=True)
+        fig.update_yaxes(title_text=sugar_axis['title'], range=sugar_axis['range'], row=2, col=1)
+        fig.update_layout(height=TREND_PLOT_HEIGHTS['combined'])
+
+    elif data_type == 'blood_pressure':
         fig = make_subplots(specs=[[{"secondary_y": True}]])
         
         for metric in metric_types:
@@ -295,16 +870,14 @@ def generate_plotly_data(reshaped_df: pd.DataFrame, data_type: str, title: str):
                     y=df_metric['Value'].tolist(),
                     mode='lines+markers',
                     name=metric,
-                    hovertemplate=
-                    '<b>%{y}</b><br>' +
-                    '日期: %{x|%Y-%m-%d}<br>' +
-                    '時間: %{x|%H:%M}<extra></extra>'
+                    hovertemplate=TREND_HOVER_TEMPLATE
                 ),
                 secondary_y=is_secondary
             )
         
-        fig.update_yaxes(title_text="<b>血壓</b> (mmHg)", range=[0, 300], secondary_y=False)
-        fig.update_yaxes(title_text="<b>脈搏</b> (次/分)", range=[0, 200], secondary_y=True)
+        primary_axis, secondary_axis = TREND_Y_AXES['blood_pressure']
+        fig.update_yaxes(title_text=primary_axis['title'], range=primary_axis['range'], secondary_y=False)
+        fig.update_yaxes(title_text=secondary_axis['title'], range=secondary_axis['range'], secondary_y=True)
 
     else: # blood_sugar
         fig = go.Figure()
@@ -316,13 +889,11 @@ def generate_plotly_data(reshaped_df: pd.DataFrame, data_type: str, title: str):
                     y=df_metric['Value'].tolist(),
                     mode='lines+markers',
                     name=metric,
-                    hovertemplate=
-                    '<b>%{y}</b><br>' +
-                    '日期: %{x|%Y-%m-%d}<br>' +
-                    '時間: %{x|%H:%M}<extra></extra>'
+                    hovertemplate=TREND_HOVER_TEMPLATE
                 )
             )
-        fig.update_yaxes(title_text="<b>血糖</b> (mg/dL)", range=[0, 300])
+        sugar_axis, = TREND_Y_AXES['blood_sugar']
+        fig.update_yaxes(title_text=sugar_axis['title'], range=sugar_axis['range'])
 
     fig.update_layout(
         title={'text': title, 'font': {'size': 20}},
@@ -331,18 +902,91 @@ def generate_plotly_data(reshaped_df: pd.DataFrame, data_type: str, title: str):
         legend_title_text='指標'
     )
     
-    return fig.to_json()
+    return fig
+
+def _encode_array(values: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(values).tobytes()).decode('ascii')
+
+def build_compact_plot_payload(reshaped_df: pd.DataFrame, data_type: str, title: str) -> dict:
+    """趨勢圖的精簡傳輸格式：每條線只送時間與數值兩個型別化陣列，由前端組成 Plotly 圖表。
+
+    完整的 fig.to_json() 會帶上整份 plotly_white 模板與每條線的設定，數據本身只佔一小部分。
+    時間為與前一點相差的秒數 (第一點相對於 t0，little-endian int32)，每日固定時段的讀數幾乎都是相同的差值，壓縮效果好；
+    數值四捨五入為 little-endian int16，皆以 base64 編碼；
+    時間戳記視為 UTC 編碼，前端以 UTC 還原即可得到原本的本地時間。"""
+    payload = {
+        'format': COMPACT_PLOT_FORMAT,
+        'data_type': data_type,
+        't0': 0,
+        'series': [],
+        'layout': {
+            'title': title,
+            'xaxis_title': '日期與時間',
+            'legend_title': '指標',
+            'hovertemplate': TREND_HOVER_TEMPLATE,
+            'yaxes': TREND_Y_AXES.get(data_type, TREND_Y_AXES['blood_sugar']),
+            'height': TREND_PLOT_HEIGHTS.get(data_type),
+        },
+    }
+    if reshaped_df.empty:
+        return payload
+
+    values = pd.to_numeric(reshaped_df['Value'], errors='coerce').to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return payload
+    seconds = reshaped_df['DateTime'].to_numpy(dtype='datetime64[s]').astype(np.int64)[valid]
+    values = np.clip(np.rint(values[valid]), np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype('<i2')
+    metric_types = reshaped_df['MetricType'].to_numpy()[valid]
+    t0 = int(seconds.min())
+    payload['t0'] = t0
+
+    for metric in pd.unique(metric_types):
+        mask = metric_types == metric
+        payload['series'].append({
+            'name': metric,
+            'axis': get_trend_axis(data_type, metric),
+            'length': int(mask.sum()),
+            't': _encode_array(np.diff(seconds[mask], prepend=t0).astype('<i4')),
+            'v': _encode_array(values[mask]),
+        })
+    return payload
+
+def get_trend_data_version(user_id: str, data_type: str, time_period_filter: str, start_date=None, end_date=None) -> str:
+    """回傳區間內數據內容的雜湊，作為趨勢分析回應的 ETag 依據。
+
+    讀取走儲存層的快取，成本遠低於重新分析；任何一筆讀數或狀態變動都會改變結果。"""
+    start, end = get_period_date_range(time_period_filter, start_date, end_date)
+    store = health_storage.get_health_store()
+    model_id = model_providers.get_model_provider().cache_id(gemini_model)
+    digest = hashlib.sha256(f"{TREND_PROMPT_VERSION}|{model_id}|{data_type}|{start}|{end}|".encode('utf-8'))
+    for source_type in get_source_data_types(data_type):
+        df = store.load(user_id, source_type, start, end)
+        digest.update(f"{source_type}:".encode('utf-8'))
+        if not df.empty:
+            digest.update(','.join(df.columns).encode('utf-8'))
+            digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def generate_plotly_data(reshaped_df: pd.DataFrame, data_type: str, title: str):
+    fig = build_plotly_figure(reshaped_df, data_type, title)
+    return "{}" if fig is None else fig.to_json()
+
+def generate_plot_base64_with_plotly(fig, plotly_fig_json_str: str = None, height: int = 500, raise_errors: bool = False):
+    """Generates a base64 PNG directly from a Plotly figure object.
 
-def generate_plot_base64_with_plotly(plotly_fig_json_str: str):
-    """Generates a base64 PNG from a Plotly figure JSON string."""
-    if not plotly_fig_json_str or plotly_fig_json_str == "{}":
+    plotly_fig_json_str, when the caller already has it, is reused as the cache key
+    so the figure is not serialized a second time. With raise_errors the export error
+    (e.g. Kaleido/Chrome missing) propagates instead of returning None."""
+    if fig is None:
         return None
     try:
-        fig = go.Figure(json.loads(plotly_fig_json_str))
-        img_bytes = pio.to_image(fig, format='png', width=900, height=500, scale=2)
+        img_bytes = plot_export.get_plot_exporter().to_png(fig, width=900, height=height, scale=2, content_key=plotly_fig_json_str)
         return base64.b64encode(img_bytes).decode('utf-8')
     except Exception as e:
         print(f"使用 Plotly 生成圖片時發生錯誤: {e}")
+        if raise_errors:
+            raise
         return None
 
 def generate_trend_report_pdf(
@@ -372,7 +1016,16 @@ def generate_trend_report_pdf(
         'Noon_Fasting': '午間空腹血糖',
         'Noon_Postprandial': '午間餐後血糖',
         'Evening_Fasting': '晚間空腹血糖',
-        'Evening_Postprandial': '晚間餐後血糖'
+        'Evening_Postprandial': '晚間餐後血糖',
+        'Morning_BP_Status': '早上血壓狀態',
+        'Noon_BP_Status': '中午血壓狀態',
+        'Evening_BP_Status': '晚上血壓狀態',
+        'Morning_Fasting_Status': '早晨空腹狀態',
+        'Morning_Postprandial_Status': '早晨餐後狀態',
+        'Noon_Fasting_Status': '午間空腹狀態',
+        'Noon_Postprandial_Status': '午間餐後狀態',
+        'Evening_Fasting_Status': '晚間空腹狀態',
+        'Evening_Postprandial_Status': '晚間餐後狀態'
     }
 
     data_table_df_display = data_table_df.copy()
@@ -382,12 +1035,10 @@ def generate_trend_report_pdf(
     data_table_html = data_table_df_display.to_html(index=False, border=0, classes="dataframe") if not data_table_df_display.empty else "<p>此期間無數據可顯示。</p>"
     
     generation_timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    template = Template(PDF_REPORT_TEMPLATE)
-    template.environment.filters['markdown_to_html'] = markdown_to_html_filter
 
     trend_plot_html_tag = f'<img src="data:image/png;base64,{trend_plot_base64_data}" alt="趨勢圖">' if trend_plot_base64_data else ''
 
-    html_content = template.render(
+    html_content = PDF_TEMPLATE.render(
         report_title=report_title,
         time_period_label=time_period_label,
         data_table_html=data_table_html,
@@ -396,24 +1047,28 @@ def generate_trend_report_pdf(
         generation_timestamp=generation_timestamp
     )
     
-    report_type_str = "血壓" if data_type_for_filename == 'blood_pressure' else "血糖"
+    report_type_str = {'blood_pressure': "血壓", 'combined': "血壓血糖"}.get(data_type_for_filename, "血糖")
     
-    period_days = ''.join(filter(str.isdigit, time_period_key))
-    if not period_days:
-        if time_period_key == 'today':
-            period_days = '1'
-        else:
-            period_days = '所有'
-            
     today_str = datetime.now().strftime("%Y-%m-%d")
-    pdf_filename = f"{report_type_str}_{period_days}天_{today_str}.pdf"
+    if '~' in time_period_key:
+        # 自訂區間 (get_period_key 的 '起始~結束')
+        range_start, range_end = time_period_key.split('~')
+        pdf_filename = f"{report_type_str}_{range_start or '最早'}至{range_end or today_str}.pdf"
+    else:
+        period_days = ''.join(filter(str.isdigit, time_period_key))
+        if not period_days:
+            if time_period_key == 'today':
+                period_days = '1'
+            else:
+                period_days = '所有'
+        pdf_filename = f"{report_type_str}_{period_days}天_{today_str}.pdf"
     
     pdf_output_folder = os.path.join(base_output_dir, "reports")
     os.makedirs(pdf_output_folder, exist_ok=True)
     abs_pdf_path = os.path.abspath(os.path.join(pdf_output_folder, pdf_filename))
     
     try:
-        pdfkit.from_string(html_content, abs_pdf_path, configuration=config, options={'enable-local-file-access': ''})
+        pdf_render_service.render(html_content, abs_pdf_path)
         
         static_dir_abs = os.path.abspath("static")
         relative_path = os.path.relpath(abs_pdf_path, static_dir_abs)
@@ -429,15 +1084,31 @@ def generate_trend_report_pdf(
         print(f"除錯用的 HTML 已儲存至: {debug_html_path}")
         raise
 
-def health_trend_analysis(csv_file_path: str, base_output_dir: str, analysis_timestamp_str: str, time_period_filter: str, data_type: str, generate_pdf: bool = True):
+def health_trend_analysis(user_id: str, base_output_dir: str, analysis_timestamp_str: str, time_period_filter: str, data_type: str, generate_pdf: bool = True, progress=None, full_resolution: bool = False, plot_format: str = 'plotly', timings: dict = None, on_plot_ready=None, on_text_chunk=None, start_date=None, end_date=None):
+    """progress(stage, message) 為選用的進度回報函式，供背景報告工作推送進度。
+    full_resolution 為 True 時趨勢圖不取樣，繪出每一筆讀數。
+    plot_format 為 'compact' 時第三個回傳值是 build_compact_plot_payload 的 JSON，而非完整的 Plotly 圖表 JSON。
+    timings 若提供 dict，會記錄各階段 (load、plot、analysis、plot_image、table、pdf) 與整體 (total) 耗費的秒數。
+    串流模式：on_plot_ready(plot_data_string) 在呼叫模型前就先交出圖表數據；on_text_chunk(text) 依序收到模型
+    以串流產生的文字片段 (命中快取時一次收到全文)。回傳值與非串流模式相同。
+    start_date / end_date 為自訂區間 (例如回診前三個月)，提供時取代 time_period_filter。
+    data_type 為 'combined' 時一次讀取血壓與血糖，產生共用時間軸的上下雙面板圖、一次 AI 分析與一份 PDF。
+
+    讀取數據後，繪圖、AI 分析與 PDF 表格彼此獨立，以 stage_graph 在共用執行緒池中同時執行；
+    圖片輸出只等繪圖，PDF 則等三者都完成，因此總耗時接近最慢的一條路徑 (通常是 Gemini)。"""
+    def report_progress(stage, message):
+        if progress:
+            progress(stage, message)
+
+    started = time.perf_counter()
     try:
-        if not os.path.exists(csv_file_path):
+        report_progress('loading', '正在讀取健康數據...')
+        if not has_trend_data(user_id, data_type):
             return "錯誤：數據檔案不存在。", None, None, None
 
-        df_original = pd.read_csv(csv_file_path, encoding='utf-8-sig')
-        
-        if 'Date' not in df_original.columns:
-            raise ValueError("CSV 檔案中缺少 'Date' 欄位。")
+        range_start, range_end = get_period_date_range(time_period_filter, start_date, end_date)
+        period_key = get_period_key(time_period_filter, start_date, end_date)
+        store = health_storage.get_health_store()
 
         bp_cols = [
             'Morning_Systolic', 'Morning_Diastolic', 'Morning_Pulse',
@@ -449,74 +1120,172 @@ def health_trend_analysis(csv_file_path: str, base_output_dir: str, analysis_tim
             'Noon_Fasting', 'Noon_Postprandial',
             'Evening_Fasting', 'Evening_Postprandial'
         ]
+        cols_by_type = {'blood_pressure': bp_cols, 'blood_sugar': sugar_cols}
 
-        cols_for_type = bp_cols if data_type == 'blood_pressure' else sugar_cols
+        # 綜合模式在同一次流程中讀取兩種數據，之後共用一張圖、一次 AI 分析與一份 PDF
+        filtered_by_type = {}
+        reshaped_by_type = {}
+        for source_type in get_source_data_types(data_type):
+            if not store.has_data(user_id, source_type):
+                continue
+            df_original = store.load(user_id, source_type, range_start, range_end)
+            if 'Date' not in df_original.columns:
+                raise ValueError("CSV 檔案中缺少 'Date' 欄位。")
 
-        df_analysis = df_original.copy()
-        for col in cols_for_type:
-            if col in df_analysis.columns:
-                df_analysis[col] = pd.to_numeric(df_analysis[col], errors='coerce')
-        
-        df_filtered = filter_data_by_period(df_analysis, time_period_filter)
+            # 儲存層每次回傳新的 DataFrame，可直接就地轉換
+            df_analysis = df_original
+            for col in cols_by_type[source_type]:
+                if col in df_analysis.columns:
+                    df_analysis[col] = pd.to_numeric(df_analysis[col], errors='coerce')
 
-        if df_filtered.empty:
-            return "選定時間範圍內無數據可供分析。", None, "{}", None
+            df_type_filtered = filter_data_by_period(df_analysis, time_period_filter, start_date, end_date)
+            if df_type_filtered.empty:
+                continue
+            filtered_by_type[source_type] = df_type_filtered
+            df_type_reshaped = reshape_for_plotting(df_type_filtered, source_type)
+            if not df_type_reshaped.empty:
+                reshaped_by_type[source_type] = df_type_reshaped
 
-        df_reshaped = reshape_for_plotting(df_filtered, data_type)
+        if not filtered_by_type:
+            return "選定時間範圍內無數據可供分析。", None, "{}", None
 
-        if df_reshaped.empty:
+        if not reshaped_by_type:
              return "選定時間範圍內無有效數據可供分析。", None, "{}", None
 
-        time_period_labels = {'today': '當日', '7days': '最近7天', '30days': '最近30天', 'all': '所有歷史數據'}
-        time_label = time_period_labels.get(time_period_filter, "指定期間")
-        
-        report_title_str = "血糖趨勢分析報告" if data_type == 'blood_sugar' else "血壓與脈搏趨勢分析報告"
-        
-        plotly_data_string = generate_plotly_data(df_reshaped, data_type, f"{report_title_str} ({time_label})")
+        df_reshaped = next(iter(reshaped_by_type.values()))
+        if len(reshaped_by_type) > 1:
+            df_reshaped = pd.concat(reshaped_by_type.values(), ignore_index=True)
+            df_reshaped.sort_values('DateTime', inplace=True, kind='stable')
+
+        # 各類型實際有數據的欄位；綜合模式的提示詞與表格以日期對齊兩種數據
+        value_cols_by_type = {
+            source_type: [col for col in cols_by_type[source_type]
+                          if col in df_type.columns and not df_type[col].isnull().all()]
+            for source_type, df_type in filtered_by_type.items()
+        }
+        value_cols = [col for cols in value_cols_by_type.values() for col in cols]
+        df_filtered = merge_on_date(filtered_by_type.values())
+
+        time_label = get_period_label(time_period_filter, start_date, end_date)
+        report_title_str = TREND_REPORT_TITLES.get(data_type, TREND_REPORT_TITLES['blood_sugar'])
+        if timings is not None:
+            timings['load'] = time.perf_counter() - started
 
-        trend_analysis_output_text = "AI趨勢分析未能生成。"
-        if api_key:
+        def plot_stage(_):
+            df_plot = df_reshaped if full_resolution else downsample_for_plotting(df_reshaped)
+            plot_title = f"{report_title_str} ({time_label})"
+            plotly_fig = None
+            plotly_data_string = "{}"
+            if plot_format != 'compact' or generate_pdf:
+                plotly_fig = build_plotly_figure(df_plot, data_type, plot_title)
+                plotly_data_string = "{}" if plotly_fig is None else plotly_fig.to_json()
+            plot_data_string = plotly_data_string
+            if plot_format == 'compact':
+                plot_data_string = json.dumps(build_compact_plot_payload(df_plot, data_type, plot_title), ensure_ascii=False)
+            if on_plot_ready:
+                on_plot_ready(plot_data_string)
+            return plotly_fig, plotly_data_string, plot_data_string
+
+        def analysis_stage(_):
+            report_progress('analyzing', '正在進行 AI 趨勢分析...')
+            provider = model_providers.get_model_provider()
+            if not provider.configured:
+                return "AI模型API金鑰未設定，無法執行AI趨勢分析。"
             try:
-                cols_to_show = ['Date'] + [col for col in cols_for_type if col in df_filtered.columns and not df_filtered[col].isnull().all()]
-                prompt_df_display = df_filtered[cols_to_show].copy()
-                prompt_df_display['Date'] = prompt_df_display['Date'].dt.strftime('%Y-%m-%d')
-                data_for_prompt = prompt_df_display.to_string(index=False, na_rep='無')
+                summary = None
+                if data_type == 'combined':
+                    summary = "\n".join(
+                        f"【{TREND_TYPE_NAMES[source_type]}】\n{summarize_for_prompt(df_type, source_type)}"
+                        for source_type, df_type in filtered_by_type.items()
+                    )
+                data_for_prompt = build_trend_prompt_data(df_filtered, data_type, value_cols, summary=summary)
                 
-                model = genai.GenerativeModel(gemini_model)
-                full_trend_prompt = f"{trend_prompt}\n以下是分析數據 ({time_label}):\n{data_for_prompt}"
-                response = model.generate_content(full_trend_prompt)
-                trend_analysis_output_text = response.text.strip()
+                full_trend_prompt = f"{trend_prompt}{TREND_PROMPT_NOTES.get(data_type, '')}\n以下是分析數據 ({time_label}):\n{data_for_prompt}"
+
+                streamed = []
+
+                def run_trend_model():
+                    if not on_text_chunk:
+                        response = provider.generative_model(gemini_model).generate_content(full_trend_prompt)
+                        return response.text.strip(), True
+                    for chunk in provider.generative_model(gemini_model).generate_content(full_trend_prompt, stream=True):
+                        if chunk.text:
+                            streamed.append(chunk.text)
+                            on_text_chunk(chunk.text)
+                    return ''.join(streamed).strip(), True
+
+                model_id = provider.cache_id(gemini_model)
+                cache_key = gemini_cache.make_cache_key(
+                    TREND_PROMPT_VERSION, model_id, data_type, period_key, full_trend_prompt
+                )
+                trend_analysis_output_text = gemini_cache.get_gemini_cache().get_or_compute(
+                    cache_key, run_trend_model, model=model_id, data_type=data_type, period=period_key
+                )
+                if on_text_chunk and not streamed:
+                    on_text_chunk(trend_analysis_output_text)
+                return trend_analysis_output_text
             except Exception as gemini_err:
-                trend_analysis_output_text = f"AI趨勢分析時發生錯誤: {gemini_err}"
-        else:
-            trend_analysis_output_text = "AI模型API金鑰未設定，無法執行AI趨勢分析。"
+                return f"AI趨勢分析時發生錯誤: {gemini_err}"
 
-        pdf_report_rel_static_path = None
-        pdf_filename = None
-        if generate_pdf:
-            trend_plot_base64 = generate_plot_base64_with_plotly(plotly_data_string)
-            
-            pdf_table_cols = ['Date'] + [col for col in cols_for_type if col in df_filtered.columns and not df_filtered[col].isnull().all()]
-            pdf_table_df_display = df_filtered[pdf_table_cols].copy()
+        def plot_image_stage(results):
+            report_progress('rendering_plot', '正在繪製趨勢圖...')
+            plotly_fig, plotly_data_string, _ = results['plot']
+            # 回傳 (圖片, 錯誤訊息)，輸出失敗時由 PDF 階段附上實際原因
+            try:
+                return generate_plot_base64_with_plotly(plotly_fig, plotly_data_string,
+                                                        height=TREND_PLOT_HEIGHTS.get(data_type, 500),
+                                                        raise_errors=True), None
+            except Exception as e:
+                return None, ' '.join(str(e).split())
+
+        def table_stage(_):
+            pdf_table_df_display = merge_on_date(
+                add_status_label_columns(df_type[['Date'] + value_cols_by_type[source_type]], df_type, source_type)
+                for source_type, df_type in filtered_by_type.items()
+            )
             pdf_table_df_display['Date'] = pdf_table_df_display['Date'].dt.strftime('%Y-%m-%d')
-            
-            if config and trend_plot_base64:
-                pdf_report_rel_static_path, pdf_filename = generate_trend_report_pdf(
-                    base_output_dir=base_output_dir, request_timestamp_str=analysis_timestamp_str,
-                    report_title=report_title_str, 
-                    time_period_label=time_label,
-                    time_period_key=time_period_filter,
-                    data_table_df=pdf_table_df_display, 
-                    trend_plot_base64_data=trend_plot_base64,
-                    trend_analysis_text=trend_analysis_output_text,
-                    data_type_for_filename=data_type 
-                )
-            else:
-                trend_analysis_output_text += "\n(PDF報告生成已跳過，因系統未配置PDF引擎或趨勢圖生成失敗)"
-        
-        return trend_analysis_output_text, pdf_report_rel_static_path, plotly_data_string, pdf_filename
+            return pdf_table_df_display
+
+        def pdf_stage(results):
+            trend_plot_base64, plot_error = results['plot_image']
+            if not config:
+                return None, None, f"\n{PDF_SKIPPED_NOTE_PREFIX}，因系統未配置PDF引擎 wkhtmltopdf)"
+            if not trend_plot_base64:
+                return None, None, f"\n{PDF_SKIPPED_NOTE_PREFIX}，因趨勢圖生成失敗: {plot_error or '沒有可繪製的數據'})"
+            report_progress('rendering_pdf', '正在產生 PDF 報告...')
+            pdf_report_rel_static_path, pdf_filename = generate_trend_report_pdf(
+                base_output_dir=base_output_dir, request_timestamp_str=analysis_timestamp_str,
+                report_title=report_title_str, 
+                time_period_label=time_label,
+                time_period_key=period_key,
+                data_table_df=results['table'], 
+                trend_plot_base64_data=trend_plot_base64,
+                trend_analysis_text=results['analysis'],
+                data_type_for_filename=data_type 
+            )
+            return pdf_report_rel_static_path, pdf_filename, ""
+
+        stages = {
+            'plot': ((), plot_stage),
+            'analysis': ((), analysis_stage),
+        }
+        if generate_pdf:
+            stages.update({
+                'plot_image': (('plot',), plot_image_stage),
+                'table': ((), table_stage),
+                'pdf': (('analysis', 'plot_image', 'table'), pdf_stage),
+            })
+        results = stage_graph.run_stage_graph(stages, timings=timings)
+
+        trend_analysis_output_text = results['analysis']
+        plot_data_string = results['plot'][2]
+        pdf_report_rel_static_path, pdf_filename, skipped_note = results.get('pdf', (None, None, ""))
+        return trend_analysis_output_text + skipped_note, pdf_report_rel_static_path, plot_data_string, pdf_filename
 
     except Exception as e:
         import traceback
         traceback.print_exc()
-        return f"趨勢分析主流程發生錯誤: {str(e)}", None, None, None
\ No newline at end of file
+        return f"趨勢分析主流程發生錯誤: {str(e)}", None, None, None
+    finally:
+        if timings is not None:
+            timings['total'] = time.perf_counter() - started
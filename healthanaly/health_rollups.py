@@ -0,0 +1,174 @@
+import os
+import json
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+import health_storage
+from auth import get_user_upload_folder
+from health_analysis import NORMAL_RANGES
+
+# 每種數據類型彙總的指標，以及一天內各時段的先後順序 (用於取得「最後一筆」)
+ROLLUP_METRICS = {
+    'blood_pressure': ['Systolic', 'Diastolic', 'Pulse'],
+    'blood_sugar': ['Fasting', 'Postprandial'],
+}
+TIME_SLOT_ORDER = {'Morning': 0, 'Noon': 1, 'Evening': 2}
+GRANULARITIES = ('day', 'week', 'month')
+
+def get_rollup_path(user_id, data_type):
+    return os.path.join(get_user_upload_folder(user_id), f"{data_type}_rollups.json")
+
+def _bucket_keys(dates: pd.Series, granularity: str) -> pd.Series:
+    if granularity == 'day':
+        return dates.dt.strftime('%Y-%m-%d')
+    if granularity == 'week':
+        iso = dates.dt.isocalendar()
+        return iso['year'].astype(str) + '-W' + iso['week'].astype(str).str.zfill(2)
+    if granularity == 'month':
+        return dates.dt.strftime('%Y-%m')
+    raise ValueError(f"無效的彙總粒度: {granularity}")
+
+def _bucket_range(date, granularity):
+    """回傳某日期所屬週 (ISO，週一起) 或月的起訖日。"""
+    if granularity == 'week':
+        start = date - timedelta(days=date.weekday())
+        return start, start + timedelta(days=6)
+    start = date.replace(day=1)
+    end = (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    return start, end
+
+# 每個 (bucket, 指標) 輸出的統計欄位，依序對應 groupby 的彙總結果
+ROLLUP_STAT_FIELDS = ('count', 'min', 'max', 'sum', 'last', 'out_of_range')
+
+def compute_rollups(df: pd.DataFrame, data_type: str, granularity: str) -> dict:
+    """以向量化方式將寬格式的每日紀錄彙總為 {bucket: {metric: 統計值}}。"""
+    metrics = ROLLUP_METRICS[data_type]
+    value_cols = [col for col in df.columns if col != 'Date' and col.split('_', 1)[1] in metrics]
+    if df.empty or not value_cols:
+        return {}
+
+    # bucket 在轉長格式前以每日一列計算，避免對每筆讀數重複轉換日期
+    wide = df[['Date'] + value_cols].reset_index(drop=True)
+    wide['Bucket'] = _bucket_keys(pd.to_datetime(wide['Date'], format='%Y-%m-%d'), granularity).to_numpy()
+    wide['Row'] = np.arange(len(wide))
+    long_df = wide.melt(id_vars=['Row', 'Bucket'], value_vars=value_cols, var_name='Column', value_name='Value')
+    long_df = long_df.dropna(subset=['Value'])
+    if long_df.empty:
+        return {}
+
+    # 欄位名稱只有少數幾種，以對照表一次轉換
+    slots = {col: TIME_SLOT_ORDER[col.split('_', 1)[0]] for col in value_cols}
+    metric_names = {col: col.split('_', 1)[1] for col in value_cols}
+    long_df['Metric'] = long_df['Column'].map(metric_names)
+    truncated = np.trunc(long_df['Value'].to_numpy())
+    low = long_df['Column'].map({col: NORMAL_RANGES[metric][0] for col, metric in metric_names.items()}).to_numpy()
+    high = long_df['Column'].map({col: NORMAL_RANGES[metric][1] for col, metric in metric_names.items()}).to_numpy()
+    long_df['OutOfRange'] = ((truncated < low) | (truncated > high)).astype(int)
+
+    # 依日期 (列序) 與時段排序，'last' 即為最後一筆讀數
+    order = long_df['Row'].to_numpy() * len(TIME_SLOT_ORDER) + long_df['Column'].map(slots).to_numpy()
+    long_df = long_df.iloc[np.argsort(order, kind='stable')]
+    stats = long_df.groupby(['Bucket', 'Metric']).agg(
+        count=('Value', 'size'),
+        min=('Value', 'min'),
+        max=('Value', 'max'),
+        sum=('Value', 'sum'),
+        last=('Value', 'last'),
+        out_of_range=('OutOfRange', 'sum'),
+    )
+
+    # 整欄轉為 Python 數值後再組成巢狀 dict，不逐列建立 Series
+    columns = [
+        stats['count'].astype('int64').tolist(),
+        stats['min'].astype(float).tolist(),
+        stats['max'].astype(float).tolist(),
+        stats['sum'].astype(float).tolist(),
+        stats['last'].astype(float).tolist(),
+        stats['out_of_range'].astype('int64').tolist(),
+    ]
+    rollups = {}
+    for (bucket, metric), *values in zip(stats.index.tolist(), *columns):
+        rollups.setdefault(bucket, {})[metric] = dict(zip(ROLLUP_STAT_FIELDS, values))
+    return rollups
+
+def _load_rollup_file(user_id, data_type):
+    path = get_rollup_path(user_id, data_type)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _save_rollup_file(user_id, data_type, rollups):
+    path = get_rollup_path(user_id, data_type)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(rollups, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def rebuild_rollups(user_id, data_type):
+    """從完整歷史重新計算週、月彙總並寫入檔案。"""
+    df = health_storage.get_health_store().load(user_id, data_type)
+    rollups = {granularity: compute_rollups(df, data_type, granularity) for granularity in ('week', 'month')}
+    _save_rollup_file(user_id, data_type, rollups)
+    return rollups
+
+def update_rollups(user_id, data_type, dates):
+    """儲存新紀錄後，只重新計算 dates 涵蓋的週與月。
+
+    一次讀取涵蓋所有受影響週/月的區間並彙總，再只替換受影響的 bucket；單筆儲存只讀取一週與一個月的資料，
+    批次匯入也只需一次彙總。呼叫端需持有該使用者的寫入鎖 (見 HealthWriteQueue.user_lock)。"""
+    rollups = _load_rollup_file(user_id, data_type)
+    if rollups is None:
+        return rebuild_rollups(user_id, data_type)
+
+    dates = pd.to_datetime(pd.Series(list(dates))).dropna()
+    if dates.empty:
+        return rollups
+    store = health_storage.get_health_store()
+    for granularity in ('week', 'month'):
+        buckets = rollups.setdefault(granularity, {})
+        touched = set(_bucket_keys(dates, granularity))
+        span_start, _ = _bucket_range(dates.min().date(), granularity)
+        _, span_end = _bucket_range(dates.max().date(), granularity)
+        recomputed = compute_rollups(store.load(user_id, data_type, span_start, span_end), data_type, granularity)
+        for bucket in touched:
+            if bucket in recomputed:
+                buckets[bucket] = recomputed[bucket]
+            else:
+                buckets.pop(bucket, None)
+    _save_rollup_file(user_id, data_type, rollups)
+    return rollups
+
+def get_rollups(user_id, data_type, granularity, start_date=None, end_date=None):
+    """回傳指定粒度的彙總 (依時間排序)，每個指標附上平均值。
+
+    週、月彙總直接讀取預先計算的檔案；日彙總只需讀取區間內的資料列。"""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"無效的彙總粒度: {granularity}")
+    start = None if start_date is None else pd.Timestamp(health_storage.normalize_date(start_date))
+    end = None if end_date is None else pd.Timestamp(health_storage.normalize_date(end_date))
+
+    if granularity == 'day':
+        df = health_storage.get_health_store().load(user_id, data_type, start_date, end_date)
+        buckets = compute_rollups(df, data_type, 'day')
+    else:
+        rollups = _load_rollup_file(user_id, data_type)
+        if rollups is None:
+            rollups = rebuild_rollups(user_id, data_type)
+        buckets = rollups.get(granularity, {})
+        # 以區間起訖日所在的週/月作為篩選邊界
+        low = None if start is None else _bucket_keys(pd.Series([start]), granularity).iloc[0]
+        high = None if end is None else _bucket_keys(pd.Series([end]), granularity).iloc[0]
+        buckets = {key: value for key, value in buckets.items()
+                   if (low is None or key >= low) and (high is None or key <= high)}
+
+    result = []
+    for bucket in sorted(buckets):
+        metrics = {}
+        for metric, stats in buckets[bucket].items():
+            metrics[metric] = dict(stats, mean=round(stats['sum'] / stats['count'], 1) if stats['count'] else None)
+        result.append({'period': bucket, 'metrics': metrics})
+    return result
@@ -0,0 +1,763 @@
+import os
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+import numpy as np
+
+from auth import get_user_upload_folder
+
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# --- 健康數據欄位定義 ---
+HEALTH_DATA_COLUMNS = {
+    'blood_pressure': ['Date', 'Morning_Systolic', 'Morning_Diastolic', 'Morning_Pulse',
+                       'Noon_Systolic', 'Noon_Diastolic', 'Noon_Pulse',
+                       'Evening_Systolic', 'Evening_Diastolic', 'Evening_Pulse'],
+    'blood_sugar': ['Date', 'Morning_Fasting', 'Morning_Postprandial',
+                    'Noon_Fasting', 'Noon_Postprandial',
+                    'Evening_Fasting', 'Evening_Postprandial'],
+}
+# 寫入時一併儲存的狀態代碼欄位 (代碼定義見 health_analysis 的 BP_STATUS_TABLE 等)，0 代表該時段無數據
+HEALTH_STATUS_COLUMNS = {
+    'blood_pressure': ['Morning_BP_Status', 'Morning_Pulse_Status',
+                       'Noon_BP_Status', 'Noon_Pulse_Status',
+                       'Evening_BP_Status', 'Evening_Pulse_Status'],
+    'blood_sugar': ['Morning_Fasting_Status', 'Morning_Postprandial_Status',
+                    'Noon_Fasting_Status', 'Noon_Postprandial_Status',
+                    'Evening_Fasting_Status', 'Evening_Postprandial_Status'],
+}
+
+# 追加日誌累積到此筆數時，於背景合併回排序後的主 CSV
+LOG_COMPACT_THRESHOLD = int(os.getenv('HEALTH_LOG_COMPACT_THRESHOLD', '200'))
+# 即使筆數未達門檻，日誌存在超過此秒數也會被合併
+LOG_COMPACT_INTERVAL_SECONDS = float(os.getenv('HEALTH_LOG_COMPACT_INTERVAL', '300'))
+# 已解析 DataFrame 快取的記憶體上限 (bytes)
+FRAME_CACHE_MAX_BYTES = int(os.getenv('HEALTH_FRAME_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# 儲存後端：'csv' (預設，static/users/<id>/*.csv) 或 'sqlite'
+HEALTH_STORAGE_BACKEND = os.getenv('HEALTH_STORAGE_BACKEND', 'csv').lower()
+HEALTH_DB_PATH = os.getenv('HEALTH_DB_PATH', os.path.join('instance', 'health.db'))
+# 儲存層回傳的 DataFrame 以此 attrs 標記「Date 為已排序的 YYYY-MM-DD 字串」，下游可直接二分搜尋而不必再檢查整欄
+DATES_SORTED_ATTR = 'health_dates_sorted'
+
+def get_health_columns(data_type):
+    if data_type not in HEALTH_DATA_COLUMNS:
+        raise ValueError("Invalid data_type specified")
+    return HEALTH_DATA_COLUMNS[data_type]
+
+def get_storage_columns(data_type):
+    """實際儲存的欄位：數值欄位加上狀態代碼欄位。"""
+    return get_health_columns(data_type) + HEALTH_STATUS_COLUMNS[data_type]
+
+def is_status_column(col):
+    return col.endswith('_Status')
+
+def get_health_csv_path(user_id, data_type):
+    get_health_columns(data_type)
+    return os.path.join(get_user_upload_folder(user_id), f"{data_type}.csv")
+
+def get_log_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.log'
+
+def _get_compacting_path(csv_path):
+    return get_log_path(csv_path) + '.compacting'
+
+def has_health_data(csv_path):
+    return any(os.path.exists(p) for p in (csv_path, get_log_path(csv_path), _get_compacting_path(csv_path)))
+
+def normalize_date(date):
+    if isinstance(date, str):
+        try:
+            # 表單送出的日期多為 YYYY-MM-DD，先走較快的解析路徑
+            return datetime.strptime(date, '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    parsed = pd.to_datetime(date, errors='coerce')
+    if pd.isna(parsed):
+        raise ValueError(f"無效的日期: {date}")
+    return parsed.strftime('%Y-%m-%d')
+
+# --- 每個檔案的鎖 ---
+# append_lock: 保護日誌的追加與輪替；compact_lock: 保證同一檔案同時只有一個合併程序
+# 兩者皆由「執行緒鎖 + 檔案鎖」組成，讓多個 gunicorn worker 之間也能互斥
+_locks_guard = threading.Lock()
+_append_locks = {}
+_compact_locks = {}
+
+def _get_lock(registry, csv_path):
+    key = os.path.abspath(csv_path)
+    with _locks_guard:
+        if key not in registry:
+            registry[key] = threading.Lock()
+        return registry[key]
+
+@contextmanager
+def file_lock(lock_path, shared=False):
+    """跨行程的檔案鎖 (POSIX 使用 flock，Windows 使用 msvcrt)。
+
+    shared 為 True 時取得共享鎖，多個讀取者可同時持有；msvcrt 沒有共享鎖，Windows 上一律為獨占鎖。"""
+    with open(lock_path, 'a+b') as f:
+        if os.name == 'nt':
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+@contextmanager
+def _append_lock(csv_path):
+    with _get_lock(_append_locks, csv_path), file_lock(f"{csv_path}.lock"):
+        yield
+
+@contextmanager
+def _read_lock(csv_path):
+    # 與 append_lock 使用同一個鎖檔；flock 以開啟的檔案為單位，同一行程的不同執行緒之間也互斥
+    with file_lock(f"{csv_path}.lock", shared=True):
+        yield
+
+@contextmanager
+def _compact_lock(csv_path):
+    with _get_lock(_compact_locks, csv_path), file_lock(f"{csv_path}.compact.lock"):
+        yield
+
+# --- 讀取 ---
+def _column_dtype(col):
+    if col == 'Date':
+        return 'object'
+    # 狀態代碼以可為空的小整數儲存，尚未回填的舊資料為 <NA>
+    return 'Int8' if is_status_column(col) else 'float64'
+
+def _empty_frame(columns):
+    df = pd.DataFrame({col: pd.Series(dtype=_column_dtype(col)) for col in columns})
+    df.attrs[DATES_SORTED_ATTR] = True
+    return df
+
+def _read_canonical_csv(csv_path, columns):
+    if not os.path.exists(csv_path):
+        return _empty_frame(columns)
+    df = pd.read_csv(csv_path, encoding='utf-8-sig')
+    if df.empty:
+        return _empty_frame(columns)
+    df['Date'] = pd.to_datetime(df['Date']).dt.strftime('%Y-%m-%d')
+    return df
+
+def _read_log_records(log_path):
+    records = []
+    if not os.path.exists(log_path):
+        return records
+    with open(log_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                # 可能是正在寫入中的最後一行，略過即可
+                print(f"略過無法解析的日誌紀錄: {log_path}")
+    return records
+
+def _apply_log_records(df, records, columns):
+    if records:
+        df = df.set_index('Date')
+        for record in records:
+            date = record.get('Date')
+            if not date:
+                continue
+            for key, value in record.items():
+                if key != 'Date' and key in columns:
+                    df.loc[date, key] = np.nan if value is None else value
+        df.index.name = 'Date'
+        df = df.reset_index()
+    return _finalize_frame(df, columns)
+
+def _finalize_frame(df, columns):
+    for col in columns:
+        if col not in df.columns:
+            df[col] = np.nan
+            df[col] = df[col].astype(_column_dtype(col))
+        elif col != 'Date':
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype(_column_dtype(col))
+    df = df[columns].sort_values(by='Date').reset_index(drop=True)
+    df.attrs[DATES_SORTED_ATTR] = True
+    return df
+
+def _file_signature(csv_path):
+    signature = []
+    for path in (csv_path, _get_compacting_path(csv_path), get_log_path(csv_path)):
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+class _FrameCache:
+    """以 LRU 方式保存已解析的 DataFrame，每個 (user_id, data_type) 對應一個 CSV 路徑。
+    以主 CSV 與日誌檔的 mtime/size 判斷是否過期，本行程的寫入也會主動使其失效。"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, signature):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def peek(self, key, signature):
+        # 供寫入端使用，不計入命中統計
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None and entry[0] == signature else None
+
+    def put(self, key, signature, df):
+        # 同時保存排序後的日期陣列，供單日查詢以二分搜尋定位
+        dates = df['Date'].to_numpy(dtype='U10')
+        size = int(df.memory_usage(index=True, deep=True).sum()) + dates.nbytes
+        with self._lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (signature, (df, dates), size)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._pop(oldest)
+                self.evictions += 1
+
+    def replace(self, key, old_signature, new_signature, frame, added_bytes=0):
+        # 寫入端已就地更新或插入一列：沿用原項目的大小估計，不重新計算整個 DataFrame 的記憶體用量
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != old_signature:
+                return False
+            size = entry[2] + added_bytes
+            self._entries[key] = (new_signature, frame, size)
+            self._total_bytes += added_bytes
+            self._entries.move_to_end(key)
+            return True
+
+    def resign(self, key, old_signature, new_signature):
+        # 檔案變動但內容不變 (例如日誌合併) 時，沿用原本的快取項目
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == old_signature:
+                self._entries[key] = (new_signature,) + entry[1:]
+                return True
+            return False
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._pop(key):
+                self.invalidations += 1
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._total_bytes -= entry[2]
+        return True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+_frame_cache = _FrameCache(FRAME_CACHE_MAX_BYTES)
+
+def get_cache_stats():
+    return _frame_cache.stats()
+
+def _load_frame(csv_path, data_type):
+    columns = get_storage_columns(data_type)
+    key = os.path.abspath(csv_path)
+    # 命中快取時不取鎖：寫入端在鎖中先改檔案再更新快取，檔案簽章一變就不會再命中舊的項目
+    cached = _frame_cache.get(key, _file_signature(csv_path))
+    if cached is not None:
+        return cached
+    with _read_lock(csv_path):
+        signature = _file_signature(csv_path)
+        # 等鎖期間可能已有其他執行緒讀取完成
+        cached = _frame_cache.peek(key, signature)
+        if cached is not None:
+            return cached
+        df = _read_canonical_csv(csv_path, columns)
+        records = _read_log_records(_get_compacting_path(csv_path)) + _read_log_records(get_log_path(csv_path))
+    df = _apply_log_records(df, records, columns)
+    _frame_cache.put(key, signature, df)
+    return df, df['Date'].to_numpy(dtype='U10')
+
+def read_health_csv(csv_path, data_type):
+    """讀取主 CSV，並依序套用尚未合併的日誌紀錄。回傳的 Date 欄位為 'YYYY-MM-DD' 字串。"""
+    df, _ = _load_frame(csv_path, data_type)
+    return df.copy()
+
+def lookup_health_row(csv_path, date, data_type):
+    """以排序後的日期陣列二分搜尋單日紀錄，回傳 {欄位: 值} 或 None。"""
+    if not has_health_data(csv_path):
+        return None
+    date_str = normalize_date(date)
+    df, dates = _load_frame(csv_path, data_type)
+    pos = int(np.searchsorted(dates, date_str))
+    if pos >= len(dates) or dates[pos] != date_str:
+        return None
+    return df.iloc[pos].to_dict()
+
+# --- 寫入 ---
+# 日誌路徑 -> (inode, 大小, 行數)：本行程最後一次追加後看到的日誌狀態
+_log_line_counts = {}
+
+def _record_value(col, numeric_value):
+    if pd.isna(numeric_value):
+        return None
+    return int(numeric_value) if is_status_column(col) else float(numeric_value)
+
+def _count_log_lines(log_path):
+    if not os.path.exists(log_path):
+        return 0
+    with open(log_path, 'rb') as f:
+        return sum(1 for _ in f)
+
+def _log_state(log_path):
+    try:
+        stat = os.stat(log_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size
+
+def _pending_log_lines(log_path):
+    """在 append_lock 中呼叫，回傳日誌目前的行數 (等待合併的紀錄數)。
+
+    日誌與本行程上次追加後相同時沿用記錄的行數；其他 worker 追加或合併過 (inode 或大小改變) 時重新計算，
+    日誌最多約 LOG_COMPACT_THRESHOLD 行，重新計算的成本很低。"""
+    state = _log_state(log_path)
+    if state is None:
+        return 0
+    known = _log_line_counts.get(log_path)
+    if known is not None and known[:2] == state:
+        return known[2]
+    return _count_log_lines(log_path)
+
+def _upsert_cached_frame(cached, record, columns):
+    """將一筆紀錄套用到快取中已排序的 (df, dates)，回傳 (新的 (df, dates), 增加的 bytes)。
+
+    日期已存在時就地更新該列；不存在時在 searchsorted 的位置插入一列，兩者都不重新排序或轉型整個 DataFrame。"""
+    df, dates = cached
+    date = record['Date']
+    pos = int(np.searchsorted(dates, date))
+    if pos < len(dates) and dates[pos] == date:
+        for col, value in record.items():
+            if col != 'Date':
+                df.iloc[pos, df.columns.get_loc(col)] = np.nan if value is None else value
+        return (df, dates), 0
+    dtypes = df.dtypes
+    row = pd.DataFrame({col: pd.array([record.get(col)], dtype=dtypes[col]) for col in columns})
+    # 新日期多半是最新的一天，插在最後時只需串接兩段
+    pieces = [df.iloc[:pos], row] if pos == len(df) else [df.iloc[:pos], row, df.iloc[pos:]]
+    df = pd.concat(pieces, ignore_index=True)
+    df.attrs[DATES_SORTED_ATTR] = True
+    dates = np.insert(dates, pos, date)
+    return (df, dates), int(row.memory_usage(index=False, deep=True).sum()) + dates.itemsize
+
+def append_health_record(csv_path, date, data_dict, data_type):
+    """以追加方式記錄一筆更新 (upsert)，不論歷史長度皆為 O(1) 的 I/O。"""
+    columns = get_storage_columns(data_type)
+    record = {'Date': normalize_date(date)}
+    for key, value in data_dict.items():
+        if key not in columns or key == 'Date':
+            continue
+        numeric_value = pd.to_numeric(value, errors='coerce')
+        record[key] = _record_value(key, numeric_value)
+
+    log_path = get_log_path(csv_path)
+    key = os.path.abspath(csv_path)
+    with _append_lock(csv_path):
+        pending = _pending_log_lines(log_path) + 1
+        signature_before = _file_signature(csv_path)
+        cached = _frame_cache.peek(key, signature_before)
+        with open(log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        _log_line_counts[log_path] = _log_state(log_path) + (pending,)
+        # 快取仍有效時直接套用這筆更新，讓日期索引與寫入保持同步而不必重新解析整個檔案；否則由下次讀取合併日誌
+        updated = False
+        if cached is not None:
+            frame, added_bytes = _upsert_cached_frame(cached, record, columns)
+            updated = _frame_cache.replace(key, signature_before, _file_signature(csv_path), frame, added_bytes)
+        if not updated:
+            _frame_cache.invalidate(key)
+
+    _compactor.mark_dirty(csv_path, data_type, urgent=pending >= LOG_COMPACT_THRESHOLD)
+    return record
+
+def _write_canonical_csv(csv_path, df):
+    tmp_path = f"{csv_path}.tmp"
+    df.to_csv(tmp_path, index=False, encoding='utf-8-sig')
+    os.replace(tmp_path, csv_path)
+
+def compact_health_log(csv_path, data_type):
+    """將日誌合併回排序後的主 CSV。先輪替日誌，合併期間新的寫入不受阻擋。"""
+    columns = get_storage_columns(data_type)
+    log_path = get_log_path(csv_path)
+    compacting_path = _get_compacting_path(csv_path)
+    key = os.path.abspath(csv_path)
+
+    with _compact_lock(csv_path):
+        with _append_lock(csv_path):
+            # 若上次合併中斷，殘留的 .compacting 檔需先處理完，再輪替新的日誌
+            if not os.path.exists(compacting_path) and os.path.exists(log_path):
+                os.replace(log_path, compacting_path)
+        if not os.path.exists(compacting_path):
+            return False
+
+        df = _apply_log_records(_read_canonical_csv(csv_path, columns), _read_log_records(compacting_path), columns)
+        with _append_lock(csv_path):
+            signature_before = _file_signature(csv_path)
+            _write_canonical_csv(csv_path, df)
+            os.remove(compacting_path)
+            _frame_cache.resign(key, signature_before, _file_signature(csv_path))
+    return True
+
+# --- 批次匯入 ---
+# 匯入時的合理數值範圍，超出者視為輸入錯誤
+IMPORT_VALUE_LIMITS = {
+    'Systolic': (40, 300), 'Diastolic': (20, 200), 'Pulse': (20, 250),
+    'Fasting': (10, 800), 'Postprandial': (10, 800),
+}
+
+def coerce_health_rows(raw_df, data_type):
+    """以向量化方式驗證並轉換批次匯入的資料列。
+
+    回傳 (有效資料, 拒絕清單, 忽略的欄位)。欄位名稱不分大小寫，亦接受表單欄位名稱
+    (例如 morning_systolic)。拒絕清單中的 row 為從 1 起算的原始列號。"""
+    columns = get_health_columns(data_type)
+    name_map = {col.lower(): col for col in columns}
+    rename = {}
+    ignored_columns = []
+    for raw_col in raw_df.columns:
+        canonical = name_map.get(str(raw_col).strip().lower())
+        if canonical and canonical not in rename.values():
+            rename[raw_col] = canonical
+        else:
+            ignored_columns.append(str(raw_col))
+    if 'Date' not in rename.values():
+        raise ValueError("匯入資料缺少 'Date' 欄位。")
+    df = raw_df[list(rename)].rename(columns=rename)
+    value_cols = [col for col in columns if col != 'Date' and col in df.columns]
+    if not value_cols:
+        raise ValueError("匯入資料中沒有可辨識的數值欄位。")
+
+    reasons = pd.Series('', index=df.index, dtype=object)
+
+    raw_dates = df['Date'].astype(str).str.strip()
+    dates = pd.to_datetime(raw_dates, format='%Y-%m-%d', errors='coerce')
+    retry = dates.isna() & df['Date'].notna()
+    if retry.any():
+        dates[retry] = pd.to_datetime(raw_dates[retry], format='mixed', errors='coerce')
+    reasons[dates.isna()] += '日期無效; '
+
+    raw_values = df[value_cols]
+    provided = raw_values.notna() & (raw_values.astype(str).apply(lambda col: col.str.strip()) != '')
+    values = raw_values.apply(pd.to_numeric, errors='coerce')
+    not_numeric = provided & values.isna()
+    low = pd.Series({col: IMPORT_VALUE_LIMITS[col.split('_', 1)[1]][0] for col in value_cols})
+    high = pd.Series({col: IMPORT_VALUE_LIMITS[col.split('_', 1)[1]][1] for col in value_cols})
+    out_of_range = values.notna() & ((values < low) | (values > high))
+
+    for mask, label in ((not_numeric, '非數值'), (out_of_range, '超出合理範圍')):
+        bad_rows = mask.any(axis=1)
+        if bad_rows.any():
+            bad_cols = mask[bad_rows].apply(lambda row: ', '.join(row.index[row]), axis=1)
+            reasons[bad_rows] += label + ': ' + bad_cols + '; '
+    reasons[(~provided).all(axis=1)] += '無任何數值; '
+
+    rejected_mask = reasons != ''
+    rejects = [
+        {'row': int(pos) + 1, 'date': None if pd.isna(raw) else str(raw), 'reason': reason.rstrip('; ')}
+        for pos, raw, reason in zip(np.flatnonzero(rejected_mask.to_numpy()), df['Date'][rejected_mask], reasons[rejected_mask])
+    ]
+
+    valid = values[~rejected_mask].copy()
+    valid.insert(0, 'Date', dates[~rejected_mask].dt.strftime('%Y-%m-%d'))
+    # 同一日期出現多次時，以較後面的資料為準
+    valid = valid.groupby('Date', sort=True).last().reset_index()
+    return valid, rejects, ignored_columns
+
+def bulk_upsert_health_frame(csv_path, rows_df, data_type):
+    """將已驗證的多筆資料一次合併進既有數據並寫回主 CSV。
+
+    匯入資料中的非空值會覆蓋同日期同欄位的舊值，空值則保留原本的數值。"""
+    columns = get_storage_columns(data_type)
+    log_path = get_log_path(csv_path)
+    compacting_path = _get_compacting_path(csv_path)
+    key = os.path.abspath(csv_path)
+
+    with _compact_lock(csv_path), _append_lock(csv_path):
+        records = _read_log_records(compacting_path) + _read_log_records(log_path)
+        existing = _apply_log_records(_read_canonical_csv(csv_path, columns), records, columns)
+        merged = rows_df.set_index('Date').combine_first(existing.set_index('Date'))
+        merged.index.name = 'Date'
+        merged = _finalize_frame(merged.reset_index(), columns)
+        _write_canonical_csv(csv_path, merged)
+        for path in (compacting_path, log_path):
+            if os.path.exists(path):
+                os.remove(path)
+        _frame_cache.put(key, _file_signature(csv_path), merged)
+    return merged
+
+# --- 背景合併 ---
+class _LogCompactor:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._dirty = {}
+        self._urgent = set()
+        self._thread = None
+
+    def mark_dirty(self, csv_path, data_type, urgent=False):
+        key = os.path.abspath(csv_path)
+        with self._cond:
+            self._dirty.setdefault(key, data_type)
+            if urgent:
+                self._urgent.add(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='health-log-compactor', daemon=True)
+                self._thread.start()
+            if urgent:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._urgent:
+                    self._cond.wait(timeout=LOG_COMPACT_INTERVAL_SECONDS)
+                if self._urgent:
+                    targets = {key: self._dirty.pop(key) for key in self._urgent if key in self._dirty}
+                else:
+                    targets, self._dirty = self._dirty, {}
+                self._urgent = set()
+            for csv_path, data_type in targets.items():
+                try:
+                    compact_health_log(csv_path, data_type)
+                except Exception as e:
+                    print(f"合併健康數據日誌 {csv_path} 時發生錯誤: {e}")
+
+_compactor = _LogCompactor()
+
+# --- 儲存後端 ---
+def _date_bound(date):
+    return None if date is None else normalize_date(date)
+
+class CsvHealthStore:
+    """以每位使用者資料夾中的 CSV (加上追加日誌) 儲存健康數據。"""
+    name = 'csv'
+
+    def has_data(self, user_id, data_type):
+        return has_health_data(get_health_csv_path(user_id, data_type))
+
+    def load(self, user_id, data_type, start_date=None, end_date=None):
+        csv_path = get_health_csv_path(user_id, data_type)
+        if not has_health_data(csv_path):
+            return _empty_frame(get_storage_columns(data_type))
+        df, dates = _load_frame(csv_path, data_type)
+        start, end = _date_bound(start_date), _date_bound(end_date)
+        lo = 0 if start is None else int(np.searchsorted(dates, start, side='left'))
+        hi = len(dates) if end is None else int(np.searchsorted(dates, end, side='right'))
+        return df.iloc[lo:hi].reset_index(drop=True).copy()
+
+    def lookup(self, user_id, data_type, date):
+        return lookup_health_row(get_health_csv_path(user_id, data_type), date, data_type)
+
+    def upsert(self, user_id, date, data_dict, data_type):
+        return append_health_record(get_health_csv_path(user_id, data_type), date, data_dict, data_type)
+
+    def bulk_upsert(self, user_id, rows_df, data_type):
+        bulk_upsert_health_frame(get_health_csv_path(user_id, data_type), rows_df, data_type)
+
+class SqliteHealthStore:
+    """以 SQLite (WAL 模式) 儲存健康數據，主鍵 (user_id, date) 同時作為範圍查詢的索引。"""
+    name = 'sqlite'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            for data_type in HEALTH_DATA_COLUMNS:
+                value_defs = ', '.join(f'{col} {self._sql_type(col)}' for col in self._value_columns(data_type))
+                conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {data_type} ('
+                    f'user_id TEXT NOT NULL, date TEXT NOT NULL, {value_defs}, '
+                    f'PRIMARY KEY (user_id, date)) WITHOUT ROWID'
+                )
+                # 舊版資料庫沒有狀態代碼欄位，補上後以 manage.py backfill-status 回填
+                existing = {row[1] for row in conn.execute(f'PRAGMA table_info({data_type})')}
+                for col in self._value_columns(data_type):
+                    if col not in existing:
+                        conn.execute(f'ALTER TABLE {data_type} ADD COLUMN {col} {self._sql_type(col)}')
+
+    def _connect(self):
+        # 每個執行緒各自持有一條連線；WAL 模式允許多個讀取者與一個寫入者同時運作
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _value_columns(data_type):
+        return [col for col in get_storage_columns(data_type) if col != 'Date']
+
+    @staticmethod
+    def _sql_type(col):
+        return 'INTEGER' if is_status_column(col) else 'REAL'
+
+    def has_data(self, user_id, data_type):
+        get_health_columns(data_type)
+        row = self._connect().execute(
+            f'SELECT 1 FROM {data_type} WHERE user_id = ? LIMIT 1', (str(user_id),)
+        ).fetchone()
+        return row is not None
+
+    def load(self, user_id, data_type, start_date=None, end_date=None):
+        value_cols = self._value_columns(data_type)
+        sql = f'SELECT date AS Date, {", ".join(value_cols)} FROM {data_type} WHERE user_id = ?'
+        params = [str(user_id)]
+        if start_date is not None:
+            sql += ' AND date >= ?'
+            params.append(normalize_date(start_date))
+        if end_date is not None:
+            sql += ' AND date <= ?'
+            params.append(normalize_date(end_date))
+        sql += ' ORDER BY date'
+        df = pd.read_sql_query(sql, self._connect(), params=params)
+        return _finalize_frame(df, get_storage_columns(data_type))
+
+    def lookup(self, user_id, data_type, date):
+        value_cols = self._value_columns(data_type)
+        date_str = normalize_date(date)
+        row = self._connect().execute(
+            f'SELECT {", ".join(value_cols)} FROM {data_type} WHERE user_id = ? AND date = ?',
+            (str(user_id), date_str)
+        ).fetchone()
+        if row is None:
+            return None
+        result = {'Date': date_str}
+        result.update({col: np.nan if value is None else value for col, value in zip(value_cols, row)})
+        return result
+
+    def upsert(self, user_id, date, data_dict, data_type):
+        columns = get_storage_columns(data_type)
+        record = {'Date': normalize_date(date)}
+        for key, value in data_dict.items():
+            if key in columns and key != 'Date':
+                numeric_value = pd.to_numeric(value, errors='coerce')
+                record[key] = _record_value(key, numeric_value)
+        keys = [key for key in record if key != 'Date']
+        insert_cols = ', '.join(['user_id', 'date'] + keys)
+        placeholders = ', '.join('?' for _ in range(len(keys) + 2))
+        on_conflict = 'DO UPDATE SET ' + ', '.join(f'{key} = excluded.{key}' for key in keys) if keys else 'DO NOTHING'
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                f'INSERT INTO {data_type} ({insert_cols}) VALUES ({placeholders}) '
+                f'ON CONFLICT (user_id, date) {on_conflict}',
+                [str(user_id), record['Date']] + [record[key] for key in keys]
+            )
+        return record
+
+    def bulk_upsert(self, user_id, rows_df, data_type):
+        value_cols = [col for col in self._value_columns(data_type) if col in rows_df.columns]
+        insert_cols = ', '.join(['user_id', 'date'] + value_cols)
+        placeholders = ', '.join('?' for _ in range(len(value_cols) + 2))
+        # 與 CSV 後端一致：匯入的空值不覆蓋既有數值
+        updates = ', '.join(f'{col} = COALESCE(excluded.{col}, {data_type}.{col})' for col in value_cols)
+        values = rows_df[value_cols].astype(object).where(rows_df[value_cols].notna(), None)
+        rows = [
+            [str(user_id), date] + list(vals)
+            for date, vals in zip(rows_df['Date'], values.itertuples(index=False, name=None))
+        ]
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                f'INSERT INTO {data_type} ({insert_cols}) VALUES ({placeholders}) '
+                f'ON CONFLICT (user_id, date) DO UPDATE SET {updates}',
+                rows
+            )
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_health_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            if HEALTH_STORAGE_BACKEND == 'sqlite':
+                _store = SqliteHealthStore(HEALTH_DB_PATH)
+            elif HEALTH_STORAGE_BACKEND == 'csv':
+                _store = CsvHealthStore()
+            else:
+                raise ValueError(f"未知的儲存後端: {HEALTH_STORAGE_BACKEND}")
+        return _store
+
+def migrate_csv_to_sqlite(users_dir, db_path):
+    """將 users_dir 底下每個使用者資料夾的 CSV (含尚未合併的日誌) 匯入 SQLite，可重複執行。"""
+    sqlite_store = SqliteHealthStore(db_path)
+    summary = []
+    if not os.path.isdir(users_dir):
+        return summary
+    for user_id in sorted(os.listdir(users_dir)):
+        if not os.path.isdir(os.path.join(users_dir, user_id)):
+            continue
+        for data_type in HEALTH_DATA_COLUMNS:
+            csv_path = os.path.join(users_dir, user_id, f"{data_type}.csv")
+            if not has_health_data(csv_path):
+                continue
+            df = read_health_csv(csv_path, data_type)
+            if not df.empty:
+                sqlite_store.bulk_upsert(user_id, df, data_type)
+            summary.append((user_id, data_type, len(df)))
+    return summary
@@ -0,0 +1,137 @@
+import os
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import pandas as pd
+
+import health_storage
+import health_rollups
+import health_analysis
+from auth import get_user_upload_folder
+
+# 同一使用者在此時間窗內的多次儲存會合併為一次寫入與一次通知
+WRITE_COALESCE_SECONDS = float(os.getenv('HEALTH_WRITE_COALESCE_SECONDS', '0.3'))
+
+def refresh_rollups(user_id, updated_keys):
+    """更新受影響日期的週/月彙總；失敗時刪除彙總檔，讓下次讀取時完整重建。"""
+    dates_by_type = {}
+    for data_type, record_date in updated_keys:
+        dates_by_type.setdefault(data_type, set()).add(record_date)
+    for data_type, dates in dates_by_type.items():
+        try:
+            health_rollups.update_rollups(user_id, data_type, dates)
+        except Exception as e:
+            print(f"更新 {user_id} 的 {data_type} 彙總時發生錯誤: {e}")
+            rollup_path = health_rollups.get_rollup_path(user_id, data_type)
+            if os.path.exists(rollup_path):
+                os.remove(rollup_path)
+
+def with_status_codes(store, user_id, data_type, record_date, data_dict):
+    """以既有紀錄套用這次的更新後計算該日各時段的狀態代碼，回傳附上狀態欄位的更新內容。"""
+    value_cols = health_storage.get_health_columns(data_type)[1:]
+    existing = store.lookup(user_id, data_type, record_date) or {}
+    row = {col: existing.get(col) for col in value_cols}
+    row.update({key: value for key, value in data_dict.items() if key in row})
+    statuses = health_analysis.classify_health_frame(pd.DataFrame([row]), data_type).iloc[0]
+    return dict(data_dict, **{col: int(code) for col, code in statuses.items()})
+
+def attach_status_codes(store, user_id, data_type, rows_df):
+    """批次匯入用：依匯入後的實際數值 (空值沿用既有數值) 為每一列附上狀態代碼。"""
+    value_cols = health_storage.get_health_columns(data_type)[1:]
+    if rows_df.empty:
+        return rows_df
+    existing = store.load(user_id, data_type, rows_df['Date'].min(), rows_df['Date'].max())
+    merged = rows_df.set_index('Date').combine_first(existing.set_index('Date')[value_cols])
+    merged = merged.reindex(rows_df['Date'])[value_cols].reset_index()
+    statuses = health_analysis.classify_health_frame(merged, data_type)
+    return pd.concat([rows_df.reset_index(drop=True), statuses.drop(columns='Date')], axis=1)
+
+def backfill_status_codes(store, user_id, data_type):
+    """為尚未儲存狀態代碼 (或代碼與數值不一致) 的舊紀錄補上代碼，回傳更新的天數。
+
+    呼叫端需持有該使用者的寫入鎖 (見 HealthWriteQueue.user_lock)。"""
+    df = store.load(user_id, data_type)
+    if df.empty:
+        return 0
+    status_cols = health_storage.HEALTH_STATUS_COLUMNS[data_type]
+    statuses = health_analysis.classify_health_frame(df, data_type)
+    stale = (df[status_cols].isna() | (df[status_cols].fillna(-1).to_numpy() != statuses[status_cols].to_numpy())).any(axis=1)
+    if stale.any():
+        store.bulk_upsert(user_id, statuses[stale.to_numpy()], data_type)
+    return int(stale.sum())
+
+class HealthWriteQueue:
+    """每位使用者一條寫入佇列。
+
+    短時間內連續送出的早/午/晚數值 (或照護者同時編輯) 會先累積在佇列中，
+    時間窗結束後在使用者層級的鎖 (執行緒鎖 + 檔案鎖) 保護下一次寫入，
+    並只呼叫一次 on_flush 以送出合併後的通知。"""
+
+    def __init__(self, window_seconds=WRITE_COALESCE_SECONDS, on_flush=None):
+        self.window_seconds = window_seconds
+        self.on_flush = on_flush
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._user_locks = {}
+
+    def submit(self, user_id, date, data_dict, data_type):
+        """排入一筆更新，回傳在實際寫入完成後才會有結果的 Future。"""
+        health_storage.get_health_columns(data_type)
+        record_date = health_storage.normalize_date(date)
+        future = Future()
+        user_id = str(user_id)
+        with self._lock:
+            batch = self._pending.get(user_id)
+            if batch is None:
+                batch = self._pending[user_id] = []
+                timer = threading.Timer(self.window_seconds, self.flush, args=(user_id,))
+                timer.daemon = True
+                timer.start()
+            batch.append((data_type, record_date, dict(data_dict), future))
+        return future
+
+    def _get_user_lock(self, user_id):
+        with self._lock:
+            if user_id not in self._user_locks:
+                self._user_locks[user_id] = threading.Lock()
+            return self._user_locks[user_id]
+
+    @contextmanager
+    def user_lock(self, user_id):
+        """使用者層級的寫入鎖，批次匯入等不經過佇列的寫入也應持有此鎖。"""
+        user_id = str(user_id)
+        lock_path = os.path.join(get_user_upload_folder(user_id), '.health_write.lock')
+        with self._get_user_lock(user_id), health_storage.file_lock(lock_path):
+            yield
+
+    def flush(self, user_id):
+        with self._lock:
+            batch = self._pending.pop(user_id, [])
+        if not batch:
+            return
+
+        # 相同 (數據類型, 日期) 的更新依送出順序合併，後到的欄位覆蓋先到的
+        merged = {}
+        for data_type, record_date, data_dict, _ in batch:
+            merged.setdefault((data_type, record_date), {}).update(data_dict)
+
+        try:
+            with self.user_lock(user_id):
+                store = health_storage.get_health_store()
+                for (data_type, record_date), data_dict in merged.items():
+                    data_dict = with_status_codes(store, user_id, data_type, record_date, data_dict)
+                    store.upsert(user_id, record_date, data_dict, data_type)
+                refresh_rollups(user_id, merged)
+        except Exception as e:
+            for *_, future in batch:
+                future.set_exception(e)
+            return
+
+        for *_, future in batch:
+            future.set_result(True)
+        if self.on_flush:
+            try:
+                self.on_flush(user_id, sorted(merged))
+            except Exception as e:
+                print(f"寫入完成通知失敗 ({user_id}): {e}")
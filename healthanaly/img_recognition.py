@@ -1,20 +1,14 @@
 import os
 from flask import Blueprint, request, jsonify
-import google.generativeai as genai
 import json
+import model_providers
 # from werkzeug.utils import secure_filename # Potentially needed later for file handling
 
-# Configure the Gemini API key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-model = None
-if GEMINI_API_KEY:
-    try:
-        genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel('gemini-2.5-flash-preview-04-17') # Newer, faster model
-        print("Gemini API configured successfully with gemini-2.5-flash-preview-04-17.")
-    except Exception as e:
-        print(f"Error configuring Gemini API: {e}")
-        model = None # Ensure model is None if configuration fails
+IMAGE_MODEL_NAME = 'gemini-2.5-flash-preview-04-17' # Newer, faster model
+
+# The provider holds the Gemini API key (or the local stand-in when MODEL_PROVIDER=fake)
+if model_providers.get_model_provider().configured:
+    print(f"Image recognition uses {IMAGE_MODEL_NAME} via the '{model_providers.get_model_provider().name}' provider.")
 else:
     print("GEMINI_API_KEY not set in .env file. Image recognition will use mock data.")
     print("Please ensure the GEMINI_API_KEY is set in your .env file for live image analysis.")
@@ -26,7 +20,8 @@ def analyze_image_with_llm(image_bytes, mime_type, prompt_text, scan_type=None):
     Sends the image and prompt to Gemini and returns the structured response.
     scan_type can be 'fasting', 'postprandial', or None.
     """
-    if not model:
+    provider = model_providers.get_model_provider()
+    if not provider.configured:
         print("LLM model not available. Returning mock data.")
         if "血壓" in prompt_text:
             return {"systolic": 125, "diastolic": 85, "pulse": 75}
@@ -52,7 +47,7 @@ def analyze_image_with_llm(image_bytes, mime_type, prompt_text, scan_type=None):
         
         print(f"Sending prompt to Gemini (scan_type: {scan_type}): {full_prompt[:150]}...")
         
-        response = model.generate_content([image_part, full_prompt])
+        response = provider.generative_model(IMAGE_MODEL_NAME).generate_content([image_part, full_prompt])
         
         cleaned_response_text = response.text.strip()
         if cleaned_response_text.startswith("```json"):
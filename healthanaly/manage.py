@@ -0,0 +1,121 @@
+import argparse
+import json
+import os
+
+import health_storage
+import health_rollups
+import batch_reports
+import benchmark
+from health_write_queue import HealthWriteQueue, backfill_status_codes
+
+def cmd_migrate_to_sqlite(args):
+    summary = health_storage.migrate_csv_to_sqlite(args.users_dir, args.db)
+    for user_id, data_type, row_count in summary:
+        print(f"{user_id} / {data_type}: 匯入 {row_count} 天")
+    print(f"完成，共處理 {len(summary)} 個檔案，資料庫位置: {args.db}")
+    print("如要啟用，請在 .env 設定 HEALTH_STORAGE_BACKEND=sqlite")
+
+def _list_user_ids(args):
+    users_dir = os.path.join('static', 'users')
+    return args.user_ids or sorted(d for d in os.listdir(users_dir) if os.path.isdir(os.path.join(users_dir, d)))
+
+def cmd_rebuild_rollups(args):
+    user_ids = _list_user_ids(args)
+    store = health_storage.get_health_store()
+    for user_id in user_ids:
+        for data_type in health_rollups.ROLLUP_METRICS:
+            if store.has_data(user_id, data_type):
+                health_rollups.rebuild_rollups(user_id, data_type)
+                print(f"{user_id} / {data_type}: 彙總已重建")
+
+def cmd_backfill_status(args):
+    store = health_storage.get_health_store()
+    write_queue = HealthWriteQueue()
+    total = 0
+    for user_id in _list_user_ids(args):
+        for data_type in health_storage.HEALTH_STATUS_COLUMNS:
+            if not store.has_data(user_id, data_type):
+                continue
+            with write_queue.user_lock(user_id):
+                updated = backfill_status_codes(store, user_id, data_type)
+            total += updated
+            print(f"{user_id} / {data_type}: 回填 {updated} 天的狀態代碼")
+    print(f"完成，共回填 {total} 天")
+
+def cmd_batch_reports(args):
+    users_dir = os.path.join('static', 'users')
+    summary = batch_reports.run_batch_reports(
+        _list_user_ids(args), users_dir, period=args.period, workers=args.workers,
+        force=args.force, enabled_only=args.enabled_only,
+        data_types=('combined',) if args.combined else batch_reports.BATCH_REPORT_DATA_TYPES
+    )
+    counts = summary['counts']
+    print(f"完成: 產生 {counts['generated']} 份，略過 {counts['skipped']} 份，失敗 {counts['failed']} 份，"
+          f"共 {summary['wall_seconds']:.1f} 秒")
+    for stage, entry in summary['stages'].items():
+        print(f"  {stage}: 平均 {entry['avg_seconds']:.2f} 秒，最長 {entry['max_seconds']:.2f} 秒，合計 {entry['total_seconds']:.1f} 秒")
+    print(f"執行摘要: {summary['summary_path']}")
+    if counts['failed']:
+        raise SystemExit(1)
+
+def cmd_benchmark(args):
+    sizes = [int(size) for size in args.sizes.split(',')] if args.sizes else benchmark.BENCHMARK_SIZES
+    report = benchmark.run_benchmarks(
+        sizes=sizes, data_types=args.data_types or benchmark.BENCHMARK_DATA_TYPES, repeats=args.repeats,
+        model_latency=args.model_latency, seed=args.seed, output_path=args.output
+    )
+    print(benchmark.format_report(report))
+    print(f"結果: {report['output_path']}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = benchmark.compare_benchmarks(baseline, report, ratio=args.regression_ratio)
+        for item in regressions:
+            print(f"效能退化: {item['days']} 天 {item['data_type']} {item['stage']} "
+                  f"{item['baseline_seconds'] * 1000:.1f}ms -> {item['current_seconds'] * 1000:.1f}ms ({item['ratio']}x)")
+        if regressions:
+            raise SystemExit(1)
+        print(f"與 {args.compare} 相比沒有超過 {args.regression_ratio}x 的退化")
+
+def main():
+    parser = argparse.ArgumentParser(description="HealthLLM 健康數據維護工具")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate = subparsers.add_parser('migrate-to-sqlite', help="將 static/users 底下的 CSV 匯入 SQLite 資料庫")
+    migrate.add_argument('--users-dir', default=os.path.join('static', 'users'))
+    migrate.add_argument('--db', default=health_storage.HEALTH_DB_PATH)
+    migrate.set_defaults(func=cmd_migrate_to_sqlite)
+
+    rollups = subparsers.add_parser('rebuild-rollups', help="重新計算每位使用者的週/月彙總")
+    rollups.add_argument('user_ids', nargs='*', help="只處理指定的使用者 ID，預設為全部")
+    rollups.set_defaults(func=cmd_rebuild_rollups)
+
+    backfill = subparsers.add_parser('backfill-status', help="為既有紀錄計算並儲存每筆讀數的狀態代碼")
+    backfill.add_argument('user_ids', nargs='*', help="只處理指定的使用者 ID，預設為全部")
+    backfill.set_defaults(func=cmd_backfill_status)
+
+    batch = subparsers.add_parser('batch-reports', help="為所有使用者產生血壓與血糖的定期報告 (可由 cron 每晚執行)")
+    batch.add_argument('user_ids', nargs='*', help="只處理指定的使用者 ID，預設為全部")
+    batch.add_argument('--period', default=batch_reports.BATCH_REPORT_PERIOD, choices=['today', '7days', '30days', 'all'])
+    batch.add_argument('--workers', type=int, default=batch_reports.BATCH_REPORT_WORKERS)
+    batch.add_argument('--force', action='store_true', help="即使數據沒有變動也重新產生")
+    batch.add_argument('--enabled-only', action='store_true', help="只處理設定中啟用報告寄送 (email_report_enabled) 的使用者")
+    batch.add_argument('--combined', action='store_true', help="每位使用者只產生一份血壓與血糖的綜合報告")
+    batch.set_defaults(func=cmd_batch_reports)
+
+    bench = subparsers.add_parser('benchmark', help="以合成數據量測分析流程各階段的耗時、記憶體與輸出大小 (Gemini 以本機替身模型代替)")
+    bench.add_argument('--sizes', help="以逗號分隔的歷史天數，預設 1,7,30,365,1825,7300")
+    bench.add_argument('--data-types', nargs='+', choices=list(benchmark.BENCHMARK_DATA_TYPES))
+    bench.add_argument('--repeats', type=int, default=benchmark.BENCHMARK_REPEATS)
+    bench.add_argument('--model-latency', type=float, default=0.0, help="替身模型每次回應前等待的秒數")
+    bench.add_argument('--seed', type=int, default=0)
+    bench.add_argument('--output', help="結果 JSON 路徑，預設寫入 BENCHMARK_OUTPUT_DIR")
+    bench.add_argument('--compare', help="與先前的結果 JSON 比較，有效能退化時以狀態碼 1 結束")
+    bench.add_argument('--regression-ratio', type=float, default=benchmark.BENCHMARK_REGRESSION_RATIO)
+    bench.set_defaults(func=cmd_benchmark)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
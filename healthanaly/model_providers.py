@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 生成模型的提供者。預設直接呼叫 Gemini；MODEL_PROVIDER=fake 時改用本機的替身模型，
+# 回應內容由輸入決定 (相同輸入得到相同結果)，可設定延遲與失敗率，供無網路環境下的壓力測試量測伺服器本身的負擔。
+MODEL_PROVIDER = os.getenv('MODEL_PROVIDER', 'gemini').lower()
+FAKE_PROVIDER_LATENCY_SECONDS = float(os.getenv('FAKE_PROVIDER_LATENCY_SECONDS', '0'))
+FAKE_PROVIDER_FAILURE_RATE = float(os.getenv('FAKE_PROVIDER_FAILURE_RATE', '0'))
+FAKE_PROVIDER_SEED = int(os.getenv('FAKE_PROVIDER_SEED', '0'))
+FAKE_STREAM_CHUNKS = 4
+
+class FakeProviderError(RuntimeError):
+    """替身模型依失敗率注入的錯誤。"""
+
+class GeminiModelProvider:
+    name = 'gemini'
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key if api_key is not None else os.getenv('GEMINI_API_KEY')
+        if self.api_key:
+            genai.configure(api_key=self.api_key)
+
+    @property
+    def configured(self):
+        return bool(self.api_key)
+
+    def generative_model(self, model_name):
+        return genai.GenerativeModel(model_name)
+
+    def cache_id(self, model_name):
+        return model_name
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGenerativeModel:
+    """與 genai.GenerativeModel 相同介面 (generate_content，回應有 .text，stream=True 時可逐段迭代) 的替身。"""
+
+    def __init__(self, provider, model_name):
+        self.provider = provider
+        self.model_name = model_name
+
+    def generate_content(self, contents, stream=False):
+        parts = contents if isinstance(contents, list) else [contents]
+        prompt = "\n".join(part for part in parts if isinstance(part, str))
+        images = [part['data'] for part in parts if isinstance(part, dict) and 'data' in part]
+        digest = hashlib.sha256(prompt.encode('utf-8'))
+        for image in images:
+            digest.update(image)
+        seed = int(digest.hexdigest()[:8], 16)
+
+        self.provider.before_call()
+        text = fake_vision_text(prompt, seed) if images else fake_text(prompt, seed)
+        if not stream:
+            return _FakeResponse(text)
+        size = max(1, -(-len(text) // FAKE_STREAM_CHUNKS))
+        return iter([_FakeResponse(text[i:i + size]) for i in range(0, len(text), size)])
+
+def fake_text(prompt, seed):
+    return (
+        f"- 🟡 **指標變化觀察**：本機替身模型的固定回應 (#{seed % 10000:04d})，數據大致穩定。\n\n"
+        "- 🔴 **健康建議**：\n"
+        "  - 持續每日量測並記錄。\n"
+        "  - 維持規律作息與均衡飲食。\n"
+        "  - 若有不適請諮詢醫療專業人員。"
+    )
+
+def _first_keyword(text, keywords):
+    positions = {keyword: text.find(keyword) for keyword in keywords if keyword in text}
+    return min(positions, key=positions.get) if positions else None
+
+def fake_vision_text(prompt, seed):
+    """依提示詞判斷量測種類，回傳與 Gemini 相同格式的 JSON 文字；數值由圖片內容決定。
+    提示詞後段的 JSON 格式說明同時提到血壓與血糖，因此以最先出現的關鍵字為準。"""
+    kind = _first_keyword(prompt, ('血壓', '血糖'))
+    if kind == '血壓':
+        values = {'systolic': 110 + seed % 40, 'diastolic': 70 + seed % 20, 'pulse': 60 + seed % 30}
+    elif kind == '血糖' and _first_keyword(prompt, ('空腹', '餐後')) == '餐後':
+        values = {'postprandial': 110 + seed % 80}
+    elif kind == '血糖':
+        values = {'fasting': 80 + seed % 40}
+    else:
+        values = {}
+    return f"```json\n{json.dumps(values)}\n```"
+
+class FakeModelProvider:
+    name = 'fake'
+    configured = True
+
+    def __init__(self, latency_seconds=FAKE_PROVIDER_LATENCY_SECONDS, failure_rate=FAKE_PROVIDER_FAILURE_RATE,
+                 seed=FAKE_PROVIDER_SEED):
+        self.latency_seconds = latency_seconds
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+
+    def before_call(self):
+        """模擬網路延遲，並依失敗率拋出 FakeProviderError。"""
+        with self._lock:
+            self.calls += 1
+            failed = self._random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        time.sleep(self.latency_seconds)
+        if failed:
+            raise FakeProviderError("替身模型注入的錯誤")
+
+    def generative_model(self, model_name):
+        return FakeGenerativeModel(self, model_name)
+
+    def cache_id(self, model_name):
+        # 與真實模型的快取鍵分開，替身的回應不會被當成 Gemini 的分析結果
+        return f"{self.name}:{model_name}"
+
+_provider = None
+_provider_lock = threading.Lock()
+
+def get_model_provider():
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            if MODEL_PROVIDER == 'fake':
+                _provider = FakeModelProvider()
+                print(f"使用本機替身模型 (延遲 {FAKE_PROVIDER_LATENCY_SECONDS} 秒，失敗率 {FAKE_PROVIDER_FAILURE_RATE})")
+            elif MODEL_PROVIDER == 'gemini':
+                _provider = GeminiModelProvider()
+            else:
+                raise ValueError(f"未知的模型提供者: {MODEL_PROVIDER}")
+        return _provider
+
+def set_model_provider(provider):
+    """替換目前的提供者 (效能基準、壓力測試用)，回傳原本的提供者以便還原。"""
+    global _provider
+    with _provider_lock:
+        previous, _provider = _provider, provider
+    return previous
@@ -0,0 +1,107 @@
+import os
+import subprocess
+import threading
+import time
+
+import pdfkit
+
+# wkhtmltopdf 沒有常駐模式，每份 PDF 仍是一個子程序；這裡集中管理同時執行的數量、逾時與失敗重試。
+PDF_RENDER_CONCURRENCY = int(os.getenv('PDF_RENDER_CONCURRENCY', str(max(1, (os.cpu_count() or 2) - 1))))
+PDF_RENDER_TIMEOUT_SECONDS = float(os.getenv('PDF_RENDER_TIMEOUT_SECONDS', '60'))
+PDF_RENDER_RETRIES = int(os.getenv('PDF_RENDER_RETRIES', '1'))
+
+# 報告模板不含 JavaScript，關閉後可省去 wkhtmltopdf 啟動 JS 引擎與等待的時間
+DEFAULT_PDF_OPTIONS = {
+    'enable-local-file-access': '',
+    'disable-javascript': '',
+}
+
+class PdfRenderError(RuntimeError):
+    pass
+
+class PdfRenderService:
+    """以 wkhtmltopdf 將 HTML 轉為 PDF。
+
+    - 以 semaphore 限制同時執行的子程序數，批次產生大量報告時不會把機器壓垮
+    - 每次轉檔有逾時限制，逾時的子程序會被終止
+    - 子程序當掉或輸出不完整時自動重試，輸出先寫入暫存檔再原子性地替換"""
+
+    def __init__(self, configuration, concurrency=PDF_RENDER_CONCURRENCY,
+                 timeout_seconds=PDF_RENDER_TIMEOUT_SECONDS, retries=PDF_RENDER_RETRIES):
+        self.configuration = configuration
+        self.timeout_seconds = timeout_seconds
+        self.retries = retries
+        self.concurrency = concurrency
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self.rendered = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.retried = 0
+        self.abandoned = 0
+        self.total_seconds = 0.0
+
+    def _run_once(self, html_bytes, output_path, options):
+        tmp_path = f"{output_path}.{threading.get_ident()}.tmp.pdf"
+        args = pdfkit.PDFKit('', 'string', options=options, configuration=self.configuration).command(tmp_path)
+        try:
+            with self._slots:
+                completed = subprocess.run(
+                    args, input=html_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    timeout=self.timeout_seconds
+                )
+            # wkhtmltopdf 在部分資源載入失敗時會回傳 1 但仍輸出完整 PDF，因此以輸出檔內容判斷是否成功
+            signature = b''
+            if os.path.exists(tmp_path):
+                with open(tmp_path, 'rb') as f:
+                    signature = f.read(4)
+            if signature != b'%PDF':
+                stderr = completed.stderr.decode('utf-8', errors='replace').strip()
+                raise PdfRenderError(f"wkhtmltopdf 輸出無效 (exit {completed.returncode}): {stderr}")
+            os.replace(tmp_path, output_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def render(self, html, output_path, options=None):
+        render_options = dict(DEFAULT_PDF_OPTIONS, **(options or {}))
+        html_bytes = html.encode('utf-8')
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self._lock:
+                    self.retried += 1
+            started = time.perf_counter()
+            try:
+                self._run_once(html_bytes, output_path, render_options)
+            except subprocess.TimeoutExpired:
+                with self._lock:
+                    self.timeouts += 1
+                last_error = PdfRenderError(f"wkhtmltopdf 超過 {self.timeout_seconds:.0f} 秒未完成")
+            except (PdfRenderError, OSError) as e:
+                last_error = e
+            else:
+                with self._lock:
+                    self.rendered += 1
+                    self.total_seconds += time.perf_counter() - started
+                return output_path
+            with self._lock:
+                self.failures += 1
+            print(f"PDF 轉檔失敗 (第 {attempt + 1} 次): {last_error}")
+        with self._lock:
+            self.abandoned += 1
+        raise PdfRenderError(str(last_error))
+
+    def stats(self):
+        """rendered: 成功的轉檔數；failures: 失敗的嘗試次數 (含逾時)；timeouts: 其中逾時的次數；
+        retried: 重試次數；abandoned: 重試用盡仍失敗的轉檔數。"""
+        with self._lock:
+            return {
+                'rendered': self.rendered,
+                'failures': self.failures,
+                'timeouts': self.timeouts,
+                'concurrency': self.concurrency,
+                'retried': self.retried,
+                'abandoned': self.abandoned,
+                'avg_seconds': round(self.total_seconds / self.rendered, 3) if self.rendered else None,
+            }
@@ -0,0 +1,142 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import plotly.graph_objects as go
+import plotly.io as pio
+
+try:
+    import kaleido
+except ImportError:
+    kaleido = None
+
+# 已輸出 PNG 的記憶體快取上限 (bytes)；同一張趨勢圖 (例如先下載再寄送) 只需輸出一次
+PLOT_IMAGE_CACHE_MAX_BYTES = int(os.getenv('PLOT_IMAGE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# 單張圖片輸出的逾時秒數；常駐程序無回應時改回每次冷啟動的輸出方式
+PLOT_EXPORT_TIMEOUT_SECONDS = float(os.getenv('PLOT_EXPORT_TIMEOUT_SECONDS', '60'))
+
+class PlotImageExporter:
+    """常駐的 Plotly 圖片輸出器。
+
+    Kaleido 1.x 提供常駐的瀏覽器程序 (start_sync_server)，啟動後 pio.to_image 不必每次冷啟動。
+    該程序一次只能處理一個請求，因此輸出時以鎖序列化。常駐程序的執行緒若異常結束，呼叫端會永遠等待，
+    因此先以一次冷啟動輸出確認 Chrome 可用才啟動常駐程序，且每次輸出都有逾時限制。"""
+
+    def __init__(self, max_cache_bytes=PLOT_IMAGE_CACHE_MAX_BYTES, timeout_seconds=PLOT_EXPORT_TIMEOUT_SECONDS):
+        self.max_cache_bytes = max_cache_bytes
+        self.timeout_seconds = timeout_seconds
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        self._started = False
+        self._server_running = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _server_supported():
+        return kaleido is not None and hasattr(kaleido, 'start_sync_server')
+
+    def _to_image(self, fig, width, height, scale):
+        """在另一個執行緒中輸出，超過逾時仍未完成時拋出 TimeoutError。"""
+        result = {}
+
+        def run():
+            try:
+                result['png'] = pio.to_image(fig, format='png', width=width, height=height, scale=scale, validate=False)
+            except Exception as e:
+                result['error'] = e
+
+        worker = threading.Thread(target=run, name='plot-export', daemon=True)
+        worker.start()
+        worker.join(self.timeout_seconds)
+        if worker.is_alive():
+            raise TimeoutError(f"Plotly 圖片輸出超過 {self.timeout_seconds:.0f} 秒未完成")
+        if 'error' in result:
+            raise result['error']
+        return result['png']
+
+    def _stop_server(self):
+        # stop_sync_server 會等待常駐執行緒結束，若該執行緒卡住則不再等待
+        self._server_running = False
+        if self._server_supported():
+            stopper = threading.Thread(target=kaleido.stop_sync_server, kwargs={'silence_warnings': True}, daemon=True)
+            stopper.start()
+            stopper.join(self.timeout_seconds)
+
+    def start(self):
+        """在背景確認 Chrome 可用後啟動常駐輸出程序，並輸出一張小圖完成 plotly.js 的載入。"""
+        with self._render_lock:
+            if self._started:
+                return
+            self._started = True
+
+        def run():
+            probe = go.Figure(go.Scatter(x=[0, 1], y=[0, 1]))
+            with self._render_lock:
+                try:
+                    self._to_image(probe, 50, 50, 1)
+                    if not self._server_supported():
+                        return
+                    kaleido.start_sync_server(silence_warnings=True)
+                    self._server_running = True
+                    self._to_image(probe, 50, 50, 1)
+                    print("Plotly 圖片輸出程序已就緒")
+                except Exception as e:
+                    print(f"Plotly 常駐圖片輸出程序未啟動，將改為每次輸出時啟動: {e}")
+                    if self._server_running:
+                        self._stop_server()
+
+        threading.Thread(target=run, name='plot-export-warmup', daemon=True).start()
+
+    def _render(self, fig, width, height, scale):
+        with self._render_lock:
+            if not self._server_running:
+                return self._to_image(fig, width, height, scale)
+            try:
+                return self._to_image(fig, width, height, scale)
+            except Exception as e:
+                # 常駐程序可能已當掉：關閉後以冷啟動方式重試一次
+                print(f"Plotly 圖片輸出失敗，改以冷啟動方式重試: {e}")
+                self._stop_server()
+                return self._to_image(fig, width, height, scale)
+
+    def to_png(self, fig, width=900, height=500, scale=2, content_key=None):
+        """回傳圖表的 PNG bytes。content_key 為圖表內容 (通常是已產生的 fig.to_json() 字串)，省略時會自行序列化。"""
+        content = content_key if content_key is not None else fig.to_json()
+        key = hashlib.sha256(f"{width}x{height}@{scale}:{content}".encode('utf-8')).hexdigest()
+        with self._cache_lock:
+            png = self._cache.get(key)
+            if png is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return png
+            self.misses += 1
+
+        png = self._render(fig, width, height, scale)
+        with self._cache_lock:
+            if key not in self._cache and len(png) <= self.max_cache_bytes:
+                self._cache[key] = png
+                self._cache_bytes += len(png)
+                while self._cache_bytes > self.max_cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(evicted)
+        return png
+
+    def stats(self):
+        with self._cache_lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._cache),
+                'bytes': self._cache_bytes,
+                'max_bytes': self.max_cache_bytes,
+                'warm_server': self._server_running,
+            }
+
+_exporter = PlotImageExporter()
+
+def get_plot_exporter():
+    return _exporter
@@ -0,0 +1,243 @@
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 同時執行的報告工作數 (每個工作包含 Gemini 呼叫、圖片輸出與 wkhtmltopdf)
+REPORT_JOB_WORKERS = int(os.getenv('REPORT_JOB_WORKERS', '2'))
+# 已完成的工作 (及其輸出檔) 保留多久以供下載
+REPORT_JOB_RETENTION_SECONDS = float(os.getenv('REPORT_JOB_RETENTION_SECONDS', '3600'))
+# 工作狀態以每個工作一個 JSON 檔儲存，所有 worker 程序都從這裡讀取，重新啟動後仍查得到
+REPORT_JOB_DIR = os.getenv('REPORT_JOB_DIR', os.path.join('instance', 'report_jobs'))
+# 未完成的工作超過此秒數沒有任何進度，視為執行它的程序已中止
+REPORT_JOB_STALE_SECONDS = float(os.getenv('REPORT_JOB_STALE_SECONDS', '900'))
+# 每個程序清理過期工作的最短間隔 (清理需要讀取 job_dir 內所有工作檔)
+REPORT_JOB_PURGE_INTERVAL_SECONDS = float(os.getenv('REPORT_JOB_PURGE_INTERVAL_SECONDS', '300'))
+
+JOB_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+class ReportJob:
+    def __init__(self, owner_id, kind, params, key):
+        self.id = uuid.uuid4().hex
+        self.owner_id = str(owner_id)
+        self.kind = kind
+        self.params = dict(params)
+        self.key = key
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.message = '報告工作已排入佇列...'
+        self.result = None
+        self.output_dir = None
+        self.pid = os.getpid()
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': self.params,
+            'status': self.status,
+            'stage': self.stage,
+            'message': self.message,
+            'result': self.result,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+    def to_record(self):
+        """寫入磁碟的完整狀態 (含 API 不回傳的擁有者、去重鍵與輸出資料夾)。"""
+        return dict(self.to_dict(), owner_id=self.owner_id, key=list(self.key),
+                    output_dir=self.output_dir, pid=self.pid)
+
+    @classmethod
+    def from_record(cls, record):
+        job = cls.__new__(cls)
+        for name in ('id', 'owner_id', 'kind', 'params', 'status', 'stage', 'message', 'result',
+                     'output_dir', 'pid', 'created_at', 'updated_at'):
+            setattr(job, name, record.get(name))
+        job.key = tuple(record.get('key') or ())
+        return job
+
+class ReportJobQueue:
+    """報告產生的背景工作佇列。
+
+    submit() 立即回傳工作，實際處理在有上限的執行緒池中進行；每次進度變化都會寫入 job_dir 並呼叫 on_update(job)。
+    get() 一律從磁碟讀取，因此查詢可由任何一個 worker 程序處理。
+    同一位使用者以相同參數重複送出時，若前一個工作尚未完成，會直接回傳該工作 (以 job_dir/active 下的鍵檔跨程序去重)。"""
+
+    def __init__(self, max_workers=REPORT_JOB_WORKERS, retention_seconds=REPORT_JOB_RETENTION_SECONDS, on_update=None,
+                 job_dir=REPORT_JOB_DIR, stale_seconds=REPORT_JOB_STALE_SECONDS,
+                 purge_interval_seconds=REPORT_JOB_PURGE_INTERVAL_SECONDS):
+        self.retention_seconds = retention_seconds
+        self.stale_seconds = stale_seconds
+        self.purge_interval_seconds = purge_interval_seconds
+        self.on_update = on_update
+        self.job_dir = job_dir
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='report-job')
+        self._lock = threading.Lock()
+        self._running = set()
+        self._last_purge = 0.0
+
+    @staticmethod
+    def make_key(owner_id, kind, params):
+        return (str(owner_id), kind) + tuple(sorted((k, str(v)) for k, v in params.items()))
+
+    def _job_path(self, job_id):
+        return os.path.join(self.job_dir, f"{job_id}.json")
+
+    def _key_path(self, key):
+        digest = hashlib.sha256(json.dumps(list(key), ensure_ascii=False).encode('utf-8')).hexdigest()
+        return os.path.join(self.job_dir, 'active', digest)
+
+    def _save(self, job):
+        path = self._job_path(job.id)
+        os.makedirs(self.job_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job.to_record(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _load(self, job_id):
+        try:
+            with open(self._job_path(job_id), 'r', encoding='utf-8') as f:
+                return ReportJob.from_record(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _is_interrupted(self, job):
+        """未完成的工作是否已沒有程序在執行：本程序建立但不在執行中 (例如重新啟動後 PID 相同)，或長時間沒有進度。"""
+        if job.finished:
+            return False
+        with self._lock:
+            if job.id in self._running:
+                return False
+        if job.pid == os.getpid():
+            return True
+        return time.time() - job.updated_at > self.stale_seconds
+
+    def submit(self, owner_id, kind, params, runner):
+        """runner(job, progress) 執行實際工作並回傳結果 dict；progress(stage, message) 用於回報進度。
+
+        回傳 (job, 是否為新建立的工作)。"""
+        self._purge_expired()
+        key = self.make_key(owner_id, kind, params)
+        key_path = self._key_path(key)
+        os.makedirs(os.path.dirname(key_path), exist_ok=True)
+        job = ReportJob(owner_id, kind, params, key)
+        with self._lock:
+            self._running.add(job.id)
+        # 先寫入工作檔再建立鍵檔，其他程序讀到鍵檔時一定查得到對應的工作
+        self._save(job)
+        for _ in range(3):
+            try:
+                fd = os.open(key_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                existing = self.get(self._read_key(key_path))
+                if existing is not None and not existing.finished:
+                    self._discard(job)
+                    return existing, False
+                self._remove_key(key_path)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(job.id)
+            break
+        self._executor.submit(self._run, job, runner)
+        return job, True
+
+    def get(self, job_id):
+        if not job_id or not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        job = self._load(job_id)
+        if job is not None and self._is_interrupted(job):
+            self._update(job, status='failed', stage='failed', message='❌ 報告工作已中斷 (伺服器重新啟動)，請重新送出。')
+        return job
+
+    @staticmethod
+    def _read_key(key_path):
+        try:
+            with open(key_path, 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _remove_key(self, key_path, job_id=None):
+        if job_id is not None and self._read_key(key_path) != job_id:
+            return
+        try:
+            os.remove(key_path)
+        except FileNotFoundError:
+            pass
+
+    def _discard(self, job):
+        with self._lock:
+            self._running.discard(job.id)
+        try:
+            os.remove(self._job_path(job.id))
+        except FileNotFoundError:
+            pass
+
+    def _update(self, job, **fields):
+        with self._lock:
+            for name, value in fields.items():
+                setattr(job, name, value)
+            job.updated_at = time.time()
+            if job.finished:
+                self._running.discard(job.id)
+            self._save(job)
+        if job.finished:
+            self._remove_key(self._key_path(job.key), job.id)
+        if self.on_update:
+            try:
+                self.on_update(job)
+            except Exception as e:
+                print(f"報告工作進度通知失敗 ({job.id}): {e}")
+
+    def _run(self, job, runner):
+        self._update(job, status='running', stage='started', message='開始產生報告...')
+        try:
+            result = runner(job, lambda stage, message: self._update(job, stage=stage, message=message))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            self._update(job, status='failed', stage='failed', message=f'❌ 報告產生失敗: {e}')
+            return
+        self._update(job, status='done', stage='done', message=result.pop('message', '🟢 報告已完成'), result=result)
+
+    def _purge_expired(self):
+        """刪除超過保留時間的工作檔、鍵檔與輸出資料夾 (含已中斷但從未被查詢的工作)。
+
+        每個程序最多每 purge_interval_seconds 執行一次；直接讀取工作檔，不經過 get()，清理時不會改寫任何工作。"""
+        now = time.time()
+        with self._lock:
+            if now - self._last_purge < self.purge_interval_seconds:
+                return
+            self._last_purge = now
+        if not os.path.isdir(self.job_dir):
+            return
+        for name in os.listdir(self.job_dir):
+            job_id, ext = os.path.splitext(name)
+            if ext != '.json' or not JOB_ID_PATTERN.fullmatch(job_id):
+                continue
+            job = self._load(job_id)
+            if job is None or now - job.updated_at <= self.retention_seconds:
+                continue
+            if not (job.finished or self._is_interrupted(job)):
+                continue
+            try:
+                os.remove(self._job_path(job.id))
+            except FileNotFoundError:
+                continue
+            if job.key:
+                self._remove_key(self._key_path(job.key), job.id)
+            if job.output_dir and os.path.isdir(job.output_dir):
+                shutil.rmtree(job.output_dir, ignore_errors=True)
@@ -0,0 +1,43 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# 各種分析流程共用的執行緒池。階段多半在等待外部程序 (Gemini、Kaleido、wkhtmltopdf)，
+# 因此數量可以比 CPU 核心數多；排程本身在呼叫端執行緒進行，階段之間不會互相等待而卡住執行緒池。
+STAGE_EXECUTOR_WORKERS = int(os.getenv('STAGE_EXECUTOR_WORKERS', '8'))
+
+_executor = ThreadPoolExecutor(max_workers=STAGE_EXECUTOR_WORKERS, thread_name_prefix='pipeline-stage')
+
+def get_stage_executor():
+    return _executor
+
+def run_stage_graph(stages, timings=None, executor=None):
+    """依相依關係執行一組階段，彼此獨立的階段同時在執行緒池中執行。
+
+    stages 為 {名稱: (相依的階段名稱 tuple, fn)}，fn(results) 收到已完成階段的結果 dict 並回傳本階段結果。
+    回傳 {名稱: 結果}；timings 若提供 dict，會記錄每個階段執行的秒數。任一階段拋出例外時直接向上拋出。"""
+    executor = executor or _executor
+    results = {}
+    pending = dict(stages)
+    running = {}
+
+    def timed(name, fn, snapshot):
+        started = time.perf_counter()
+        try:
+            return fn(snapshot)
+        finally:
+            if timings is not None:
+                timings[name] = time.perf_counter() - started
+
+    while pending or running:
+        ready = [name for name, (deps, _) in pending.items() if all(dep in results for dep in deps)]
+        for name in ready:
+            deps, fn = pending.pop(name)
+            running[executor.submit(timed, name, fn, dict(results))] = name
+        if not running:
+            missing = {name: [dep for dep in deps if dep not in stages] for name, (deps, _) in pending.items()}
+            raise ValueError(f"階段相依關係無法滿足: {missing}")
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            results[running.pop(future)] = future.result()
+    return results
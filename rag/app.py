@@ -1,16 +1,13 @@
 from flask import Flask, request, jsonify, send_file
 import tempfile
-from gtts import gTTS
 import whisper
 from langchain_community.vectorstores import FAISS
-from langchain_ollama import OllamaEmbeddings, OllamaLLM
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.chains import RetrievalQA
 import os
 from pathlib import Path
 from dotenv import load_dotenv
-import google.generativeai as genai
 import logging
 from pydub import AudioSegment
 import asyncio
@@ -19,6 +16,7 @@ import hashlib
 from tqdm import tqdm
 import torch
 from importlib.util import find_spec
+import providers
 
 load_dotenv()
 
@@ -63,7 +61,7 @@ except Exception as e:
 
 # Initialize FAISS with PDF hash check
 PDF_DATA_DIR = os.getenv("PDF_DATA_DIR")
-index_path = "faiss_index"
+index_path = f"faiss_index{providers.INDEX_SUFFIX}"
 print(PDF_DATA_DIR, os.listdir(PDF_DATA_DIR))
 pdf_paths = []
 if PDF_DATA_DIR:
@@ -72,7 +70,7 @@ if PDF_DATA_DIR:
             pdf_paths.append(os.path.join(PDF_DATA_DIR, filename))
 else:
     logging.warning("PDF_DATA_DIR environment variable not set.")
-hash_file = "pdf_hash.txt"
+hash_file = f"pdf_hash{providers.INDEX_SUFFIX}.txt"
 model_name = os.getenv("OLLAMA_MODEL", "llama3.2:latest")
 
 def get_pdf_hash(paths):
@@ -87,8 +85,8 @@ def get_pdf_hash(paths):
     return hasher.hexdigest()
 
 try:
-    embeddings = OllamaEmbeddings(model=model_name)
-    logging.info("Ollama embeddings initialized successfully.")
+    embeddings = providers.get_embeddings(model_name)
+    logging.info(f"Embeddings initialized successfully ({providers.MODEL_PROVIDER} provider).")
 except Exception as e:
     logging.error(f"Ollama embeddings initialization failed ({model_name}): {e}")
     raise
@@ -142,12 +140,7 @@ if not vectorstore:
 # Set up retriever
 retriever = vectorstore.as_retriever(search_type="mmr", search_kwargs={"k": 6, "fetch_k": 20})
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    logging.error("GEMINI_API_KEY not found in environment variables.")
-    raise ValueError("GEMINI_API_KEY is required.")
-genai.configure(api_key=GEMINI_API_KEY)
-gemini = genai.GenerativeModel("gemini-2.0-flash")
+gemini = providers.get_gemini("gemini-2.0-flash")
 logging.info("Gemini model initialized successfully.")
 
 async def transcribe_audio(audio_path):
@@ -160,7 +153,7 @@ async def transcribe_audio(audio_path):
 async def process_question(question):
     try:
         retriever_chain = RetrievalQA.from_chain_type(
-            llm=OllamaLLM(model=model_name, system="你是一個專業的助手，所有回應請使用正體中文，語言清晰且符合台灣用語習慣。"),
+            llm=providers.get_llm(model_name, system="你是一個專業的助手，所有回應請使用正體中文，語言清晰且符合台灣用語習慣。"),
             retriever=retriever
         )
         retrieval_response = retriever_chain.invoke(question)
@@ -189,9 +182,8 @@ AUDIO_OUTPUT_DIR = os.getenv("AUDIO_OUTPUT_DIR")
 
 async def generate_speech(text):
     try:
-        tts = gTTS(text=text, lang='zh-tw')
         tts_path = os.path.join(AUDIO_OUTPUT_DIR, f"response_{uuid.uuid4()}.mp3")
-        tts.save(tts_path)
+        providers.synthesize_speech(text, tts_path)
         logging.info(f"Generated audio response at: {tts_path}")
         return tts_path
     except Exception as e:
@@ -0,0 +1,126 @@
+import os
+import random
+import hashlib
+import logging
+import threading
+import time
+
+import numpy as np
+import google.generativeai as genai
+from dotenv import load_dotenv
+from gtts import gTTS
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+from langchain_ollama import OllamaEmbeddings, OllamaLLM
+
+load_dotenv()
+
+# Backends used by the RAG service. MODEL_PROVIDER=fake swaps Gemini, Ollama (LLM + embeddings) and gTTS
+# for deterministic local stand-ins so the service can be load-tested without network access; the
+# stand-ins share one configurable latency and failure rate.
+MODEL_PROVIDER = os.getenv("MODEL_PROVIDER", "real").lower()
+FAKE_PROVIDER_LATENCY_SECONDS = float(os.getenv("FAKE_PROVIDER_LATENCY_SECONDS", "0"))
+FAKE_PROVIDER_FAILURE_RATE = float(os.getenv("FAKE_PROVIDER_FAILURE_RATE", "0"))
+FAKE_PROVIDER_SEED = int(os.getenv("FAKE_PROVIDER_SEED", "0"))
+FAKE_EMBEDDING_SIZE = 384
+
+USE_FAKE_PROVIDERS = MODEL_PROVIDER == "fake"
+# Keeps a FAISS index built from fake embeddings apart from the real one
+INDEX_SUFFIX = "_fake" if USE_FAKE_PROVIDERS else ""
+
+class FakeProviderError(RuntimeError):
+    """Failure injected by a stand-in backend."""
+
+class FaultInjector:
+    def __init__(self, latency_seconds=FAKE_PROVIDER_LATENCY_SECONDS, failure_rate=FAKE_PROVIDER_FAILURE_RATE,
+                 seed=FAKE_PROVIDER_SEED):
+        self.latency_seconds = latency_seconds
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def before_call(self, backend):
+        with self._lock:
+            failed = self._random.random() < self.failure_rate
+        time.sleep(self.latency_seconds)
+        if failed:
+            raise FakeProviderError(f"Injected failure in fake {backend}")
+
+fault_injector = FaultInjector()
+
+def _digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class FakeLLM(LLM):
+    """Stand-in for OllamaLLM: returns the start of the prompt (the retrieved context) as the answer."""
+
+    @property
+    def _llm_type(self):
+        return "fake"
+
+    def _call(self, prompt, stop=None, run_manager=None, **kwargs):
+        fault_injector.before_call("llm")
+        return f"(fake #{_digest(prompt)[:8]}) {prompt.strip()[:300]}"
+
+class FakeEmbeddings(Embeddings):
+    """Stand-in for OllamaEmbeddings: unit vectors seeded by the text, so equal texts map to equal vectors."""
+
+    def __init__(self, size=FAKE_EMBEDDING_SIZE):
+        self.size = size
+
+    def _vector(self, text):
+        vector = np.random.default_rng(int(_digest(text)[:16], 16)).standard_normal(self.size)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        fault_injector.before_call("embeddings")
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        fault_injector.before_call("embeddings")
+        return self._vector(text)
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeGemini:
+    """Stand-in for genai.GenerativeModel.generate_content on text prompts."""
+
+    def generate_content(self, prompt):
+        fault_injector.before_call("gemini")
+        return _FakeResponse(f"這是本機替身模型的回答 (#{_digest(str(prompt))[:8]})，請以實際模型取得健康建議。")
+
+# One silent MPEG-1 Layer III frame (128 kbps, 44.1 kHz, ~26 ms); zeroed side info decodes as silence
+_SILENT_MP3_FRAME = bytes([0xFF, 0xFB, 0x90, 0x64]) + bytes(413)
+
+def get_embeddings(model_name):
+    if USE_FAKE_PROVIDERS:
+        return FakeEmbeddings()
+    return OllamaEmbeddings(model=model_name)
+
+def get_llm(model_name, system=None):
+    if USE_FAKE_PROVIDERS:
+        return FakeLLM()
+    return OllamaLLM(model=model_name, system=system)
+
+def get_gemini(model_name):
+    if USE_FAKE_PROVIDERS:
+        logging.info("Using the fake Gemini backend.")
+        return FakeGemini()
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        logging.error("GEMINI_API_KEY not found in environment variables.")
+        raise ValueError("GEMINI_API_KEY is required.")
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+def synthesize_speech(text, output_path):
+    """Writes an MP3 of text to output_path; the fake backend writes silence roughly as long as speech would be."""
+    if USE_FAKE_PROVIDERS:
+        fault_injector.before_call("tts")
+        with open(output_path, "wb") as f:
+            f.write(_SILENT_MP3_FRAME * max(1, len(text) * 10))
+        return output_path
+    gTTS(text=text, lang='zh-tw').save(output_path)
+    return output_path